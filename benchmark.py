@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+基于本地模拟服务器（mock_server.py）的性能基准测试
+
+测量课程发现耗时随章节/leaf数量的变化、单个视频 configure_video_session 的延迟、
+图文批量打卡的总耗时、单进程可维持的心跳会话数（含CPU和内存）、moov 在
+文件开头/末尾时时长探测读取的字节数，以及心跳事件的编码速度。结果以 JSON 输出，便于对比不同版本的 main.py：
+
+    python benchmark.py --output bench.json
+    python benchmark.py --quick
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import threading
+import time
+from datetime import datetime
+
+import main
+from mock_server import MockYuketangServer
+
+
+def _serve(conn, options):
+    server = MockYuketangServer(**options).start()
+    conn.send(server.base_url)
+    # 收到任意消息后停止，并把服务器端的请求统计发回
+    conn.recv()
+    conn.send(server.stats())
+    server.stop()
+
+
+class MockServerProcess:
+    """在独立进程中运行模拟服务器，避免服务端的CPU和内存计入被测进程"""
+
+    def __init__(self, **options):
+        self.options = options
+        self.base_url = None
+        self.server_stats = None
+
+    def __enter__(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve, args=(child_conn, self.options), daemon=True)
+        self.process.start()
+        self.base_url = self.conn.recv()
+        return self
+
+    def __exit__(self, *exc):
+        self.conn.send('stop')
+        self.server_stats = self.conn.recv()
+        self.process.join(timeout=5)
+
+
+@contextlib.contextmanager
+def quiet():
+    """屏蔽 main.py 的日志输出"""
+    previous = main.logger.level
+    main.logger.setLevel(logging.CRITICAL)
+    try:
+        yield
+    finally:
+        main.logger.setLevel(previous)
+
+
+def new_client(base_url, **kwargs):
+    # 默认不限速，测量客户端本身的能力
+    kwargs.setdefault('rate_limiter', main.RateLimiter())
+    client = main.YuketangHeartbeat({'csrftoken': 'bench', 'sessionid': 'bench'}, base_url=base_url, **kwargs)
+    client.set_account_params('bench', 1234)
+    return client
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    return {
+        'count': len(samples),
+        'mean': statistics.mean(samples),
+        'p50': samples[len(samples) // 2],
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'max': samples[-1],
+    }
+
+
+def current_rss_kb():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def bench_discovery(sizes, repeats, latency_ms):
+    """课程发现：新实例首次获取视频列表的耗时（含 course/chapter 请求和结构解析）"""
+    results = []
+    for chapters, videos_per_chapter in sizes:
+        with MockServerProcess(chapters=chapters, videos_per_chapter=videos_per_chapter,
+                               richtexts_per_chapter=1, latency_ms=latency_ms) as server:
+            samples = []
+            video_count = 0
+            for _ in range(repeats):
+                client = new_client(server.base_url)
+                start = time.perf_counter()
+                with quiet():
+                    videos = client.get_video_leaf_list(1)
+                samples.append(time.perf_counter() - start)
+                video_count = len(videos)
+        results.append({
+            'chapters': chapters,
+            'videos_per_chapter': videos_per_chapter,
+            'leaves': chapters * (videos_per_chapter + 1),
+            'videos_found': video_count,
+            'seconds': summarize(samples),
+        })
+    return results
+
+
+def bench_configure(video_count, latency_ms):
+    """逐个视频调用 configure_video_session 的延迟（冷启动，不使用磁盘缓存）"""
+    with MockServerProcess(chapters=1, videos_per_chapter=video_count, latency_ms=latency_ms) as server:
+        client = new_client(server.base_url)
+        with quiet():
+            videos = client.get_video_leaf_list(1)
+        samples = []
+        failures = 0
+        for video_info in videos:
+            start = time.perf_counter()
+            with quiet():
+                video_session = client.configure_video_session(1, video_info['id'])
+            samples.append(time.perf_counter() - start)
+            failures += 0 if video_session is not None else 1
+    return {
+        'videos': len(samples),
+        'failures': failures,
+        'seconds': summarize(samples),
+        'server_requests': server.server_stats['requests'],
+    }
+
+
+def bench_richtext(richtext_count, concurrencies, stay_seconds, latency_ms):
+    """图文批量打卡的总耗时（所有图文初始均未完成）"""
+    results = []
+    for concurrency in concurrencies:
+        with MockServerProcess(chapters=1, videos_per_chapter=0, richtexts_per_chapter=richtext_count,
+                               latency_ms=latency_ms) as server:
+            client = new_client(server.base_url)
+            start = time.perf_counter()
+            with quiet():
+                summary = client.batch_view_richtexts(1, stay_seconds=stay_seconds, skip_delay=0.1,
+                                                      concurrency=concurrency)
+            elapsed = time.perf_counter() - start
+        results.append({
+            'concurrency': concurrency,
+            'richtexts': richtext_count,
+            'stay_seconds': stay_seconds,
+            'wall_seconds': elapsed,
+            'success': summary['success'] if summary else 0,
+        })
+    return results
+
+
+def bench_heartbeat_sessions(session_counts, interval, ticks, latency_ms):
+    """同时运行 N 个观看会话（共享中央调度器），测量心跳吞吐、唤醒延迟、CPU 和 RSS
+
+    延迟 P95 不超过心跳间隔的 10% 视为该会话数可以维持。
+    """
+    results = []
+    for session_count in session_counts:
+        with MockServerProcess(chapters=1, videos_per_chapter=1, video_duration=interval * ticks,
+                               latency_ms=latency_ms) as server:
+            scheduler = main.HeartbeatScheduler()
+            client = new_client(server.base_url, scheduler=scheduler)
+            with quiet():
+                videos = client.get_video_leaf_list(1)
+                template = client.configure_video_session(1, videos[0]['id'])
+            video_sessions = [template.clone() for _ in range(session_count)]
+
+            rss_before = current_rss_kb()
+            cpu_before = time.process_time()
+            start = time.perf_counter()
+            with quiet():
+                threads = [
+                    threading.Thread(target=client.run_watch_plan,
+                                     args=(video_session, client.watch_plan(video_session, speed=1.0, interval=interval)))
+                    for video_session in video_sessions
+                ]
+                for thread in threads:
+                    thread.start()
+                peak_rss = current_rss_kb()
+                for thread in threads:
+                    thread.join()
+            elapsed = time.perf_counter() - start
+            cpu = time.process_time() - cpu_before
+
+        heartbeats = server.server_stats['requests'].get('heartbeat', 0)
+        lateness = scheduler.stats()
+        results.append({
+            'sessions': session_count,
+            'interval': interval,
+            'wall_seconds': elapsed,
+            'heartbeats': heartbeats,
+            'heartbeats_per_second': heartbeats / elapsed if elapsed else 0.0,
+            'cpu_seconds': cpu,
+            'cpu_ms_per_heartbeat': cpu * 1000 / heartbeats if heartbeats else None,
+            'rss_kb_before': rss_before,
+            'rss_kb_running': peak_rss,
+            'rss_kb_per_session': (peak_rss - rss_before) / session_count,
+            'lateness': lateness,
+            'sustained': lateness['p95_lateness'] <= interval * 0.1,
+        })
+    return results
+
+
+def bench_duration_probe(mdat_sizes):
+    """moov 在文件开头/末尾时 getVideoDuration 读取的字节数和请求数"""
+    results = []
+    for mdat_size in mdat_sizes:
+        for layout in ('start', 'end'):
+            with MockServerProcess(chapters=1, videos_per_chapter=1, moov_layout=layout,
+                                   mdat_size=mdat_size) as server:
+                client = new_client(server.base_url)
+                with quiet():
+                    videos = client.get_video_leaf_list(1)
+                    leaf_info = client.get_leaf_info(1, videos[0]['id'])
+                    ccid = leaf_info['data']['content_info']['media']['ccid']
+                    stats = {}
+                    start = time.perf_counter()
+                    duration = main.getVideoDuration(f"{server.base_url}/media/{ccid}.mp4", stats=stats)
+                    elapsed = time.perf_counter() - start
+            results.append({
+                'moov': layout,
+                'file_bytes': mdat_size,
+                'duration': duration,
+                'bytes_read': stats.get('bytes_read'),
+                'requests': stats.get('requests'),
+                'seconds': elapsed,
+            })
+    return results
+
+
+def bench_heartbeat_encoding(event_count):
+    """单个会话每秒可编码的心跳事件数：逐个构造字典再 json.dumps，对比预序列化静态字段的编码器"""
+    client = new_client('http://127.0.0.1:1')
+    video_session = client.new_video_session(10001, 20001, 30001, 40001, 1, 'ccid-bench', 1800.0, 'bench', 1234, 1234)
+
+    def encode_dicts(batch):
+        return json.dumps({"heart_data": [
+            client.create_heartbeat_data(video_session, "playing", position, 0, speed=1.0) for position in batch]})
+
+    def encode_fragments(batch):
+        return client.build_heartbeat_request(video_session, [
+            client.encode_heartbeat(video_session, "playing", position, 0, speed=1.0) for position in batch])[2]
+
+    # 两种方式的结果必须解析为相同的事件（时间戳和序列号除外）
+    expected = json.loads(encode_dicts([5.0]))['heart_data'][0]
+    actual = json.loads(encode_fragments([5.0]))['heart_data'][0]
+    for event in (expected, actual):
+        event.pop('ts')
+        event.pop('sq')
+    assert expected == actual, (expected, actual)
+
+    batch = [float(i) for i in range(10)]
+    results = {'backend': 'orjson' if main.orjson is not None else 'json', 'events': event_count}
+    for name, encode in (('dict_json_dumps', encode_dicts), ('encoder', encode_fragments)):
+        start = time.perf_counter()
+        for _ in range(event_count // len(batch)):
+            encode(batch)
+        elapsed = time.perf_counter() - start
+        results[name] = {'seconds': elapsed, 'events_per_second': event_count / elapsed}
+    results['speedup'] = results['encoder']['events_per_second'] / results['dict_json_dumps']['events_per_second']
+    return results
+
+
+def version_info():
+    main_path = os.path.abspath(main.__file__)
+    with open(main_path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(main_path),
+                                capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {'main_sha256': digest, 'git_commit': commit, 'python': platform.python_version()}
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='雨课堂心跳工具性能基准测试')
+    parser.add_argument('--output', help='结果写入的 JSON 文件（默认只输出到控制台）')
+    parser.add_argument('--quick', action='store_true', help='缩小规模，快速运行')
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='模拟服务器每个请求的延迟（毫秒）')
+    parser.add_argument('--only', nargs='+',
+                        choices=['discovery', 'configure', 'richtext', 'heartbeat', 'probe', 'encoding'],
+                        help='只运行指定的测试')
+    args = parser.parse_args()
+
+    if args.quick:
+        discovery_sizes = [(5, 5), (20, 10)]
+        configure_videos = 5
+        richtext_count, concurrencies = 6, [1, 3]
+        session_counts, ticks = [5, 20], 3
+        mdat_sizes = [1024 * 1024]
+        encoded_events = 20000
+    else:
+        discovery_sizes = [(5, 5), (20, 10), (50, 20), (100, 40)]
+        configure_videos = 20
+        richtext_count, concurrencies = 20, [1, 4, 8]
+        session_counts, ticks = [10, 50, 200, 500], 5
+        mdat_sizes = [1024 * 1024, 16 * 1024 * 1024]
+        encoded_events = 200000
+
+    benchmarks = {
+        'discovery': lambda: bench_discovery(discovery_sizes, repeats=3, latency_ms=args.latency_ms),
+        'configure': lambda: bench_configure(configure_videos, args.latency_ms),
+        'richtext': lambda: bench_richtext(richtext_count, concurrencies, stay_seconds=0.5,
+                                           latency_ms=args.latency_ms),
+        'heartbeat': lambda: bench_heartbeat_sessions(session_counts, interval=1, ticks=ticks,
+                                                      latency_ms=args.latency_ms),
+        'probe': lambda: bench_duration_probe(mdat_sizes),
+        'encoding': lambda: bench_heartbeat_encoding(encoded_events),
+    }
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'version': version_info(),
+        'params': {'quick': args.quick, 'latency_ms': args.latency_ms},
+        'results': {},
+    }
+    for name, run in benchmarks.items():
+        if args.only and name not in args.only:
+            continue
+        print(f"运行基准测试: {name} ...")
+        start = time.perf_counter()
+        report['results'][name] = run()
+        print(f"  完成，耗时 {time.perf_counter() - start:.1f}秒")
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+        print(f"结果已写入: {args.output}")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main_cli()
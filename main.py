@@ -5,37 +5,1536 @@
 """
 
 import requests
+import asyncio
+import atexit
 import json
 import time
 import random
 from datetime import datetime
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import copy
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import os
 from dotenv import load_dotenv
 import struct
+import heapq
+import math
+import itertools
+import importlib.util
+import logging
+import logging.handlers
+import queue
+import signal
+import sys
+import contextlib
+import contextvars
+from collections import deque
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+try:
+    import httpx  # 可选依赖：安装后 asyncio 引擎使用原生异步HTTP客户端
+except ImportError:
+    httpx = None
+
+try:
+    import orjson  # 可选依赖：安装后心跳使用更快的JSON编码
+except ImportError:
+    orjson = None
 
 # 加载环境变量
 load_dotenv()
 
+logger = logging.getLogger('yuketang')
 
-def getVideoDuration(url: str):
-    r = requests.get(url, stream=True)
-    for data in r.iter_content(chunk_size=512):
-        if data.find(b'mvhd') > 0:
-            index = data.find(b'mvhd') + 4
-            time_scale = struct.unpack('>I', data[index + 13:index + 13 + 4])
-            durations = struct.unpack('>I', data[index + 13 + 4:index + 13 + 4 + 4])
-            duration = durations[0] / time_scale[0]
+# 当前线程/协程的日志上下文（worker、leaf 等），由 log_context 设置
+_log_context = contextvars.ContextVar('yuketang_log_context', default={})
+
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """在代码块内为日志附加上下文字段，线程和 asyncio 任务各自独立"""
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+class _LogContextFilter(logging.Filter):
+    """在调用线程中把日志上下文写入记录（入队之前执行）"""
+
+    def filter(self, record):
+        context = _log_context.get()
+        record.context = context
+        record.context_text = ''.join(f"[{key}={value}]" for key, value in context.items()) + ' ' if context else ''
+        return True
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """每条日志一行 JSON，包含级别、线程和上下文字段"""
+
+    def format(self, record):
+        entry = {
+            'ts': record.created,
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'context', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level='INFO', json_file=None):
+    """配置日志：调用方只把记录放入队列，由单独的监听线程写控制台和可选的 JSONL 文件，
+    工作线程不会阻塞在 stdout 上。返回 QueueListener，退出前调用 stop() 刷新剩余日志。"""
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter('%(asctime)s %(levelname)-7s %(context_text)s%(message)s', '%H:%M:%S'))
+    handlers = [console]
+    if json_file:
+        directory = os.path.dirname(json_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        file_handler = logging.FileHandler(json_file, encoding='utf-8')
+        file_handler.setFormatter(JsonLinesFormatter())
+        handlers.append(file_handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(_LogContextFilter())
+    logger.handlers = [queue_handler]
+    logger.setLevel(level)
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    return listener
+
+
+# 默认服务器地址，可通过 YUKETANG_BASE_URL 指向本地模拟服务器（mock_server.py）
+DEFAULT_BASE_URL = "https://changjiang.yuketang.cn"
+
+# 服务器完成率达到该值即视为视频已看完
+COMPLETION_THRESHOLD = 0.9
+# 观看过程中两次进度查询的最短/最长间隔（秒），实际间隔随距完成阈值的远近调整
+PROGRESS_POLL_MIN_SECONDS = 10
+PROGRESS_POLL_MAX_SECONDS = 300
+
+# 标识当前课堂的 cookie，多课堂运行时按请求所属课堂改写
+CLASSROOM_COOKIES = ('classroomId', 'classroom_id')
+
+# MP4 时长探测：单个视频最多读取的字节数
+MP4_PROBE_MAX_BYTES = 512 * 1024
+# 首次读取文件头的字节数，moov 在文件开头时一次即可读到 mvhd
+MP4_PROBE_HEAD_BYTES = 64 * 1024
+# 跳转到后续 box（如文件末尾的 moov）时每次读取的字节数
+MP4_PROBE_JUMP_BYTES = 16 * 1024
+
+
+class _Mp4RangeReader:
+    """通过 HTTP Range 请求按需读取 MP4 文件片段，并限制总读取字节数"""
+
+    def __init__(self, url, session=None, max_bytes=MP4_PROBE_MAX_BYTES, timeout=10):
+        self.url = url
+        self.session = session or requests
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.file_size = None
+        self.bytes_read = 0
+        self.request_count = 0
+        # 已读取的片段 [(起始偏移, 数据), ...]
+        self.chunks = []
+
+    def _cached(self, offset, length):
+        for start, data in self.chunks:
+            if start <= offset and offset + length <= start + len(data):
+                return data[offset - start:offset - start + length]
+        return None
+
+    def read_at(self, offset, length, window=0):
+        """读取 [offset, offset+length) 的数据，未命中时按 max(length, window) 发起 Range 请求"""
+        data = self._cached(offset, length)
+        if data is not None:
+            return data
+
+        fetch_length = max(length, window)
+        if self.file_size is not None:
+            fetch_length = min(fetch_length, self.file_size - offset)
+        if fetch_length <= 0 or self.bytes_read + fetch_length > self.max_bytes:
+            return None
+
+        headers = {'Range': f'bytes={offset}-{offset + fetch_length - 1}'}
+        self.request_count += 1
+        with self.session.get(self.url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 206:
+                start = offset
+                content_range = response.headers.get('Content-Range', '')
+                total = content_range.rpartition('/')[2]
+                if total.isdigit():
+                    self.file_size = int(total)
+            elif response.status_code == 200:
+                # 服务器不支持 Range，只能从文件开头顺序读取
+                start = 0
+                fetch_length = offset + fetch_length
+                if self.bytes_read + fetch_length > self.max_bytes:
+                    fetch_length = self.max_bytes - self.bytes_read
+                content_length = response.headers.get('Content-Length', '')
+                if content_length.isdigit():
+                    self.file_size = int(content_length)
+            else:
+                return None
+
+            buffer = bytearray()
+            for block in response.iter_content(chunk_size=8192):
+                buffer.extend(block)
+                if len(buffer) >= fetch_length:
+                    break
+            self.bytes_read += len(buffer)
+
+        self.chunks.append((start, bytes(buffer[:fetch_length])))
+        return self._cached(offset, length)
+
+
+def _read_box_header(reader, offset, end=None, window=0):
+    """读取 box 头，返回 (类型, 头部长度, box总长度)，失败返回None"""
+    header = reader.read_at(offset, 8, window)
+    if header is None or len(header) < 8:
+        return None
+
+    size, box_type = struct.unpack('>I4s', header)
+    header_size = 8
+    if size == 1:
+        # 64位 largesize
+        large = reader.read_at(offset + 8, 8, window)
+        if large is None:
+            return None
+        size = struct.unpack('>Q', large)[0]
+        header_size = 16
+    elif size == 0:
+        # box 一直延续到父容器（或文件）末尾
+        limit = end if end is not None else reader.file_size
+        if limit is None:
+            return None
+        size = limit - offset
+
+    if size < header_size:
+        return None
+    return box_type, header_size, size
+
+
+def _parse_mvhd(payload):
+    """解析 mvhd，支持 version 0（32位）和 version 1（64位）"""
+    if len(payload) < 20:
+        return None
+    version = payload[0]
+    if version == 1:
+        if len(payload) < 32:
+            return None
+        time_scale, duration = struct.unpack('>IQ', payload[20:32])
+    else:
+        time_scale, duration = struct.unpack('>II', payload[12:20])
+    if not time_scale:
+        return None
+    return duration / time_scale
+
+
+def getVideoDuration(url: str, session=None, max_bytes=MP4_PROBE_MAX_BYTES, stats=None):
+    """按 box 结构遍历 MP4 获取视频时长（秒）
+
+    先读取文件头部；moov 不在头部时根据 box 长度直接跳到下一个 box，
+    moov 位于文件末尾时只读取末尾片段。失败或超过读取上限时返回None。
+    """
+    reader = _Mp4RangeReader(url, session=session, max_bytes=max_bytes)
+    try:
+        offset = 0
+        window = MP4_PROBE_HEAD_BYTES
+        while reader.file_size is None or offset < reader.file_size:
+            box = _read_box_header(reader, offset, window=window)
+            if box is None:
+                return None
+            box_type, header_size, size = box
+
+            if box_type == b'moov':
+                # 在 moov 的子 box 中查找 mvhd（通常是第一个）
+                child = offset + header_size
+                moov_end = offset + size
+                while child < moov_end:
+                    child_box = _read_box_header(reader, child, moov_end, window=MP4_PROBE_JUMP_BYTES)
+                    if child_box is None:
+                        return None
+                    child_type, child_header_size, child_size = child_box
+                    if child_type == b'mvhd':
+                        payload = reader.read_at(child + child_header_size, 32, MP4_PROBE_JUMP_BYTES)
+                        return _parse_mvhd(payload) if payload else None
+                    child += child_size
+                return None
+
+            offset += size
+            window = MP4_PROBE_JUMP_BYTES
+        return None
+    except Exception as e:
+        logger.warning("探测视频时长失败: %s", e)
+        return None
+    finally:
+        if stats is not None:
+            stats['bytes_read'] = reader.bytes_read
+            stats['requests'] = reader.request_count
+
+
+class SharedTransport:
+    """进程级共享连接池：所有 YuketangHeartbeat 实例的 Session 挂载同一个 HTTPAdapter，
+    复用到 changjiang.yuketang.cn 的 TCP/TLS 连接；cookies 和 headers 仍由各自的 Session 保存"""
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, pool_size=10, pool_connections=4, pool_block=False):
+        self.pool_size = pool_size
+        self.stats_lock = threading.Lock()
+        self.request_count = 0
+        self.new_connection_count = 0
+        self.adapter = self._create_adapter(pool_connections, pool_size, pool_block)
+        # 不带cookies的共享Session，用于访问CDN（视频时长探测等）
+        self.probe_session = self.new_session()
+
+    def _create_adapter(self, pool_connections, pool_size, pool_block):
+        transport = self
+
+        def counting_pool(base):
+            class CountingPool(base):
+                def _new_conn(self):
+                    with transport.stats_lock:
+                        transport.new_connection_count += 1
+                    return super()._new_conn()
+            return CountingPool
+
+        pool_classes = {
+            'http': counting_pool(HTTPConnectionPool),
+            'https': counting_pool(HTTPSConnectionPool),
+        }
+
+        class CountingAdapter(HTTPAdapter):
+            def init_poolmanager(self, *args, **kwargs):
+                super().init_poolmanager(*args, **kwargs)
+                self.poolmanager.pool_classes_by_scheme = pool_classes
+
+            def send(self, request, **kwargs):
+                with transport.stats_lock:
+                    transport.request_count += 1
+                return super().send(request, **kwargs)
+
+        return CountingAdapter(pool_connections=pool_connections, pool_maxsize=pool_size, pool_block=pool_block)
+
+    @classmethod
+    def get_default(cls):
+        """返回进程级默认连接池，池大小由 HTTP_POOL_SIZE 配置"""
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls(pool_size=int(os.getenv('HTTP_POOL_SIZE', 10)))
+            return cls._default
+
+    def mount(self, session):
+        session.mount('https://', self.adapter)
+        session.mount('http://', self.adapter)
+        return session
+
+    def new_session(self):
+        return self.mount(requests.Session())
+
+    def stats(self):
+        """连接复用统计：请求数、新建连接数（TCP/TLS握手）、复用连接的请求数"""
+        with self.stats_lock:
+            return {
+                'requests': self.request_count,
+                'new_connections': self.new_connection_count,
+                'reused_connections': max(0, self.request_count - self.new_connection_count),
+            }
+
+
+class RequestMetrics:
+    """按接口统计请求：请求数、状态码、错误、重试、收发字节数和延迟直方图，线程安全
+
+    可导出为 Prometheus 文本格式或 JSON 快照，也可以启动一个HTTP端点在运行中实时查看。
+    """
+
+    # 延迟直方图的桶上限（秒），与 Prometheus 默认桶一致
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # endpoint -> 统计数据
+        self.endpoints = {}
+        self.http_server = None
+
+    @classmethod
+    def get_default(cls):
+        """返回进程级默认统计对象"""
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def _endpoint(self, endpoint):
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = {
+                'requests': 0,
+                'status': {},
+                'errors': {},
+                'retries': 0,
+                'bytes_in': 0,
+                'bytes_out': 0,
+                'latency_sum': 0.0,
+                'latency_max': 0.0,
+                'buckets': [0] * (len(self.LATENCY_BUCKETS) + 1),
+            }
+            self.endpoints[endpoint] = stats
+        return stats
+
+    def observe(self, endpoint, status, latency, bytes_in=0, bytes_out=0):
+        """记录一次完成的请求；status 为HTTP状态码，请求异常时为异常类型名"""
+        index = len(self.LATENCY_BUCKETS)
+        for i, bound in enumerate(self.LATENCY_BUCKETS):
+            if latency <= bound:
+                index = i
+                break
+        with self.lock:
+            stats = self._endpoint(endpoint)
+            stats['requests'] += 1
+            if isinstance(status, int):
+                stats['status'][status] = stats['status'].get(status, 0) + 1
+            else:
+                stats['errors'][status] = stats['errors'].get(status, 0) + 1
+            stats['bytes_in'] += bytes_in
+            stats['bytes_out'] += bytes_out
+            stats['latency_sum'] += latency
+            stats['latency_max'] = max(stats['latency_max'], latency)
+            stats['buckets'][index] += 1
+
+    def record_retry(self, endpoint):
+        with self.lock:
+            self._endpoint(endpoint)['retries'] += 1
+
+    def snapshot(self):
+        """JSON 快照：{'uptime', 'endpoints': {endpoint: {...}}}，延迟桶为累计计数"""
+        with self.lock:
+            endpoints = {}
+            for endpoint, stats in sorted(self.endpoints.items()):
+                cumulative = list(itertools.accumulate(stats['buckets']))
+                buckets = {str(bound): count for bound, count in zip(self.LATENCY_BUCKETS, cumulative)}
+                buckets['+Inf'] = cumulative[-1]
+                endpoints[endpoint] = {
+                    'requests': stats['requests'],
+                    'status': {str(code): count for code, count in sorted(stats['status'].items())},
+                    'errors': dict(stats['errors']),
+                    'retries': stats['retries'],
+                    'bytes_in': stats['bytes_in'],
+                    'bytes_out': stats['bytes_out'],
+                    'latency': {
+                        'count': stats['requests'],
+                        'sum': stats['latency_sum'],
+                        'mean': stats['latency_sum'] / stats['requests'] if stats['requests'] else 0.0,
+                        'max': stats['latency_max'],
+                        'buckets': buckets,
+                    },
+                }
+            return {'uptime': time.time() - self.started, 'endpoints': endpoints}
+
+    def to_prometheus(self):
+        """导出为 Prometheus 文本格式"""
+        snapshot = self.snapshot()
+        lines = [
+            '# HELP yuketang_requests_total Requests by endpoint and HTTP status.',
+            '# TYPE yuketang_requests_total counter',
+        ]
+        for endpoint, stats in snapshot['endpoints'].items():
+            for code, count in stats['status'].items():
+                lines.append(f'yuketang_requests_total{{endpoint="{endpoint}",status="{code}"}} {count}')
+        lines += ['# HELP yuketang_request_errors_total Requests that raised before a response.',
+                  '# TYPE yuketang_request_errors_total counter']
+        for endpoint, stats in snapshot['endpoints'].items():
+            for error, count in stats['errors'].items():
+                lines.append(f'yuketang_request_errors_total{{endpoint="{endpoint}",error="{error}"}} {count}')
+        for name, key, help_text in (
+            ('yuketang_request_retries_total', 'retries', 'Retried requests.'),
+            ('yuketang_request_bytes_in_total', 'bytes_in', 'Response bytes received.'),
+            ('yuketang_request_bytes_out_total', 'bytes_out', 'Request bytes sent.'),
+        ):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            for endpoint, stats in snapshot['endpoints'].items():
+                lines.append(f'{name}{{endpoint="{endpoint}"}} {stats[key]}')
+        lines += ['# HELP yuketang_request_duration_seconds Request latency.',
+                  '# TYPE yuketang_request_duration_seconds histogram']
+        for endpoint, stats in snapshot['endpoints'].items():
+            latency = stats['latency']
+            for bound, count in latency['buckets'].items():
+                lines.append(f'yuketang_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+            lines.append(f'yuketang_request_duration_seconds_sum{{endpoint="{endpoint}"}} {latency["sum"]:.6f}')
+            lines.append(f'yuketang_request_duration_seconds_count{{endpoint="{endpoint}"}} {latency["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """写入文件：.json 后缀写 JSON 快照，其余写 Prometheus 文本格式"""
+        if path.endswith('.json'):
+            content = json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+        else:
+            content = self.to_prometheus()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def start_http_server(self, port, host='127.0.0.1'):
+        """在后台线程提供 /metrics（Prometheus）和 /metrics.json"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics.json':
+                    body = json.dumps(metrics.snapshot(), ensure_ascii=False).encode('utf-8')
+                    content_type = 'application/json'
+                elif self.path == '/metrics':
+                    body = metrics.to_prometheus().encode('utf-8')
+                    content_type = 'text/plain; version=0.0.4'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.http_server = ThreadingHTTPServer((host, port), Handler)
+        self.http_server.daemon_threads = True
+        threading.Thread(target=self.http_server.serve_forever, name='metrics-http', daemon=True).start()
+        return self.http_server
+
+    def stop_http_server(self):
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
+
+    def summary_lines(self):
+        """每个接口一行的文字摘要，用于运行结束时打印"""
+        lines = []
+        for endpoint, stats in self.snapshot()['endpoints'].items():
+            latency = stats['latency']
+            failed = sum(count for code, count in stats['status'].items() if not code.startswith('2')
+                         and code != '304') + sum(stats['errors'].values())
+            lines.append(f"  {endpoint}: 请求 {stats['requests']} 次, 失败 {failed} 次, 重试 {stats['retries']} 次, "
+                         f"平均 {latency['mean'] * 1000:.1f}ms, 最大 {latency['max'] * 1000:.1f}ms, "
+                         f"接收 {stats['bytes_in']} 字节")
+        return lines
+
+
+class CircuitOpenError(Exception):
+    """接口处于熔断状态，请求未发送直接失败"""
+
+    def __init__(self, endpoint, retry_in):
+        super().__init__(f"接口 {endpoint} 熔断中，{retry_in:.0f}秒后重试")
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+class RetryPolicy:
+    """共享的重试策略与按接口的熔断器，线程安全
+
+    可重试的失败（网络异常、429、5xx）按指数退避加全抖动重试；每个接口的重试总数不超过
+    min_budget + budget_ratio * 请求数，避免故障期间重试放大请求量。
+    同一接口连续失败 failure_threshold 次后熔断 reset_timeout 秒，期间请求直接失败，
+    到期后只放行一个探测请求，成功则恢复。
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=8.0, budget_ratio=0.2, min_budget=10,
+                 failure_threshold=5, reset_timeout=30.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.min_budget = min_budget
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        # endpoint -> {'requests', 'retries', 'failures', 'open_until', 'probing'}
+        self.endpoints = {}
+
+    @classmethod
+    def get_default(cls):
+        """返回进程级默认策略，参数由 RETRY_* 和 CIRCUIT_* 环境变量配置"""
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls(
+                    max_attempts=int(os.getenv('RETRY_MAX_ATTEMPTS', 3)),
+                    base_delay=float(os.getenv('RETRY_BASE_DELAY', 0.5)),
+                    max_delay=float(os.getenv('RETRY_MAX_DELAY', 8)),
+                    failure_threshold=int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5)),
+                    reset_timeout=float(os.getenv('CIRCUIT_RESET_SECONDS', 30)),
+                )
+            return cls._default
+
+    def _state(self, endpoint):
+        state = self.endpoints.get(endpoint)
+        if state is None:
+            state = {'requests': 0, 'retries': 0, 'failures': 0, 'open_until': 0.0, 'probing': False}
+            self.endpoints[endpoint] = state
+        return state
+
+    def before_request(self, endpoint):
+        """发送前检查熔断器，熔断中抛出 CircuitOpenError
+
+        返回本次请求是否为半开状态下的探测请求；为 True 时调用方须在请求结束后
+        （无论以何种方式退出）调用 end_probe，否则熔断器会一直拒绝请求。
+        """
+        with self.lock:
+            state = self._state(endpoint)
+            probe = False
+            if state['failures'] >= self.failure_threshold:
+                now = time.monotonic()
+                if now < state['open_until'] or state['probing']:
+                    raise CircuitOpenError(endpoint, max(0.0, state['open_until'] - now))
+                # 熔断到期（半开）：只放行这一个探测请求
+                state['probing'] = True
+                probe = True
+            state['requests'] += 1
+            return probe
+
+    def end_probe(self, endpoint):
+        """探测请求结束，允许下一次探测"""
+        with self.lock:
+            self._state(endpoint)['probing'] = False
+
+    def is_retryable(self, response=None, error=None):
+        if error is not None:
+            return isinstance(error, requests.RequestException) or (httpx is not None and isinstance(error, httpx.HTTPError))
+        return response.status_code in self.RETRY_STATUSES
+
+    def next_delay(self, endpoint, attempt, response=None, error=None):
+        """记录第 attempt 次（从0开始）请求的结果；需要重试时返回等待秒数，否则返回None"""
+        retryable = self.is_retryable(response, error)
+        with self.lock:
+            state = self._state(endpoint)
+            if not retryable:
+                state['failures'] = 0
+                return None
+
+            state['failures'] += 1
+            if state['failures'] >= self.failure_threshold:
+                state['open_until'] = time.monotonic() + self.reset_timeout
+                if state['failures'] == self.failure_threshold:
+                    logger.warning("接口 %s 连续失败 %s 次，熔断 %s 秒", endpoint, state['failures'], self.reset_timeout)
+                return None
+            if attempt + 1 >= self.max_attempts:
+                return None
+            if state['retries'] >= self.min_budget + self.budget_ratio * state['requests']:
+                return None
+            state['retries'] += 1
+            # 占用一次请求计数，重试同样受熔断器约束
+            state['requests'] += 1
+
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(float(retry_after), self.max_delay))
+        return delay
+
+
+class TokenBucket:
+    """令牌桶限速器：平均每秒 rate 个请求，允许突发 burst 个，线程安全"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        """尝试取一个令牌：成功返回0，否则返回还需等待的秒数"""
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """取一个令牌，不足时阻塞等待，返回等待的秒数"""
+        waited = 0.0
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+
+class RateLimiter:
+    """全局请求限速：按接口类别（metadata、heartbeat、progress、article）各用一个令牌桶，
+    另有可选的总速率上限；所有观看会话和 asyncio 引擎共享，提高并发数不会超过配置的速率"""
+
+    ENDPOINT_CLASSES = {
+        'heartbeat': 'heartbeat',
+        'progress': 'progress',
+        'progress_batch': 'progress',
+        'article_status': 'article_status',
+        'article_finish': 'article',
+    }
+    # 未列出的接口（课程章节、leaf信息、拖拽权限、水印、播放地址等）都算 metadata
+    DEFAULT_CLASS = 'metadata'
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, rates=None, total_rate=0):
+        """rates: {类别: 每秒请求数}，不设置或为0的类别不限速；total_rate 为所有请求的总上限"""
+        self.buckets = {name: TokenBucket(rate) for name, rate in (rates or {}).items() if rate and rate > 0}
+        self.total = TokenBucket(total_rate) if total_rate and total_rate > 0 else None
+
+    @staticmethod
+    def session_rates(max_sessions, heartbeat_interval):
+        """按同时观看的会话数估算心跳和进度查询接口需要的速率（次/秒）
+
+        每个会话每个心跳周期最多发一次心跳请求，最多每 PROGRESS_POLL_MIN_SECONDS 秒查一次进度；
+        留出一倍余量给启动阶段的突发和重试，且不低于原来的固定默认值（20、5）。
+        """
+        interval = max(heartbeat_interval, 1)
+        return {
+            'heartbeat': max(20.0, math.ceil(2 * max_sessions / interval)),
+            'progress': max(5.0, math.ceil(2 * max_sessions / PROGRESS_POLL_MIN_SECONDS)),
+        }
+
+    @classmethod
+    def get_default(cls, max_sessions=0, heartbeat_interval=5):
+        """返回进程级默认限速器，速率由 RATE_LIMIT_* 环境变量配置
+
+        未设置 RATE_LIMIT_HEARTBEAT/RATE_LIMIT_PROGRESS 时按 max_sessions 个并发会话估算（见 session_rates），
+        提高并发数时限速器不会成为瓶颈；只在第一次调用时生效。
+        """
+        with cls._default_lock:
+            if cls._default is None:
+                session_rates = cls.session_rates(max_sessions, heartbeat_interval)
+                cls._default = cls(
+                    rates={
+                        'metadata': float(os.getenv('RATE_LIMIT_METADATA', 10)),
+                        'heartbeat': float(os.getenv('RATE_LIMIT_HEARTBEAT') or session_rates['heartbeat']),
+                        'progress': float(os.getenv('RATE_LIMIT_PROGRESS') or session_rates['progress']),
+                        # RICHTEXT_MAX_RPS 为旧名称，未设置 RATE_LIMIT_ARTICLE 时使用
+                        'article': float(os.getenv('RATE_LIMIT_ARTICLE') or os.getenv('RICHTEXT_MAX_RPS') or 2),
+                        'article_status': float(os.getenv('RATE_LIMIT_ARTICLE_STATUS', 20)),
+                    },
+                    total_rate=float(os.getenv('RATE_LIMIT_TOTAL', 0)),
+                )
+            return cls._default
+
+    def rate(self, endpoint_class):
+        """该类别的速率上限（次/秒），不限速时返回None"""
+        bucket = self.buckets.get(endpoint_class)
+        return bucket.rate if bucket is not None else None
+
+    def _buckets_for(self, endpoint):
+        bucket = self.buckets.get(self.ENDPOINT_CLASSES.get(endpoint, self.DEFAULT_CLASS))
+        return [b for b in (bucket, self.total) if b is not None]
+
+    def acquire(self, endpoint):
+        """阻塞直到该接口的类别令牌和总令牌都可用，返回等待的秒数"""
+        return sum(bucket.acquire() for bucket in self._buckets_for(endpoint))
+
+    async def acquire_async(self, endpoint):
+        """协程版本的 acquire，等待时不阻塞事件循环"""
+        waited = 0.0
+        for bucket in self._buckets_for(endpoint):
+            while True:
+                delay = bucket.try_acquire()
+                if not delay:
+                    break
+                await asyncio.sleep(delay)
+                waited += delay
+        return waited
+
+
+def _classroom_cookie_overrides(cookies, classroom_id):
+    """返回该课堂请求需要改写的 cookies；账号cookies不带课堂或已是该课堂时返回None"""
+    if classroom_id is None:
+        return None
+    value = str(classroom_id)
+    overrides = {name: value for name in CLASSROOM_COOKIES if name in cookies and cookies.get(name) != value}
+    return overrides or None
+
+
+def _json_dumps(obj):
+    """紧凑JSON编码，安装了 orjson 时使用 orjson"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, separators=(',', ':'))
+
+
+class HeartbeatEncoder:
+    """单个视频会话的心跳编码器
+
+    会话内不变的字段（用户、课程、视频、时长等）只序列化一次，每个心跳只填入
+    et/cp/fp/tp/sp/ts/sq，直接产出JSON片段，发送时再拼接成请求体。
+    """
+
+    __slots__ = ('_static', '_event_types')
+
+    def __init__(self, video_session):
+        static = {
+            "i": 5,  # 固定值
+            "p": "web",  # 平台
+            "n": "ali-cdn.xuetangx.com",  # CDN
+            "lob": "ykt",  # 固定值
+            "u": video_session.user_id,
+            "uip": "",  # 用户IP（可为空）
+            "c": video_session.course_id,
+            "v": video_session.video_id,
+            "skuid": video_session.sku_id,
+            "classroomid": str(video_session.classroom_id),
+            "cc": video_session.cc_id,
+            "d": video_session.duration,
+            "pg": f"{video_session.video_id}_q8mn",  # 页面标识
+            "t": "video",  # 类型
+            "cards_id": 0,
+            "slide": 0,
+            "v_url": ""
+        }
+        # 去掉开头的 '{'，作为每个事件片段的后半部分
+        self._static = _json_dumps(static)[1:]
+        self._event_types = {}
+
+    def encode(self, event_type, current_position, first_position, true_position, speed, timestamp, sequence):
+        """返回单个心跳事件的JSON片段；位置和速度为 int/float，timestamp 为数字字符串"""
+        et = self._event_types.get(event_type)
+        if et is None:
+            et = self._event_types[event_type] = _json_dumps(event_type)
+        # int/float 的 repr 与 JSON 数字表示一致
+        return (f'{{"et":{et},"cp":{current_position!r},"fp":{first_position!r},'
+                f'"tp":{true_position!r},"sp":{speed!r},"ts":"{timestamp}","sq":{sequence},'
+                f'{self._static}')
+
+
+class VideoSession:
+    """单个视频的观看会话：视频相关的ID、时长、心跳序列号和请求头
+
+    创建后不再修改（序列号除外），会话之间不共享可变状态，
+    同一个 YuketangHeartbeat 可以同时驱动任意多个会话。
+    """
+
+    __slots__ = ('user_id', 'course_id', 'video_id', 'sku_id', 'classroom_id', 'cc_id', 'duration',
+                 'csrf_token', 'university_id', 'uv_id', 'headers', 'encoder', '_sequence')
+
+    def __init__(self, user_id, course_id, video_id, sku_id, classroom_id, cc_id, duration,
+                 csrf_token, university_id, uv_id, headers):
+        self.user_id = user_id
+        self.course_id = course_id
+        self.video_id = video_id
+        self.sku_id = sku_id
+        self.classroom_id = classroom_id
+        self.cc_id = cc_id
+        self.duration = duration
+        self.csrf_token = csrf_token
+        self.university_id = university_id
+        self.uv_id = uv_id
+        # 心跳和进度请求使用的完整请求头，只读，同一视频的会话之间可以共用
+        self.headers = headers
+        self.encoder = HeartbeatEncoder(self)
+        self._sequence = itertools.count(1)
+
+    def next_sequence(self):
+        # itertools.count 的 next() 在 GIL 下是原子操作，无需额外加锁
+        return next(self._sequence)
+
+    def clone(self):
+        """同一视频的新会话（序列号重新计数）"""
+        return VideoSession(self.user_id, self.course_id, self.video_id, self.sku_id, self.classroom_id,
+                            self.cc_id, self.duration, self.csrf_token, self.university_id, self.uv_id,
+                            self.headers)
+
+
+class HeartbeatBuffer:
+    """单个观看会话的心跳缓冲：同一时刻产生的事件合并为一次请求
+
+    缓冲数达到 batch_size，或最早的事件已等待 flush_interval 秒时到期；
+    flush_interval 为0时每个心跳周期都会发送。
+    """
+
+    def __init__(self, batch_size=10, flush_interval=0.0):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.events = []
+        self.first_added = None
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, heart_data):
+        if not self.events:
+            self.first_added = time.monotonic()
+        self.events.append(heart_data)
+
+    def due(self):
+        if not self.events:
+            return False
+        return (len(self.events) >= self.batch_size
+                or time.monotonic() - self.first_added >= self.flush_interval)
+
+    def drain(self):
+        """取出最多 batch_size 个事件"""
+        batch, self.events = self.events[:self.batch_size], self.events[self.batch_size:]
+        self.first_added = time.monotonic() if self.events else None
+        return batch
+
+
+class CancellationToken:
+    """协作式取消标记：观看流程、各种等待和请求重试都会检查它
+
+    cancel() 之后 wait()/wait_async() 立即返回，并依次调用注册的回调
+    （例如唤醒在中央调度器中等待的会话）。
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.reason = None
+        # 可重入：信号处理等场景下同一线程可能再次进入
+        self.lock = threading.RLock()
+        self.callbacks = []
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self, reason='已取消'):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.reason = reason
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.debug("取消回调执行失败: %s", e)
+
+    def add_callback(self, callback):
+        """注册取消时调用的回调；已经取消时立即调用"""
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def wait(self, timeout):
+        """等待 timeout 秒，期间被取消时提前返回，返回值为是否已取消"""
+        return self.event.wait(timeout)
+
+    async def wait_async(self, timeout):
+        """协程版本的 wait"""
+        if self.cancelled:
+            return True
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            if not future.done():
+                future.set_result(None)
+
+        def notify():
+            loop.call_soon_threadsafe(wake)
+
+        self.add_callback(notify)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.remove_callback(notify)
+        return self.cancelled
+
+
+class ScheduledSession:
+    """调度器中的一个观看会话，保存下一次心跳的绝对到期时间"""
+
+    def __init__(self, interval, next_due):
+        self.interval = interval
+        self.next_due = next_due
+        self.active = True
+        self.event = threading.Event()
+        # asyncio 会话到期时的回调（由 wait_async 设置）
+        self.notify = None
+
+    def fire(self):
+        if self.notify is not None:
+            notify, self.notify = self.notify, None
+            notify()
+        else:
+            self.event.set()
+
+
+class HeartbeatScheduler:
+    """中央心跳调度器：用一个最小堆保存所有活动会话的下一次到期时间，
+    由单个调度线程按绝对截止时间唤醒会话，并记录每次唤醒的延迟"""
+
+    def __init__(self, max_samples=10000):
+        self.heap = []
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.thread = None
+        self.tick_count = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+        self.lateness_samples = deque(maxlen=max_samples)
+
+    def _ensure_thread(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='heartbeat-scheduler', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        with self.condition:
+            while True:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                due, _, session = self.heap[0]
+                now = time.monotonic()
+                if due > now:
+                    self.condition.wait(due - now)
+                    continue
+                heapq.heappop(self.heap)
+                if session.active:
+                    session.fire()
+
+    def register(self, interval):
+        """注册一个会话，第一次心跳在 interval 秒后到期"""
+        return ScheduledSession(interval, time.monotonic() + interval)
+
+    def unregister(self, session):
+        session.active = False
+
+    def _schedule(self, session):
+        with self.condition:
+            self._ensure_thread()
+            heapq.heappush(self.heap, (session.next_due, next(self.counter), session))
+            self.condition.notify()
+
+    def _advance(self, session):
+        """记录本次唤醒的延迟，并按绝对时间计算下一次到期时间"""
+        now = time.monotonic()
+        lateness = max(0.0, now - session.next_due)
+        with self.condition:
+            self.tick_count += 1
+            self.total_lateness += lateness
+            self.max_lateness = max(self.max_lateness, lateness)
+            self.lateness_samples.append(lateness)
+
+        session.next_due += session.interval
+        # 落后超过一个间隔时不再补发，从当前时间重新对齐
+        if session.next_due < now:
+            session.next_due = now + session.interval
+        return lateness
+
+    def wait(self, session):
+        """阻塞当前线程直到会话下一次到期，返回延迟秒数"""
+        session.event.clear()
+        self._schedule(session)
+        session.event.wait()
+        return self._advance(session)
+
+    async def wait_async(self, session):
+        """协程版本的 wait，到期时由调度线程唤醒事件循环"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            if not future.done():
+                future.set_result(None)
+
+        session.notify = lambda: loop.call_soon_threadsafe(wake)
+        self._schedule(session)
+        await future
+        return self._advance(session)
+
+    def stats(self):
+        """心跳延迟统计（秒）：次数、平均、P95、最大"""
+        with self.condition:
+            samples = sorted(self.lateness_samples)
+            p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))] if samples else 0.0
+            return {
+                'ticks': self.tick_count,
+                'mean_lateness': self.total_lateness / self.tick_count if self.tick_count else 0.0,
+                'p95_lateness': p95,
+                'max_lateness': self.max_lateness,
+            }
+
+
+class MetadataResolver:
+    """leaf 元数据解析器
+
+    按课堂记住哪种获取方式成功过，下次优先使用（没有记录时先试 leaf_info）；
+    首选方式失败时，并发请求其余的API方式，取最先成功的结果，课程结构仅作为最后的备用。
+    """
+
+    # 按优先级排列；course_structure 只能得到简化信息
+    STRATEGIES = ('leaf_info', 'leafprogress', 'leaf', 'leaf_info_short', 'course_structure')
+    API_STRATEGIES = STRATEGIES[:-1]
+
+    def __init__(self, max_parallel=4):
+        self.max_parallel = max_parallel
+        self.lock = threading.Lock()
+        # classroom_id -> 最近成功的获取方式
+        self.preferred = {}
+        # (classroom_id, 方式) -> [成功次数, 失败次数]
+        self.outcomes = {}
+        self.executor = None
+
+    def _record(self, classroom_id, strategy, success):
+        key = str(classroom_id)
+        with self.lock:
+            counts = self.outcomes.setdefault((key, strategy), [0, 0])
+            counts[0 if success else 1] += 1
+            if success:
+                self.preferred[key] = strategy
+
+    def _attempt(self, client, strategy, classroom_id, leaf_id, sign):
+        try:
+            result = client.fetch_leaf_metadata(strategy, classroom_id, leaf_id, sign)
+        except Exception as e:
+            logger.warning("获取方式 %s 异常: %s", strategy, e)
+            result = None
+        success = bool(result and result.get('success'))
+        self._record(classroom_id, strategy, success)
+        return result if success else None
+
+    def _ordered(self, classroom_id, strategies):
+        """失败次数少的方式排在前面"""
+        key = str(classroom_id)
+        with self.lock:
+            return sorted(strategies, key=lambda s: self.outcomes.get((key, s), [0, 0])[1])
+
+    def resolve(self, client, classroom_id, leaf_id, sign=None):
+        """获取leaf信息，全部失败时返回None"""
+        with self.lock:
+            # 还没有成功记录时先试主接口 leaf_info
+            preferred = self.preferred.get(str(classroom_id), self.STRATEGIES[0])
+
+        result = self._attempt(client, preferred, classroom_id, leaf_id, sign)
+        if result:
+            return result
+        logger.warning("课堂 %s 的首选方式 %s 失败，并发尝试其他方式...", classroom_id, preferred)
+
+        remaining = self._ordered(classroom_id, [s for s in self.API_STRATEGIES if s != preferred])
+        if remaining:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=self.max_parallel,
+                                                       thread_name_prefix='metadata-resolver')
+            futures = [
+                self.executor.submit(self._attempt, client, strategy, classroom_id, leaf_id, sign)
+                for strategy in remaining
+            ]
+            # 取最先成功的结果，其余请求在后台结束，不再等待
+            for future in as_completed(futures):
+                result = future.result()
+                if result:
+                    return result
+
+        if preferred != 'course_structure':
+            logger.warning("API方法都失败，尝试从课程结构中获取信息...")
+            return self._attempt(client, 'course_structure', classroom_id, leaf_id, sign)
+        return None
+
+
+class MetadataCache:
+    """元数据磁盘缓存：按 (classroom_id, leaf_id) 保存 leaf_info、拖拽权限、水印配置和播放地址
+
+    修改只标记为待写入，距上次写盘超过 flush_interval 秒时才整体写一次文件，
+    退出前调用 flush() 写入剩余修改；flush_interval 为 0 时每次修改都立即写盘。
+    """
+
+    def __init__(self, path, ttl=86400, ttl_overrides=None, flush_interval=5.0):
+        self.path = path
+        self.ttl = ttl
+        # 个别类型单独设置有效期（例如播放地址带签名，过期更快）
+        self.ttl_overrides = ttl_overrides or {}
+        self.flush_interval = flush_interval
+        # 只保护内存字典，写文件时不持有，预取和解析线程不会被磁盘IO串行化
+        self.lock = threading.Lock()
+        # 保证同一时刻只有一个线程在写文件
+        self.write_lock = threading.Lock()
+        self.entries = {}
+        self.dirty = False
+        self.last_flush = time.monotonic()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except (OSError, ValueError) as e:
+            logger.warning("元数据缓存文件无法读取，已忽略: %s", e)
+            self.entries = {}
+
+    def _save(self, payload):
+        # 先写临时文件再替换，避免进程中断时留下半个文件
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+        os.replace(tmp_path, self.path)
+
+    def _mark_dirty(self):
+        """调用方须持有 self.lock；返回是否到了写盘时间"""
+        self.dirty = True
+        return time.monotonic() - self.last_flush >= self.flush_interval
+
+    def flush(self):
+        """把尚未写盘的修改写入文件，没有修改时不做任何事"""
+        with self.write_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                payload = json.dumps(self.entries, ensure_ascii=False)
+                self.dirty = False
+                self.last_flush = time.monotonic()
+            try:
+                self._save(payload)
+            except OSError as e:
+                logger.warning("元数据缓存写入失败: %s", e)
+                with self.lock:
+                    self.dirty = True
+
+    @staticmethod
+    def _key(classroom_id, leaf_id):
+        return f"{classroom_id}:{leaf_id}"
+
+    def get(self, classroom_id, leaf_id, kind):
+        """返回缓存条目 {'data', 'fetched_at', 'etag', 'last_modified'}，不存在时返回None"""
+        with self.lock:
+            return self.entries.get(self._key(classroom_id, leaf_id), {}).get(kind)
+
+    def is_fresh(self, entry, kind):
+        ttl = self.ttl_overrides.get(kind, self.ttl)
+        return time.time() - entry.get('fetched_at', 0) < ttl
+
+    def put(self, classroom_id, leaf_id, kind, data, etag=None, last_modified=None):
+        with self.lock:
+            self.entries.setdefault(self._key(classroom_id, leaf_id), {})[kind] = {
+                'data': data,
+                'fetched_at': time.time(),
+                'etag': etag,
+                'last_modified': last_modified,
+            }
+            due = self._mark_dirty()
+        if due:
+            self.flush()
+
+    def touch(self, classroom_id, leaf_id, kind):
+        """服务器返回304时刷新条目的获取时间"""
+        with self.lock:
+            entry = self.entries.get(self._key(classroom_id, leaf_id), {}).get(kind)
+            if entry is None:
+                return
+            entry['fetched_at'] = time.time()
+            due = self._mark_dirty()
+        if due:
+            self.flush()
+
+
+class DurationCache:
+    """视频时长持久化缓存：按 ccid 保存探测结果，备用键为去掉查询参数的播放地址路径"""
+
+    def __init__(self, path):
+        self.path = path
+        # 只保护内存字典和文件写入，不在网络请求期间持有
+        self.lock = threading.Lock()
+        # 每个视频一把锁，避免多个worker同时探测同一个视频
+        self.key_locks = {}
+        self.entries = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning("时长缓存文件无法读取，已忽略: %s", e)
+
+    @staticmethod
+    def _keys(cc_id, url):
+        keys = []
+        if cc_id:
+            keys.append(f"cc:{cc_id}")
+        if url:
+            parsed = urlsplit(url)
+            keys.append(f"url:{parsed.netloc}{parsed.path}")
+        return keys
+
+    def get(self, cc_id=None, url=None):
+        """返回缓存的时长（秒），未命中返回None"""
+        with self.lock:
+            for key in self._keys(cc_id, url):
+                entry = self.entries.get(key)
+                if entry:
+                    return entry['duration']
+        return None
+
+    def put(self, cc_id, url, duration):
+        entry = {'duration': duration, 'probed_at': time.time()}
+        with self.lock:
+            for key in self._keys(cc_id, url):
+                self.entries[key] = entry
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+    def get_or_probe(self, cc_id, url, probe=getVideoDuration):
+        """命中缓存直接返回，否则调用 probe(url) 探测并写入缓存"""
+        duration = self.get(cc_id, url)
+        if duration is not None:
             return duration
-            break
+
+        keys = self._keys(cc_id, url)
+        if not keys:
+            return None
+        with self.lock:
+            key_lock = self.key_locks.setdefault(keys[0], threading.Lock())
+
+        with key_lock:
+            # 等锁期间可能已被其他worker探测完成
+            duration = self.get(cc_id, url)
+            if duration is not None:
+                return duration
+            duration = probe(url) if url else None
+            if duration:
+                self.put(cc_id, url, duration)
+        return duration
+
+
+class RunJournal:
+    """可恢复的运行日志：按行追加 JSON（JSONL），记录每个 leaf 的状态变化
+
+    状态依次为 discovered、configured、watching（带最后位置）、finished 或 failed（带原因）。
+    启动时重放日志得到每个 leaf 的最新状态，并把日志压缩为每个 leaf 一行。
+    进程崩溃最多丢失最后一行未写完的记录，重放时会忽略。
+    """
+
+    IN_FLIGHT_STATES = ('configured', 'watching')
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # classroom_id -> {leaf_id -> 最新记录}
+        self.states = {}
+        # classroom_id -> 发现的视频列表
+        self.discoveries = {}
+        self._replay()
+        self._compact()
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def _apply(self, entry):
+        classroom_id = str(entry.get('classroom_id'))
+        event = entry.get('state')
+        if event == 'reset':
+            self.states.pop(classroom_id, None)
+            self.discoveries.pop(classroom_id, None)
+        elif event == 'rediscover':
+            self.discoveries.pop(classroom_id, None)
+        elif event == 'discovered' and 'videos' in entry:
+            self.discoveries[classroom_id] = entry['videos']
+        else:
+            self.states.setdefault(classroom_id, {})[str(entry.get('leaf_id'))] = entry
+
+    def _replay(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        # 崩溃时写了一半的行
+                        continue
+        except FileNotFoundError:
+            pass
+
+    def _compact(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for classroom_id, videos in self.discoveries.items():
+                f.write(json.dumps({'classroom_id': classroom_id, 'state': 'discovered', 'videos': videos},
+                                   ensure_ascii=False) + '\n')
+            for leaves in self.states.values():
+                for entry in leaves.values():
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        os.replace(tmp_path, self.path)
+
+    def _append(self, entry):
+        with self.lock:
+            self._apply(entry)
+            self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.file.flush()
+
+    def record(self, classroom_id, leaf_id, state, **fields):
+        """记录一个 leaf 的状态变化"""
+        entry = {'ts': time.time(), 'classroom_id': str(classroom_id), 'leaf_id': str(leaf_id), 'state': state}
+        entry.update(fields)
+        self._append(entry)
+
+    def record_discovery(self, classroom_id, videos):
+        self._append({'ts': time.time(), 'classroom_id': str(classroom_id), 'state': 'discovered', 'videos': videos})
+
+    def reset(self, classroom_id):
+        """课堂全部处理完后清除其记录，下次运行重新发现课程"""
+        self._append({'ts': time.time(), 'classroom_id': str(classroom_id), 'state': 'reset'})
+
+    def forget_discovery(self, classroom_id):
+        """只清除课堂的发现结果、保留每个 leaf 的状态：下次运行重新发现课程（包括新增的视频），
+        已完成的视频仍按日志跳过"""
+        self._append({'ts': time.time(), 'classroom_id': str(classroom_id), 'state': 'rediscover'})
+
+    def discovered_videos(self, classroom_id):
+        with self.lock:
+            return self.discoveries.get(str(classroom_id))
+
+    def leaf_states(self, classroom_id):
+        """返回 {leaf_id字符串: 最新记录}"""
+        with self.lock:
+            return dict(self.states.get(str(classroom_id), {}))
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class _CachedResponse:
+    """命中元数据缓存时代替 requests.Response 返回给调用方"""
+
+    status_code = 200
+
+    def __init__(self, data):
+        self._data = data
+        self.headers = {}
+
+    def json(self):
+        return self._data
+
+    @property
+    def text(self):
+        return json.dumps(self._data, ensure_ascii=False)
+
+
+class CourseIndex:
+    """课程章节结构索引：一次获取 course/chapter，单次遍历建立 O(1) 查找表"""
+
+    def __init__(self, chapters_data):
+        self.raw = chapters_data
+        self.chapters = []
+        # leaf_id -> {'leaf', 'section', 'chapter_name'}，section 层级和子 leaf 都在其中
+        self.by_leaf_id = {}
+        # section_id -> {'section', 'chapter_name', 'leaf_list'}
+        self.by_section_id = {}
+        # leaf_type -> [entry, ...]，按课程顺序排列
+        self.by_leaf_type = {}
+        self.sections = []
+
+        chapters = (chapters_data or {}).get('data', {}).get('course_chapter', []) or []
+        for chapter in chapters:
+            chapter_name = chapter.get('name', '未知章节')
+            self.chapters.append(chapter)
+
+            for section in chapter.get('section_leaf_list', []) or []:
+                leaf_list = section.get('leaf_list', []) or []
+                section_entry = {
+                    'section': section,
+                    'chapter_name': chapter_name,
+                    'leaf_list': leaf_list,
+                }
+                self.sections.append(section_entry)
+                if section.get('id') is not None:
+                    self.by_section_id[section.get('id')] = section_entry
+                self._add_leaf(section, None, chapter_name)
+
+                for actual_leaf in leaf_list:
+                    self._add_leaf(actual_leaf, section, chapter_name)
+
+    def _add_leaf(self, leaf, section, chapter_name):
+        entry = {'leaf': leaf, 'section': section, 'chapter_name': chapter_name}
+        leaf_id = leaf.get('id')
+        # section 层级的记录优先，子 leaf 不覆盖同 ID 的 section
+        if leaf_id is not None and (leaf_id not in self.by_leaf_id or section is None):
+            self.by_leaf_id[leaf_id] = entry
+        self.by_leaf_type.setdefault(leaf.get('leaf_type'), []).append(entry)
+
+    def get_leaf(self, leaf_id):
+        """按 leaf ID 查找，返回 {'leaf', 'section', 'chapter_name'} 或 None"""
+        return self.by_leaf_id.get(leaf_id)
+
+    def get_section(self, section_id):
+        """按 section ID 查找，返回 {'section', 'chapter_name', 'leaf_list'} 或 None"""
+        return self.by_section_id.get(section_id)
+
+    def leaves_of_type(self, leaf_type):
+        """返回指定 leaf_type 的所有节点（含 section 层级与子 leaf）"""
+        return self.by_leaf_type.get(leaf_type, [])
 
 
 class YuketangHeartbeat:
-    def __init__(self, cookies=None):
-        self.session = requests.Session()
-        self.base_url = "https://changjiang.yuketang.cn"
+    def __init__(self, cookies=None, metadata_cache=None, duration_cache=None, transport=None, scheduler=None,
+                 resolver=None, journal=None, base_url=None, metrics=None, retry_policy=None, rate_limiter=None,
+                 heartbeat_batch_size=10, heartbeat_flush_interval=0.0, cancel_token=None):
+        # 所有实例共享同一个连接池，Session 只负责各自的cookies
+        self.transport = transport or SharedTransport.get_default()
+        self.session = self.transport.new_session()
+        # 按接口的请求统计，所有实例共享
+        self.metrics = metrics or RequestMetrics.get_default()
+        # 重试与熔断策略，所有实例共享同一组接口状态
+        self.retry_policy = retry_policy or RetryPolicy.get_default()
+        # 全局请求限速器，所有实例共享同一组令牌桶
+        self.rate_limiter = rate_limiter or RateLimiter.get_default()
+        # 心跳合并：每次请求最多携带的事件数，以及周期心跳最多缓冲的秒数（0 表示每个周期都发送）
+        self.heartbeat_batch_size = heartbeat_batch_size
+        self.heartbeat_flush_interval = heartbeat_flush_interval
+        # 取消标记：收到退出信号后所有会话发出暂停心跳、保存进度并尽快结束
+        self.cancel_token = cancel_token or CancellationToken()
+        self.base_url = (base_url or DEFAULT_BASE_URL).rstrip('/')
         self.heartbeat_url = f"{self.base_url}/video-log/heartbeat/"
         self.progress_url = f"{self.base_url}/video-log/get_video_watch_progress/"
 
@@ -46,7 +1545,7 @@ class YuketangHeartbeat:
             'Cache-Control': 'no-cache',
             'Connection': 'keep-alive',
             'Content-Type': 'application/json',
-            'Origin': 'https://changjiang.yuketang.cn',
+            'Origin': self.base_url,
             'Pragma': 'no-cache',
             'Sec-Fetch-Dest': 'empty',
             'Sec-Fetch-Mode': 'cors',
@@ -62,54 +1561,156 @@ class YuketangHeartbeat:
         # 设置cookies
         if cookies:
             self.session.cookies.update(cookies)
+        # 多课堂：classroomId 与账号cookies不同的课堂各用一个 Session（共享连接池），见 _session_for
+        self._classroom_sessions = {}
+        self._classroom_sessions_lock = threading.Lock()
+
+        # 账号级参数（获取课程章节等接口使用），视频相关的状态都在 VideoSession 中
+        self.csrf_token = None
+        self.university_id = None
+        self.uv_id = None
+        # auto_configure_from_ids 配置的当前会话，供单视频的便捷方法使用
+        self.video_session = None
+
+        # 课程结构索引缓存（按 classroom_id + sign），所有视频会话共享
+        self._course_indexes = {}
+        # 只保护上面的字典和每个课堂的锁表，不在网络请求期间持有
+        self._course_index_lock = threading.Lock()
+        # 每个课堂一把锁：同一课堂并发调用时只下载一次，不同课堂互不等待
+        self._course_index_key_locks = {}
+
+        # 进度预筛选：课堂 -> (course_id, user_id)，以及进度接口是否支持批量查询（None 表示未知）
+        self._progress_identities = {}
+        self._progress_batch_supported = None
+        # 预筛选查到的未完成视频进度：(课堂ID, leaf_id) -> 进度数据，准备阶段取出使用，不再重复查询
+        self._prefetched_progress = {}
+
+        # 元数据磁盘缓存（可选），所有视频会话共享
+        self.metadata_cache = metadata_cache
+        # 视频时长持久化缓存（可选），所有视频会话共享
+        self.duration_cache = duration_cache
+        # 中央心跳调度器（可选），未设置时每个会话自行sleep
+        self.scheduler = scheduler
+        # leaf元数据解析器，所有会话共享，按课堂记住可用的获取方式
+        self.resolver = resolver or MetadataResolver()
+        # 可恢复的运行日志（可选），所有视频会话共享
+        self.journal = journal
+
+    def set_account_params(self, csrf_token, university_id, uv_id=None):
+        """设置账号级参数（获取课程章节等接口需要）"""
+        self.csrf_token = csrf_token
+        self.university_id = university_id
+        self.uv_id = university_id if uv_id is None else uv_id
+
+    def new_video_session(self, user_id, course_id, video_id, sku_id, classroom_id,
+                          cc_id, duration, csrf_token, university_id, uv_id):
+        """创建视频观看会话，视频相关的请求头只写入会话自己的副本"""
+        headers = self.headers.copy()
+        headers.update({
+            'X-CSRFToken': csrf_token,
+            'classroom-id': str(classroom_id),
+            'university-id': str(university_id),
+            'uv-id': str(uv_id),
+            'Referer': f'{self.base_url}/v2/web/xcloud/video-student/{classroom_id}/{video_id}'
+        })
+        return VideoSession(user_id, course_id, video_id, sku_id, classroom_id, cc_id, duration,
+                            csrf_token, university_id, uv_id, headers)
 
-        # 视频参数
-        self.video_params = {}
-        self.sequence = 0
-        # 线程锁，确保sequence安全
-        self.sequence_lock = threading.Lock()
+    def set_video_params(self, user_id, course_id, video_id, sku_id, classroom_id,
+                        cc_id, duration, csrf_token, university_id, uv_id):
+        """设置视频播放参数（创建新的当前会话）"""
+        self.video_session = self.new_video_session(
+            user_id, course_id, video_id, sku_id, classroom_id, cc_id, duration, csrf_token, university_id, uv_id
+        )
+        return self.video_session
 
-    def create_worker_instance(self, cookies=None):
-        """创建一个独立的工作实例，用于并发处理"""
-        # 使用传入的cookies或复制当前实例的cookies
-        if cookies is None:
-            cookies = dict(self.session.cookies)
+    def _session_for(self, classroom_id):
+        """返回发送该课堂请求的 Session
 
-        # 创建新实例
-        worker = YuketangHeartbeat(cookies)
+        账号cookies中的 classroomId 就是该课堂（或未指定课堂）时使用主 Session；
+        否则使用该课堂专用的 Session，cookies 与主 Session 相同但课堂ID改为该课堂。
+        """
+        overrides = _classroom_cookie_overrides(self.session.cookies, classroom_id)
+        if overrides is None:
+            return self.session
+        key = str(classroom_id)
+        with self._classroom_sessions_lock:
+            session = self._classroom_sessions.get(key)
+            if session is None:
+                session = self.transport.new_session()
+                session.headers.update(self.session.headers)
+                session.cookies.update(self.session.cookies)
+                session.cookies.update(overrides)
+                self._classroom_sessions[key] = session
+            return session
+
+    def _request(self, endpoint, method, url, classroom_id=None, **kwargs):
+        """发送请求并按 endpoint 记录请求数、状态码、延迟和收发字节数
+
+        网络异常、429 和 5xx 按共享的重试策略退避重试，最后一次的响应照常返回、异常照常抛出；
+        接口熔断时直接抛出 CircuitOpenError。已取消时不再重试。
+        classroom_id 为请求所属课堂，决定请求携带的课堂 cookies。
+        """
+        session = self._session_for(classroom_id)
+        attempt = 0
+        while True:
+            try:
+                probe = self.retry_policy.before_request(endpoint)
+            except CircuitOpenError:
+                self.metrics.observe(endpoint, 'CircuitOpen', 0.0)
+                raise
+
+            try:
+                self.rate_limiter.acquire(endpoint)
+                response, error = None, None
+                start = time.perf_counter()
+                try:
+                    response = session.request(method, url, **kwargs)
+                except Exception as e:
+                    error = e
+                    self.metrics.observe(endpoint, type(e).__name__, time.perf_counter() - start)
+                else:
+                    body = response.request.body if response.request is not None else None
+                    self.metrics.observe(
+                        endpoint, response.status_code, time.perf_counter() - start,
+                        bytes_in=len(response.content or b''),
+                        bytes_out=len(body) if body else 0
+                    )
+
+                delay = self.retry_policy.next_delay(endpoint, attempt, response, error)
+            finally:
+                # 探测请求无论成功、失败还是被中断都要结束探测，熔断器才能继续放行
+                if probe:
+                    self.retry_policy.end_probe(endpoint)
+            if delay is not None and not self.cancel_token.cancelled:
+                self.metrics.record_retry(endpoint)
+                logger.debug("%s 请求失败（%s），%.2f秒后第%s次重试", endpoint,
+                             error if error is not None else response.status_code, delay, attempt + 1)
+                if not self.cancel_token.wait(delay):
+                    attempt += 1
+                    continue
 
-        # 复制基本配置
-        if hasattr(self, 'video_params'):
-            worker.video_params = copy.deepcopy(self.video_params)
+            if error is not None:
+                raise error
+            return response
 
-        return worker
+    def _journal(self, classroom_id, leaf_id, state, **fields):
+        """写入运行日志（未启用时忽略）"""
+        if self.journal is not None:
+            self.journal.record(classroom_id, leaf_id, state, **fields)
 
-    def set_video_params(self, user_id, course_id, video_id, sku_id, classroom_id,
-                        cc_id, duration, csrf_token, university_id, uv_id):
-        """设置视频播放参数"""
-        self.video_params = {
-            'user_id': user_id,
-            'course_id': course_id,
-            'video_id': video_id,
-            'sku_id': sku_id,
-            'classroom_id': classroom_id,
-            'cc_id': cc_id,
-            'duration': duration,
-            'csrf_token': csrf_token,
-            'university_id': university_id,
-            'uv_id': uv_id
-        }
+    def encode_heartbeat(self, video_session, event_type, current_position, first_position=None,
+                         true_position=None, speed=1.0):
+        """创建心跳数据并直接编码为JSON片段，字段与 create_heartbeat_data 相同"""
+        if first_position is None:
+            first_position = current_position
+        if true_position is None:
+            true_position = current_position
 
-        # 更新headers中的特定字段
-        self.headers.update({
-            'X-CSRFToken': csrf_token,
-            'classroom-id': str(classroom_id),
-            'university-id': str(university_id),
-            'uv-id': str(uv_id),
-            'Referer': f'https://changjiang.yuketang.cn/v2/web/xcloud/video-student/{classroom_id}/{video_id}'
-        })
+        return video_session.encoder.encode(event_type, current_position, first_position, true_position, speed,
+                                            str(int(time.time() * 1000)), video_session.next_sequence())
 
-    def create_heartbeat_data(self, event_type, current_position, first_position=None,
+    def create_heartbeat_data(self, video_session, event_type, current_position, first_position=None,
                              true_position=None, speed=1.0):
         """创建心跳数据"""
         timestamp = str(int(time.time() * 1000))
@@ -120,9 +1721,7 @@ class YuketangHeartbeat:
         if true_position is None:
             true_position = current_position
 
-        with self.sequence_lock:
-            self.sequence += 1
-            current_sequence = self.sequence
+        current_sequence = video_session.next_sequence()
 
         heart_data = {
             "i": 5,  # 固定值
@@ -135,15 +1734,15 @@ class YuketangHeartbeat:
             "tp": true_position,  # 真实播放位置
             "sp": speed,  # 播放速度
             "ts": timestamp,  # 时间戳
-            "u": self.video_params['user_id'],
+            "u": video_session.user_id,
             "uip": "",  # 用户IP（可为空）
-            "c": self.video_params['course_id'],
-            "v": self.video_params['video_id'],
-            "skuid": self.video_params['sku_id'],
-            "classroomid": str(self.video_params['classroom_id']),
-            "cc": self.video_params['cc_id'],
-            "d": self.video_params['duration'],
-            "pg": f"{self.video_params['video_id']}_q8mn",  # 页面标识
+            "c": video_session.course_id,
+            "v": video_session.video_id,
+            "skuid": video_session.sku_id,
+            "classroomid": str(video_session.classroom_id),
+            "cc": video_session.cc_id,
+            "d": video_session.duration,
+            "pg": f"{video_session.video_id}_q8mn",  # 页面标识
             "sq": current_sequence,  # 序列号
             "t": "video",  # 类型
             "cards_id": 0,
@@ -153,50 +1752,65 @@ class YuketangHeartbeat:
 
         return heart_data
 
-    def send_heartbeat(self, heart_data_list):
+    def build_heartbeat_request(self, video_session, heart_data_list):
+        """构造心跳请求，返回 (url, headers, body)
+
+        heart_data_list 中可以是 encode_heartbeat 产生的JSON片段，也可以是心跳数据字典。
+        """
+        fragments = [data if isinstance(data, str) else _json_dumps(data) for data in heart_data_list]
+        body = '{"heart_data":[' + ','.join(fragments) + ']}'
+        return self.heartbeat_url, video_session.headers, body.encode('utf-8')
+
+    def send_heartbeat(self, video_session, heart_data_list):
         """发送心跳数据"""
-        payload = {
-            "heart_data": heart_data_list
-        }
+        url, headers, body = self.build_heartbeat_request(video_session, heart_data_list)
 
         try:
-            response = self.session.post(
-                self.heartbeat_url,
-                headers=self.headers,
-                data=json.dumps(payload),
+            response = self._request(
+                'heartbeat', 'POST', url,
+                classroom_id=video_session.classroom_id,
+                headers=headers,
+                data=body,
                 timeout=10
             )
 
             if response.status_code == 200:
                 return response.json()
             else:
-                print(f"心跳请求失败，状态码: {response.status_code}")
+                logger.warning("心跳请求失败，状态码: %s", response.status_code)
                 return None
 
         except Exception as e:
-            print(f"发送心跳失败: {e}")
+            logger.warning("发送心跳失败: %s", e)
             return None
-    def get_video_progress(self):
-        """获取视频播放进度"""
+
+    def build_progress_request(self, video_session):
+        """构造进度查询请求，返回 (url, headers, params)"""
         params = {
-            'cid': self.video_params['course_id'],
-            'user_id': self.video_params['user_id'],
-            'classroom_id': self.video_params['classroom_id'],
+            'cid': video_session.course_id,
+            'user_id': video_session.user_id,
+            'classroom_id': video_session.classroom_id,
             'video_type': 'video',
             'vtype': 'rate',
-            'video_id': self.video_params['video_id'],
+            'video_id': video_session.video_id,
             'snapshot': 1
         }
 
-        progress_headers = self.headers.copy()
+        progress_headers = video_session.headers.copy()
         progress_headers.update({
             'Accept': 'application/json, text/plain, */*',
             'Xt-Agent': 'web'
         })
+        return self.progress_url, progress_headers, params
+
+    def get_video_progress(self, video_session):
+        """获取视频播放进度"""
+        url, progress_headers, params = self.build_progress_request(video_session)
 
         try:
-            response = self.session.get(
-                self.progress_url,
+            response = self._request(
+                'progress', 'GET', url,
+                classroom_id=video_session.classroom_id,
                 headers=progress_headers,
                 params=params,
                 timeout=10
@@ -207,13 +1821,50 @@ class YuketangHeartbeat:
                 # print(f"hello -{response.json()}")
                 return response.json()
             else:
-                print(f"获取进度失败，状态码: {response.status_code}")
+                logger.warning("获取进度失败，状态码: %s", response.status_code)
                 return None
 
         except Exception as e:
-            print(f"获取进度失败: {e}")
+            logger.warning("获取进度失败: %s", e)
             return None
 
+    def _cached_get(self, kind, cache_key, url, headers, params=None, timeout=10):
+        """带元数据缓存的GET：缓存有效时直接返回，过期时用 ETag/Last-Modified 条件请求重新验证"""
+        if self.metadata_cache is None or cache_key is None:
+            return self._request(kind, 'GET', url, classroom_id=cache_key[0] if cache_key else None,
+                                 headers=headers, params=params, timeout=timeout)
+
+        classroom_id, leaf_id = cache_key
+        entry = self.metadata_cache.get(classroom_id, leaf_id, kind)
+        if entry is not None:
+            if self.metadata_cache.is_fresh(entry, kind):
+                return _CachedResponse(entry['data'])
+            headers = dict(headers)
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        response = self._request(kind, 'GET', url, classroom_id=classroom_id,
+                                 headers=headers, params=params, timeout=timeout)
+
+        if response.status_code == 304 and entry is not None:
+            self.metadata_cache.touch(classroom_id, leaf_id, kind)
+            return _CachedResponse(entry['data'])
+
+        if response.status_code == 200:
+            try:
+                data = response.json()
+            except ValueError:
+                return response
+            if isinstance(data, dict) and data.get('success'):
+                self.metadata_cache.put(
+                    classroom_id, leaf_id, kind, data,
+                    etag=response.headers.get('ETag'),
+                    last_modified=response.headers.get('Last-Modified')
+                )
+        return response
+
     def get_leaf_info(self, classroom_id, leaf_id):
         """获取视频单元信息"""
         url = f"{self.base_url}/mooc-api/v1/lms/learn/leaf_info/{classroom_id}/{leaf_id}/"
@@ -225,189 +1876,228 @@ class YuketangHeartbeat:
             'classroom-id': str(classroom_id)  # 添加必需的classroom-id头部
         })
 
-        print(f"正在请求URL: {url}")
+        logger.debug("正在请求URL: %s", url)
 
         try:
-            response = self.session.get(url, headers=headers, timeout=10)
+            response = self._cached_get('leaf_info', (classroom_id, leaf_id), url, headers)
 
-            print(f"响应状态码: {response.status_code}")
+            logger.debug("响应状态码: %s", response.status_code)
 
             if response.status_code == 200:
                 try:
                     json_data = response.json()
                     if json_data.get('success'):
-                        print("成功获取视频单元信息")
+                        logger.info("成功获取视频单元信息")
                         return json_data
                     else:
-                        print(f"API返回失败: {json_data.get('msg', '未知错误')}")
-                        print(f"响应内容: {response.text[:500]}...")
+                        logger.warning("API返回失败: %s", json_data.get('msg', '未知错误'))
+                        logger.debug("响应内容: %s...", response.text[:500])
                         return None
                 except json.JSONDecodeError:
-                    print("响应不是有效的JSON格式")
-                    print(f"响应内容: {response.text[:500]}...")
+                    logger.warning("响应不是有效的JSON格式")
+                    logger.debug("响应内容: %s...", response.text[:500])
                     return None
             else:
-                print(f"获取视频单元信息失败，状态码: {response.status_code}")
-                print(f"响应内容: {response.text}")
+                logger.warning("获取视频单元信息失败，状态码: %s", response.status_code)
+                logger.debug("响应内容: %s", response.text)
                 return None
 
         except Exception as e:
-            print(f"获取视频单元信息失败: {e}")
+            logger.warning("获取视频单元信息失败: %s", e)
             return None
 
-    def get_video_info_alternative(self, classroom_id, leaf_id):
-        """使用备用方法获取视频信息"""
-        print(f"尝试备用方法获取视频信息: classroom_id={classroom_id}, leaf_id={leaf_id}")
-
-        # 方法1: 尝试学习进度API
-        url1 = f"{self.base_url}/mooc-api/v1/lms/learn/leafprogress/{classroom_id}/{leaf_id}/"
+    def _leaf_api_headers(self, classroom_id):
         headers = self.headers.copy()
         headers.update({
             'Accept': 'application/json, text/plain, */*',
             'Xt-Agent': 'web',
             'classroom-id': str(classroom_id)
         })
-
-        print(f"方法1 - 尝试学习进度API: {url1}")
+        return headers
+
+    def _alternative_leaf_urls(self, classroom_id, leaf_id):
+        """备用获取方式：[(方式名, 说明, URL), ...]"""
+        return [
+            # 方法1: 尝试学习进度API
+            ('leafprogress', '方法1 - 尝试学习进度API',
+             f"{self.base_url}/mooc-api/v1/lms/learn/leafprogress/{classroom_id}/{leaf_id}/"),
+            # 方法2: 尝试课程内容API
+            ('leaf', '方法2 - 尝试课程内容API',
+             f"{self.base_url}/mooc-api/v1/lms/learn/leaf/{leaf_id}/"),
+            # 方法3: 尝试不同的路径格式
+            ('leaf_info_short', '方法3 - 尝试简化路径',
+             f"{self.base_url}/mooc-api/v1/lms/learn/leaf_info/{leaf_id}/"),
+        ]
+
+    def _get_leaf_json(self, strategy, classroom_id, url, headers, label):
+        """请求一个备用leaf接口，成功返回JSON，否则返回None"""
+        name = label.split(' - ')[0]
+        logger.debug("%s: %s", label, url)
         try:
-            response = self.session.get(url1, headers=headers, timeout=10)
-            print(f"方法1响应状态码: {response.status_code}")
+            response = self._request(strategy, 'GET', url, classroom_id=classroom_id, headers=headers, timeout=10)
+            logger.debug("%s响应状态码: %s", name, response.status_code)
             if response.status_code == 200:
                 json_data = response.json()
                 if json_data.get('success'):
-                    print("方法1成功获取视频信息")
+                    logger.info("%s成功获取视频信息", name)
                     return json_data
                 else:
-                    print(f"方法1失败: {json_data.get('msg', '未知错误')}")
+                    logger.warning("%s失败: %s", name, json_data.get('msg', '未知错误'))
             else:
-                print(f"方法1失败，状态码: {response.status_code}")
+                logger.warning("%s失败，状态码: %s", name, response.status_code)
         except Exception as e:
-            print(f"方法1异常: {e}")
+            logger.warning("%s异常: %s", name, e)
+        return None
 
-        # 方法2: 尝试课程内容API
-        url2 = f"{self.base_url}/mooc-api/v1/lms/learn/leaf/{leaf_id}/"
-        print(f"方法2 - 尝试课程内容API: {url2}")
-        try:
-            response = self.session.get(url2, headers=headers, timeout=10)
-            print(f"方法2响应状态码: {response.status_code}")
-            if response.status_code == 200:
-                json_data = response.json()
-                if json_data.get('success'):
-                    print("方法2成功获取视频信息")
-                    return json_data
-                else:
-                    print(f"方法2失败: {json_data.get('msg', '未知错误')}")
-            else:
-                print(f"方法2失败，状态码: {response.status_code}")
-        except Exception as e:
-            print(f"方法2异常: {e}")
+    def get_video_info_alternative(self, classroom_id, leaf_id):
+        """使用备用方法获取视频信息"""
+        logger.info("尝试备用方法获取视频信息: classroom_id=%s, leaf_id=%s", classroom_id, leaf_id)
 
-        # 方法3: 尝试不同的路径格式
-        url3 = f"{self.base_url}/mooc-api/v1/lms/learn/leaf_info/{leaf_id}/"
-        print(f"方法3 - 尝试简化路径: {url3}")
-        try:
-            response = self.session.get(url3, headers=headers, timeout=10)
-            print(f"方法3响应状态码: {response.status_code}")
-            if response.status_code == 200:
-                json_data = response.json()
-                if json_data.get('success'):
-                    print("方法3成功获取视频信息")
-                    return json_data
-                else:
-                    print(f"方法3失败: {json_data.get('msg', '未知错误')}")
-            else:
-                print(f"方法3失败，状态码: {response.status_code}")
-        except Exception as e:
-            print(f"方法3异常: {e}")
+        headers = self._leaf_api_headers(classroom_id)
+        for strategy, label, url in self._alternative_leaf_urls(classroom_id, leaf_id):
+            json_data = self._get_leaf_json(strategy, classroom_id, url, headers, label)
+            if json_data:
+                return json_data
 
-        print("所有备用方法都失败了")
+        logger.warning("所有备用方法都失败了")
         return None
 
+    def get_leaf_info_from_structure(self, classroom_id, leaf_id, sign=None):
+        """从课程结构中构造一个简化的leaf_info（缺少user_id等字段，作为最后的备用）"""
+        structure_info = self.find_video_in_course_structure(classroom_id, leaf_id, sign)
+        if not structure_info or not structure_info.get('success'):
+            return None
+
+        # 使用课程结构中的信息
+        leaf_data = structure_info.get('data', {})
+        logger.info("从课程结构获取信息成功，视频名称: %s", leaf_data.get('name', '未知'))
+
+        # 尝试使用课程结构中的sku_id等信息
+        sku_id = leaf_data.get('sku_id')
+        if not sku_id:
+            logger.warning("课程结构中也没有足够的信息")
+            return None
+
+        logger.info("使用课程结构中的sku_id: %s", sku_id)
+        # 模拟一个简单的leaf_info结构
+        return {
+            'success': True,
+            'data': {
+                'sku_id': sku_id,
+                'name': leaf_data.get('name', '未知视频'),
+                'content_info': {
+                    'media': {
+                        'duration': leaf_data.get('duration', 0),
+                        'ccid': leaf_data.get('video_id'),  # 可能存在
+                        'cc_id': leaf_data.get('video_id'),
+                        'cc': leaf_data.get('video_id')
+                    }
+                }
+            }
+        }
+
+    def fetch_leaf_metadata(self, strategy, classroom_id, leaf_id, sign=None):
+        """按指定方式获取leaf信息，方式名见 MetadataResolver.STRATEGIES"""
+        if strategy == 'leaf_info':
+            return self.get_leaf_info(classroom_id, leaf_id)
+        if strategy == 'course_structure':
+            return self.get_leaf_info_from_structure(classroom_id, leaf_id, sign)
+
+        headers = self._leaf_api_headers(classroom_id)
+        for name, label, url in self._alternative_leaf_urls(classroom_id, leaf_id):
+            if name == strategy:
+                return self._get_leaf_json(name, classroom_id, url, headers, label)
+        raise ValueError(f"未知的元数据获取方式: {strategy}")
+
     def find_video_in_course_structure(self, classroom_id, leaf_id, sign=None):
         """在课程结构中查找指定的视频ID，获取其详细信息"""
-        print(f"在课程结构中查找视频ID: {leaf_id}")
+        logger.info("在课程结构中查找视频ID: %s", leaf_id)
 
-        chapters_data = self.get_course_chapters(classroom_id, sign)
-        if not chapters_data or not chapters_data.get('success'):
-            print("无法获取课程章节数据")
+        course_index = self.get_course_index(classroom_id, sign)
+        if course_index is None:
+            logger.warning("无法获取课程章节数据")
             return None
 
-        chapters = chapters_data.get('data', {}).get('course_chapter', [])
-
-        for chapter in chapters:
-            chapter_name = chapter.get('name', '未知章节')
-            section_leaf_list = chapter.get('section_leaf_list', [])
-
-            for leaf in section_leaf_list:
-                if leaf.get('id') == leaf_id:
-                    print(f"找到视频: {leaf.get('name')} (ID: {leaf_id}) 在章节: {chapter_name}")
-                    # 返回完整的leaf信息
-                    return {
-                        'success': True,
-                        'data': leaf,
-                        'chapter_name': chapter_name
-                    }
+        entry = course_index.get_leaf(leaf_id)
+        if entry is None:
+            logger.warning("在课程结构中未找到视频ID: %s", leaf_id)
+            return None
 
-        print(f"在课程结构中未找到视频ID: {leaf_id}")
-        return None
+        leaf = entry['leaf']
+        section = entry['section']
+        chapter_name = entry['chapter_name']
+        if section is not None:
+            # 子leaf本身不带sku_id和名称，用所属section的信息补全
+            leaf = dict(leaf)
+            leaf.setdefault('sku_id', section.get('sku_id'))
+            if not leaf.get('name'):
+                leaf['name'] = section.get('name')
+
+        logger.info("找到视频: %s (ID: %s) 在章节: %s", leaf.get('name'), leaf_id, chapter_name)
+        # 返回完整的leaf信息
+        return {
+            'success': True,
+            'data': leaf,
+            'chapter_name': chapter_name
+        }
 
     def debug_video_ids(self, classroom_id, sign=None, limit=5):
         """调试视频ID获取问题"""
-        print(f"开始调试视频ID问题...")
+        logger.debug("开始调试视频ID问题...")
 
         # 获取视频列表
         video_leafs = self.get_video_leaf_list(classroom_id, sign, debug=True)
         if not video_leafs:
-            print("没有找到视频")
+            logger.warning("没有找到视频")
             return
 
-        print(f"找到 {len(video_leafs)} 个视频，测试前 {limit} 个:")
+        logger.info("找到 %s 个视频，测试前 %s 个:", len(video_leafs), limit)
 
         for i, video_info in enumerate(video_leafs[:limit]):
             leaf_id = video_info['id']
-            print(f"\n{'='*50}")
-            print(f"调试视频 {i+1}/{min(limit, len(video_leafs))}: ID={leaf_id}")
-            print(f"名称: {video_info['name']}")
-            print(f"章节: {video_info['chapter_name']}")
-            print(f"原始leaf_type: {video_info['leaf_type']}")
-            print(f"原始sku_id: {video_info['sku_id']}")
+            logger.info("==================================================")
+            logger.debug("调试视频 %s/%s: ID=%s", i + 1, min(limit, len(video_leafs)), leaf_id)
+            logger.info("名称: %s", video_info['name'])
+            logger.info("章节: %s", video_info['chapter_name'])
+            logger.info("原始leaf_type: %s", video_info['leaf_type'])
+            logger.info("原始sku_id: %s", video_info['sku_id'])
 
             # 测试各种获取方法
-            print(f"\n1. 测试主方法 get_leaf_info:")
+            logger.info("1. 测试主方法 get_leaf_info:")
             leaf_info = self.get_leaf_info(classroom_id, leaf_id)
             if leaf_info and leaf_info.get('success'):
-                print("✅ 主方法成功")
+                logger.info("✅ 主方法成功")
                 data = leaf_info.get('data', {})
-                print(f"   user_id: {data.get('user_id')}")
-                print(f"   course_id: {data.get('course_id')}")
-                print(f"   sku_id: {data.get('sku_id')}")
+                logger.info("   user_id: %s", data.get('user_id'))
+                logger.info("   course_id: %s", data.get('course_id'))
+                logger.info("   sku_id: %s", data.get('sku_id'))
                 content_info = data.get('content_info', {})
                 media = content_info.get('media', {})
-                print(f"   media keys: {list(media.keys()) if media else 'None'}")
+                logger.debug("   media keys: %s", list(media.keys()) if media else 'None')
             else:
-                print("❌ 主方法失败")
+                logger.warning("❌ 主方法失败")
 
-                print(f"\n2. 测试备用方法:")
+                logger.info("2. 测试备用方法:")
                 alt_info = self.get_video_info_alternative(classroom_id, leaf_id)
                 if alt_info and alt_info.get('success'):
-                    print("✅ 备用方法成功")
+                    logger.info("✅ 备用方法成功")
                 else:
-                    print("❌ 备用方法也失败")
+                    logger.warning("❌ 备用方法也失败")
 
-                    print(f"\n3. 测试课程结构查找:")
+                    logger.info("3. 测试课程结构查找:")
                     structure_info = self.find_video_in_course_structure(classroom_id, leaf_id, sign)
                     if structure_info and structure_info.get('success'):
-                        print("✅ 课程结构查找成功")
+                        logger.info("✅ 课程结构查找成功")
                         leaf_data = structure_info.get('data', {})
-                        print(f"   leaf keys: {list(leaf_data.keys()) if leaf_data else 'None'}")
-                        print(f"   leaf data: {leaf_data}")
+                        logger.debug("   leaf keys: %s", list(leaf_data.keys()) if leaf_data else 'None')
+                        logger.debug("   leaf data: %s", leaf_data)
                     else:
-                        print("❌ 课程结构查找也失败")
+                        logger.warning("❌ 课程结构查找也失败")
 
-        print(f"\n{'='*50}")
-        print("调试完成")
+        logger.info("==================================================")
+        logger.debug("调试完成")
 
-    def get_video_drag_permission(self, sku_id, classroom_id=None):
+    def get_video_drag_permission(self, sku_id, classroom_id=None, cache_key=None):
         """获取视频拖拽权限"""
         url = f"{self.base_url}/mooc-api/v1/lms/learn/video/drag"
         params = {'sku_id': sku_id}
@@ -423,19 +2113,19 @@ class YuketangHeartbeat:
             headers['classroom-id'] = str(classroom_id)
 
         try:
-            response = self.session.get(url, headers=headers, params=params, timeout=10)
+            response = self._cached_get('video_drag', cache_key, url, headers, params)
 
             if response.status_code == 200:
                 return response.json()
             else:
-                print(f"获取拖拽权限失败，状态码: {response.status_code}")
+                logger.warning("获取拖拽权限失败，状态码: %s", response.status_code)
                 return None
 
         except Exception as e:
-            print(f"获取拖拽权限失败: {e}")
+            logger.warning("获取拖拽权限失败: %s", e)
             return None
 
-    def get_watermark_config(self, uv_id, classroom_id):
+    def get_watermark_config(self, uv_id, classroom_id, cache_key=None):
         """获取水印配置"""
         url = f"{self.base_url}/c27/api/v1/platfrom/watermark"
         params = {
@@ -451,19 +2141,19 @@ class YuketangHeartbeat:
         })
 
         try:
-            response = self.session.get(url, headers=headers, params=params, timeout=10)
+            response = self._cached_get('watermark', cache_key, url, headers, params)
 
             if response.status_code == 200:
                 return response.json()
             else:
-                print(f"获取水印配置失败，状态码: {response.status_code}")
+                logger.warning("获取水印配置失败，状态码: %s", response.status_code)
                 return None
 
         except Exception as e:
-            print(f"获取水印配置失败: {e}")
+            logger.warning("获取水印配置失败: %s", e)
             return None
 
-    def get_video_play_url(self, video_id, provider='cc', file_type=1, is_single=0):
+    def get_video_play_url(self, video_id, provider='cc', file_type=1, is_single=0, cache_key=None):
         """获取视频播放地址"""
         url = f"{self.base_url}/api/open/audiovideo/playurl"
         params = {
@@ -471,7 +2161,7 @@ class YuketangHeartbeat:
             'provider': provider,
             'file_type': file_type,
             'is_single': is_single,
-            'domain': 'changjiang.yuketang.cn'
+            'domain': urlsplit(self.base_url).netloc
         }
 
         headers = self.headers.copy()
@@ -481,16 +2171,16 @@ class YuketangHeartbeat:
         })
 
         try:
-            response = self.session.get(url, headers=headers, params=params, timeout=10)
+            response = self._cached_get('playurl', cache_key, url, headers, params)
 
             if response.status_code == 200:
                 return response.json()
             else:
-                print(f"获取视频播放地址失败，状态码: {response.status_code}")
+                logger.warning("获取视频播放地址失败，状态码: %s", response.status_code)
                 return None
 
         except Exception as e:
-            print(f"获取视频播放地址失败: {e}")
+            logger.warning("获取视频播放地址失败: %s", e)
             return None
 
     def get_classroom_info(self, classroom_id):
@@ -506,16 +2196,17 @@ class YuketangHeartbeat:
         })
 
         try:
-            response = self.session.get(url, headers=headers, params=params, timeout=10)
+            response = self._request('classroom_info', 'GET', url, classroom_id=classroom_id,
+                                     headers=headers, params=params, timeout=10)
 
             if response.status_code == 200:
                 return response.json()
             else:
-                print(f"获取课堂信息失败，状态码: {response.status_code}")
+                logger.warning("获取课堂信息失败，状态码: %s", response.status_code)
                 return None
 
         except Exception as e:
-            print(f"获取课堂信息失败: {e}")
+            logger.warning("获取课堂信息失败: %s", e)
             return None
 
     def get_course_chapters(self, classroom_id, sign=None):
@@ -524,7 +2215,7 @@ class YuketangHeartbeat:
         params = {
             'cid': classroom_id,
             'term': 'latest',
-            'uv_id': self.video_params.get('uv_id', ''),
+            'uv_id': self.uv_id or '',
             'classroom_id': classroom_id
         }
 
@@ -535,118 +2226,135 @@ class YuketangHeartbeat:
         headers = self.headers.copy()
         headers.update({
             'Accept': 'application/json, text/plain, */*',
-            'X-CSRFToken': self.video_params.get('csrf_token', ''),
+            'X-CSRFToken': self.csrf_token or '',
             'platform-id': '3',
             'terminal-type': 'web',
-            'university-id': str(self.video_params.get('university_id', '')),
+            'university-id': str(self.university_id or ''),
             'x-client': 'web',
             'xtbz': 'ykt'
         })
 
-        print(f"正在获取课程章节列表: {url}")
+        logger.debug("正在获取课程章节列表: %s", url)
 
         try:
-            response = self.session.get(url, headers=headers, params=params, timeout=10)
+            response = self._request('course_chapter', 'GET', url, classroom_id=classroom_id,
+                                     headers=headers, params=params, timeout=10)
 
-            print(f"响应状态码: {response.status_code}")
+            logger.debug("响应状态码: %s", response.status_code)
 
             if response.status_code == 200:
                 try:
                     json_data = response.json()
                     if json_data.get('success'):
-                        print("成功获取课程章节列表")
+                        logger.info("成功获取课程章节列表")
                         # 调试：输出数据结构
-                        print("数据结构调试:")
+                        logger.debug("数据结构调试:")
                         data = json_data.get('data', {})
-                        print(f"data keys: {list(data.keys())}")
+                        logger.debug("data keys: %s", list(data.keys()))
                         if 'course_chapter' in data:
                             chapters = data['course_chapter']
-                            print(f"course_chapter 类型: {type(chapters)}, 长度: {len(chapters) if isinstance(chapters, list) else 'N/A'}")
+                            logger.debug("course_chapter 类型: %s, 长度: %s", type(chapters), len(chapters) if isinstance(chapters, list) else 'N/A')
                             if isinstance(chapters, list) and len(chapters) > 0:
                                 first_chapter = chapters[0]
-                                print(f"第一个章节的keys: {list(first_chapter.keys())}")
-                                print(f"第一个章节示例: {first_chapter}")
+                                logger.debug("第一个章节的keys: %s", list(first_chapter.keys()))
+                                logger.debug("第一个章节示例: %s", first_chapter)
                         return json_data
                     else:
-                        print(f"API返回失败: {json_data.get('msg', '未知错误')}")
+                        logger.warning("API返回失败: %s", json_data.get('msg', '未知错误'))
                         return None
                 except json.JSONDecodeError:
-                    print("响应不是有效的JSON格式")
+                    logger.warning("响应不是有效的JSON格式")
                     return None
             else:
-                print(f"获取课程章节失败，状态码: {response.status_code}")
-                print(f"响应内容: {response.text[:500]}...")
+                logger.warning("获取课程章节失败，状态码: %s", response.status_code)
+                logger.debug("响应内容: %s...", response.text[:500])
                 return None
 
         except Exception as e:
-            print(f"获取课程章节失败: {e}")
+            logger.warning("获取课程章节失败: %s", e)
             return None
 
+    def get_course_index(self, classroom_id, sign=None, refresh=False):
+        """获取课程结构索引，每个课堂只请求一次 course/chapter"""
+        key = (str(classroom_id), sign or '')
+        with self._course_index_lock:
+            if not refresh and key in self._course_indexes:
+                return self._course_indexes[key]
+            key_lock = self._course_index_key_locks.setdefault(key, threading.Lock())
+
+        # 持该课堂的锁请求，保证同一课堂只下载一次
+        with key_lock:
+            with self._course_index_lock:
+                course_index = self._course_indexes.get(key)
+            # 等锁期间可能已被其他线程下载完成
+            if course_index is not None and not refresh:
+                return course_index
+
+            chapters_data = self.get_course_chapters(classroom_id, sign)
+            if not chapters_data or not chapters_data.get('success'):
+                return None
+
+            course_index = CourseIndex(chapters_data)
+            with self._course_index_lock:
+                self._course_indexes[key] = course_index
+            return course_index
+
     def get_richtext_leaf_list(self, classroom_id, sign=None, debug=False):
         """获取课程中所有图文类型的leaf列表（leaf_type==3）"""
-        chapters_data = self.get_course_chapters(classroom_id, sign)
-        if not chapters_data or not chapters_data.get('success'):
+        course_index = self.get_course_index(classroom_id, sign)
+        if course_index is None:
             return []
 
         richtext_leafs = []
-        chapters = chapters_data.get('data', {}).get('course_chapter', [])
-
-        print(f"解析章节数据，共{len(chapters)}个章节（查找图文）")
-
-        for chapter in chapters:
-            chapter_name = chapter.get('name', '未知章节')
-            section_leaf_list = chapter.get('section_leaf_list', [])
 
-            for leaf in section_leaf_list:
-                if debug:
-                    print(f"  调试 - Section Leaf: name='{leaf.get('name')}', type='{leaf.get('leaf_type')}', id={leaf.get('id')}")
-
-                # 检查子节点 leaf_list
-                leaf_list = leaf.get('leaf_list', [])
-                if leaf_list:
-                    for actual_leaf in leaf_list:
-                        if actual_leaf.get('leaf_type') == 3:
-                            richtext_info = {
-                                'id': actual_leaf.get('id'),
-                                'name': actual_leaf.get('name', '未知图文') or leaf.get('name', '未知图文'),
-                                'section_id': leaf.get('id'),
-                                'chapter_name': chapter_name,
-                                'leaf_type': 3,
-                                'sku_id': leaf.get('sku_id'),
-                                'leafinfo_id': actual_leaf.get('leafinfo_id'),
-                            }
-                            richtext_leafs.append(richtext_info)
-                            print(f"  找到图文: ID={richtext_info['id']}, 名称={richtext_info['name']}, 章节={chapter_name}")
-                
+        logger.info("解析章节数据，共%s个章节（查找图文）", len(course_index.chapters))
+
+        if debug:
+            for section_entry in course_index.sections:
+                leaf = section_entry['section']
+                logger.debug("  调试 - Section Leaf: name='%s', type='%s', id=%s", leaf.get('name'), leaf.get('leaf_type'), leaf.get('id'))
+
+        for entry in course_index.leaves_of_type(3):
+            chapter_name = entry['chapter_name']
+            section = entry['section']
+
+            if section is not None:
+                # 子节点 leaf_list 中的图文
+                actual_leaf = entry['leaf']
+                richtext_info = {
+                    'id': actual_leaf.get('id'),
+                    'name': actual_leaf.get('name', '未知图文') or section.get('name', '未知图文'),
+                    'section_id': section.get('id'),
+                    'chapter_name': chapter_name,
+                    'leaf_type': 3,
+                    'sku_id': section.get('sku_id'),
+                    'leafinfo_id': actual_leaf.get('leafinfo_id'),
+                }
+                richtext_leafs.append(richtext_info)
+                logger.info("  找到图文: ID=%s, 名称=%s, 章节=%s", richtext_info['id'], richtext_info['name'], chapter_name)
+            else:
                 # 有些单独的节点可能外层就是 leaf_type == 3
-                if leaf.get('leaf_type') == 3 and not leaf_list:
-                    leafinfo_id = leaf.get('leafinfo_id')
-                    richtext_info = {
-                        'id': leaf.get('id'),  # 修复！只能使用真实的 id，不能使用 leafinfo_id
-                        'name': leaf.get('name', '未知图文'),
-                        'section_id': leaf.get('id'),
-                        'chapter_name': chapter_name,
-                        'leaf_type': 3,
-                        'sku_id': leaf.get('sku_id'),
-                        'leafinfo_id': leafinfo_id,
-                    }
-                    richtext_leafs.append(richtext_info)
-                    print(f"  找到图文(外部): ID={richtext_info['id']}, 名称={richtext_info['name']}, 章节={chapter_name}")
+                leaf = entry['leaf']
+                if leaf.get('leaf_list'):
+                    continue
+                leafinfo_id = leaf.get('leafinfo_id')
+                richtext_info = {
+                    'id': leaf.get('id'),  # 修复！只能使用真实的 id，不能使用 leafinfo_id
+                    'name': leaf.get('name', '未知图文'),
+                    'section_id': leaf.get('id'),
+                    'chapter_name': chapter_name,
+                    'leaf_type': 3,
+                    'sku_id': leaf.get('sku_id'),
+                    'leafinfo_id': leafinfo_id,
+                }
+                richtext_leafs.append(richtext_info)
+                logger.info("  找到图文(外部): ID=%s, 名称=%s, 章节=%s", richtext_info['id'], richtext_info['name'], chapter_name)
 
-        print(f"总共找到 {len(richtext_leafs)} 个图文")
+        logger.info("总共找到 %s 个图文", len(richtext_leafs))
         return richtext_leafs
 
-    def view_richtext(self, classroom_id, leaf_id, leaf_name='未知图文', stay_seconds=3):
-        """
-        模拟图文/课程任务的阅读打卡。
-        利用发掘到的 user_article_finish 接口真正标记图文为已读。
-        """
-        status_url = f"{self.base_url}/mooc-api/v1/lms/learn/user_article_finish_status/{leaf_id}/"
-        finish_url = f"{self.base_url}/mooc-api/v1/lms/learn/user_article_finish/{leaf_id}/"
-
-        print(f"正在处理图文: {leaf_name} (ID: {leaf_id})")
-
-        # 构造打卡专用的请求头（包含关键的 xtbz 参数）
+    def _article_headers(self, classroom_id):
+        """构造图文打卡专用的请求头（包含关键的 xtbz 参数）"""
         api_headers = self.headers.copy()
         api_headers.update({
             'Accept': 'application/json, text/plain, */*',
@@ -654,252 +2362,433 @@ class YuketangHeartbeat:
             'xtbz': 'ykt',  # 最关键的头部
             'x-client': 'web'
         })
-        
+
         # 移除与接口请求无关或会导致 400 的头部
         api_headers.pop('Upgrade-Insecure-Requests', None)
+        return api_headers
+
+    def get_article_finish_status(self, classroom_id, leaf_id):
+        """查询图文是否已打卡完成，返回 True/False，查询失败返回None
 
+        只读的状态查询走限速器的 article_status 类别（RATE_LIMIT_ARTICLE_STATUS），不占用打卡请求的速率。
+        """
+        status_url = f"{self.base_url}/mooc-api/v1/lms/learn/user_article_finish_status/{leaf_id}/"
         try:
-            # 1. 检查当前是否已经完成
-            status_resp = self.session.get(status_url, headers=api_headers, timeout=10)
+            status_resp = self._request('article_status', 'GET', status_url, classroom_id=classroom_id,
+                                        headers=self._article_headers(classroom_id), timeout=10)
             if status_resp.status_code == 200:
                 status_data = status_resp.json()
-                if status_data.get('success') and status_data.get('data', {}).get('finish') == 1:
-                    print(f"  ⏭️ 图文 '{leaf_name}' 已经打卡完成，跳过。")
-                    return True
+                if status_data.get('success'):
+                    return status_data.get('data', {}).get('finish') == 1
+        except Exception as e:
+            logger.warning("  查询图文完成状态失败 (ID: %s): %s", leaf_id, e)
+        return None
+
+    def prescan_richtext_status(self, classroom_id, richtext_leafs, max_workers=5):
+        """并发预查所有图文的完成状态，返回 (未完成的图文列表, 已完成的图文列表)
 
-            print(f"  URL: {finish_url}")
+        查询失败的图文按未完成处理，交给后续打卡流程。
+        """
+        candidates = [info for info in richtext_leafs if info['id']]
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='richtext-status') as executor:
+            statuses = list(executor.map(
+                lambda info: self.get_article_finish_status(classroom_id, info['id']),
+                candidates
+            ))
+
+        finished_ids = {info['id'] for info, finished in zip(candidates, statuses) if finished}
+        pending = [info for info in richtext_leafs if info['id'] not in finished_ids]
+        finished = [info for info in richtext_leafs if info['id'] in finished_ids]
+        logger.info("图文状态预查: %s 篇已完成，%s 篇待处理", len(finished), len(pending))
+        return pending, finished
+
+    def view_richtext(self, classroom_id, leaf_id, leaf_name='未知图文', stay_seconds=3, check_status=True):
+        """
+        模拟图文/课程任务的阅读打卡。
+        利用发掘到的 user_article_finish 接口真正标记图文为已读。
+        打卡请求的速率由全局限速器的 article 类别（RATE_LIMIT_ARTICLE）控制；
+        已做过状态预查时传入 check_status=False，不再重复查询。
+        """
+        with log_context(leaf=leaf_id):
+            if self.cancel_token.cancelled:
+                return False
+            finish_url = f"{self.base_url}/mooc-api/v1/lms/learn/user_article_finish/{leaf_id}/"
 
-            # 模拟阅读停留时间
-            if stay_seconds > 0:
-                print(f"  模拟阅读停留 {stay_seconds} 秒...")
-                time.sleep(stay_seconds)
+            logger.info("正在处理图文: %s (ID: %s)", leaf_name, leaf_id)
 
-            response = self.session.get(
-                finish_url,
-                headers=api_headers,
-                timeout=15
-            )
+            api_headers = self._article_headers(classroom_id)
 
-            if response.status_code == 200:
-                result = response.json()
-                if result.get("success"):
-                    print(f"  ✅ 图文 '{leaf_name}' 打卡完成")
+            try:
+                # 1. 检查当前是否已经完成
+                if check_status and self.get_article_finish_status(classroom_id, leaf_id):
+                    logger.info("  ⏭️ 图文 '%s' 已经打卡完成，跳过。", leaf_name)
                     return True
-                else:
-                    print(f"  ⚠️ 图文 '{leaf_name}' 接口调用失败: {result}")
-            else:
-                print(f"  ❌ 打开失败 (状态码: {response.status_code})")
-                return False
 
-        except Exception as e:
-            print(f"  ❌ 请求异常: {str(e)}")
-            return False
+                logger.debug("  URL: %s", finish_url)
+
+                # 模拟阅读停留时间
+                if stay_seconds > 0:
+                    logger.info("  模拟阅读停留 %s 秒...", stay_seconds)
+                    if self.cancel_token.wait(stay_seconds):
+                        logger.info("  ⏹️ 已取消，未打卡: %s", leaf_name)
+                        return False
+
+                response = self._request(
+                    'article_finish', 'GET', finish_url,
+                    classroom_id=classroom_id,
+                    headers=api_headers,
+                    timeout=15
+                )
+
+                if response.status_code == 200:
+                    result = response.json()
+                    if result.get("success"):
+                        logger.info("  ✅ 图文 '%s' 打卡完成", leaf_name)
+                        return True
+                    else:
+                        logger.warning("  ⚠️ 图文 '%s' 接口调用失败: %s", leaf_name, result)
+                else:
+                    logger.warning("  ❌ 打开失败 (状态码: %s)", response.status_code)
+                    return False
+
+            except Exception as e:
+                logger.warning("  ❌ 请求异常: %s", str(e))
+                return False
 
-        return False
+            return False
 
     def batch_view_richtexts(self, classroom_id, sign=None, stay_seconds=3,
-                             skip_delay=1, debug=False):
-        """批量自动观看课程中的所有图文内容"""
-        print("开始批量浏览图文内容...")
+                             skip_delay=1, debug=False, concurrency=1, prescan_workers=5):
+        """批量自动观看课程中的所有图文内容
+
+        先用 prescan_workers 个线程并发预查完成状态，已完成的图文不再停留和等待；
+        预查和打卡请求分别由全局限速器的 article_status、article 类别限速（所有课堂共享）。
+        concurrency > 1 时多篇图文同时停留阅读，不再使用篇间间隔 skip_delay。返回值中的 results 为每篇图文的处理结果（按课程顺序）。
+        """
+        logger.info("开始批量浏览图文内容...")
 
-        # 首先确保基本参数已配置（获取图文列表依赖 video_params 中的部分字段）
+        # 首先确保基本参数已配置（获取图文列表依赖 set_account_params 设置的账号参数）
         richtext_leafs = self.get_richtext_leaf_list(classroom_id, sign, debug=debug)
 
         if not richtext_leafs:
-            print("没有找到任何图文内容")
-            return {'total': 0, 'success': 0, 'failed': 0}
+            logger.warning("没有找到任何图文内容")
+            return {'total': 0, 'success': 0, 'failed': 0, 'cancelled': 0, 'results': []}
 
-        print(f"准备浏览 {len(richtext_leafs)} 个图文")
+        # 预查完成状态，停留和间隔只用在真正需要打卡的图文上
+        pending_leafs, finished_leafs = self.prescan_richtext_status(classroom_id, richtext_leafs, prescan_workers)
 
-        success_count = 0
-        failed_count = 0
+        logger.info("准备浏览 %s 个图文", len(pending_leafs))
+
+        if not pending_leafs:
+            results = []
+        elif concurrency > 1:
+            results = self._view_richtexts_concurrently(
+                classroom_id, pending_leafs, stay_seconds, concurrency
+            )
+        else:
+            results = self._view_richtexts_sequentially(classroom_id, pending_leafs, stay_seconds, skip_delay)
+
+        # 合并预查结果，按课程顺序返回（两部分各自保持课程顺序）
+        finished_ids = {info['id'] for info in finished_leafs}
+        pending_results = iter(results)
+        results = [
+            {'id': info['id'], 'name': info['name'], 'success': True, 'skipped': True}
+            if info['id'] in finished_ids else next(pending_results)
+            for info in richtext_leafs
+        ]
+
+        success_count = sum(1 for result in results if result['success'])
+        # 因取消未处理的图文单独统计，不算失败
+        cancelled_count = sum(1 for result in results if result.get('cancelled'))
+        failed_count = len(results) - success_count - cancelled_count
+
+        logger.info("============================================================")
+        if cancelled_count:
+            logger.info("图文批量浏览已中断（%s）", self.cancel_token.reason)
+        else:
+            logger.info("图文批量浏览完成！")
+        logger.info("总图文数: %s", len(richtext_leafs))
+        logger.info("成功浏览: %s", success_count)
+        logger.info("失败:     %s", failed_count)
+        if cancelled_count:
+            logger.info("已取消:   %s", cancelled_count)
+        logger.info("============================================================")
 
+        return {
+            'total': len(richtext_leafs),
+            'success': success_count,
+            'failed': failed_count,
+            'cancelled': cancelled_count,
+            'results': results
+        }
+
+    def _richtext_result(self, leaf_id, leaf_name, success):
+        """单篇图文的处理结果；未成功且已收到取消时标记为 cancelled"""
+        result = {'id': leaf_id, 'name': leaf_name, 'success': bool(success)}
+        if not success and self.cancel_token.cancelled:
+            result['cancelled'] = True
+        return result
+
+    def _view_richtexts_sequentially(self, classroom_id, richtext_leafs, stay_seconds, skip_delay):
+        results = []
         for i, richtext_info in enumerate(richtext_leafs, 1):
             leaf_id = richtext_info['id']
             leaf_name = richtext_info['name']
             chapter_name = richtext_info['chapter_name']
 
-            print(f"\n{'='*50}")
-            print(f"正在处理第 {i}/{len(richtext_leafs)} 个图文")
-            print(f"  名称: {leaf_name}")
-            print(f"  章节: {chapter_name}")
-            print(f"  ID:   {leaf_id}")
+            logger.info("==================================================")
+            logger.info("正在处理第 %s/%s 个图文", i, len(richtext_leafs))
+            logger.info("  名称: %s", leaf_name)
+            logger.info("  章节: %s", chapter_name)
+            logger.info("  ID:   %s", leaf_id)
 
             if not leaf_id:
-                print("  ❌ leaf_id 为空，跳过")
-                failed_count += 1
+                logger.warning("  ❌ leaf_id 为空，跳过")
+                results.append({'id': leaf_id, 'name': leaf_name, 'success': False})
+                continue
+            if self.cancel_token.cancelled:
+                logger.info("  ⏹️ 已取消，跳过")
+                results.append(self._richtext_result(leaf_id, leaf_name, False))
                 continue
 
             result = self.view_richtext(
                 classroom_id=classroom_id,
                 leaf_id=leaf_id,
                 leaf_name=leaf_name,
-                stay_seconds=stay_seconds
+                stay_seconds=stay_seconds,
+                check_status=False
             )
-
-            if result:
-                success_count += 1
-            else:
-                failed_count += 1
+            results.append(self._richtext_result(leaf_id, leaf_name, result))
 
             # 每篇图文之间的间隔，避免请求过快
             if i < len(richtext_leafs):
-                time.sleep(skip_delay)
+                self.cancel_token.wait(skip_delay)
+        return results
 
-        print(f"\n{'='*60}")
-        print("图文批量浏览完成！")
-        print(f"总图文数: {len(richtext_leafs)}")
-        print(f"成功浏览: {success_count}")
-        print(f"失败:     {failed_count}")
-        print(f"{'='*60}")
+    def _view_richtexts_concurrently(self, classroom_id, richtext_leafs, stay_seconds, concurrency):
+        logger.info("并发浏览图文: 并发数=%s, 打卡速率上限=%s/s", concurrency, self.rate_limiter.rate('article') or '不限')
 
-        return {
-            'total': len(richtext_leafs),
-            'success': success_count,
-            'failed': failed_count
-        }
+        def view(richtext_info):
+            leaf_id = richtext_info['id']
+            leaf_name = richtext_info['name']
+            if not leaf_id:
+                logger.warning("  ❌ 图文 '%s' 的 leaf_id 为空，跳过", leaf_name)
+                return {'id': leaf_id, 'name': leaf_name, 'success': False}
+            try:
+                result = self.view_richtext(
+                    classroom_id=classroom_id,
+                    leaf_id=leaf_id,
+                    leaf_name=leaf_name,
+                    stay_seconds=stay_seconds,
+                    check_status=False
+                )
+            except Exception as e:
+                logger.warning("  ❌ 图文 '%s' 处理异常: %s", leaf_name, str(e))
+                result = False
+            return self._richtext_result(leaf_id, leaf_name, result)
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='richtext') as executor:
+            return list(executor.map(view, richtext_leafs))
 
     def get_video_leaf_list(self, classroom_id, sign=None, debug=False):
         """获取课程中所有视频类型的leaf列表"""
-        chapters_data = self.get_course_chapters(classroom_id, sign)
-        if not chapters_data or not chapters_data.get('success'):
+        course_index = self.get_course_index(classroom_id, sign)
+        if course_index is None:
             return []
 
         video_leafs = []
-        chapters = chapters_data.get('data', {}).get('course_chapter', [])
 
-        print(f"解析章节数据，共{len(chapters)}个章节")
+        logger.info("解析章节数据，共%s个章节，%s个leafs", len(course_index.chapters), len(course_index.sections))
 
-        for chapter in chapters:
-            chapter_name = chapter.get('name', '未知章节')
-            print(f"处理章节: {chapter_name}")
-
-            # 检查chapter中的section_leaf_list
-            section_leaf_list = chapter.get('section_leaf_list', [])
-            print(f"  章节包含 {len(section_leaf_list)} 个leafs")
-
-            for leaf in section_leaf_list:
-                if debug:
-                    print(f"  调试 - Leaf: name='{leaf.get('name')}', type='{leaf.get('leaf_type')}' (type: {type(leaf.get('leaf_type'))}), id={leaf.get('id')}")
-
-                # 检查是否为视频类型（根据name或leaf_type判断）
-                leaf_name = leaf.get('name', '')
-                leaf_type = leaf.get('leaf_type')  # 不设置默认值，保持原始的None
-
-                # 根据leaf_type判断是否为视频：
-                # leaf_type = None 通常是视频, 4 是讨论, 6 是测试, 5 是考试等
-                # 或者name包含"Video"
-                is_video = (leaf_name == 'Video' or
-                           leaf_type is None or  # None 通常是视频类型
-                           'video' in leaf_name.lower())
-
-                if debug:
-                    print(f"    is_video判断: {is_video} (leaf_type is None: {leaf_type is None})")
-
-                if is_video:
-                    # 检查这个视频section是否有leaf_list（实际的视频leaf）
-                    leaf_list = leaf.get('leaf_list', [])
-
-                    if leaf_list:
-                        # 找到实际的视频leaf
-                        for actual_leaf in leaf_list:
-                            if actual_leaf.get('leaf_type') == 0:  # 只要leaf_type为0就是视频
-                                video_info = {
-                                    'id': actual_leaf.get('id'),  # 使用实际的leaf ID
-                                    'name': leaf.get('name'),     # 使用section的名称
-                                    'section_id': leaf.get('id'), # 保存section ID以备用
-                                    'chapter_name': chapter_name,
-                                    'leaf_type': actual_leaf.get('leaf_type'),
-                                    'sku_id': leaf.get('sku_id'),
-                                    'leafinfo_id': actual_leaf.get('leafinfo_id'),
-                                }
-                                video_leafs.append(video_info)
-                                print(f"  找到视频: ID={video_info['id']} (实际leaf), 名称={video_info['name']}, 章节={chapter_name}")
-                    else:
-                        # 如果没有leaf_list，这可能是一个简单的视频section
-                        # 我们需要通过其他方式找到实际的video leaf ID
-                        # 根据调试信息，leafinfo_id可能指向实际的leaf
-                        leafinfo_id = leaf.get('leafinfo_id')
-                        if leafinfo_id:
-                            video_info = {
-                                'id': leafinfo_id,  # 尝试使用leafinfo_id
-                                'name': leaf.get('name'),
-                                'section_id': leaf.get('id'),
-                                'chapter_name': chapter_name,
-                                'leaf_type': leaf.get('leaf_type'),
-                                'sku_id': leaf.get('sku_id'),
-                                'leafinfo_id': leafinfo_id,
-                            }
-                            video_leafs.append(video_info)
-                            print(f"  找到视频: ID={video_info['id']} (leafinfo_id), 名称={video_info['name']}, 章节={chapter_name}")
-                        else:
-                            # 最后的备用选项：使用section ID
+        for section_entry in course_index.sections:
+            leaf = section_entry['section']
+            chapter_name = section_entry['chapter_name']
+            if debug:
+                logger.debug("  调试 - Leaf: name='%s', type='%s' (type: %s), id=%s", leaf.get('name'), leaf.get('leaf_type'), type(leaf.get('leaf_type')), leaf.get('id'))
+
+            # 检查是否为视频类型（根据name或leaf_type判断）
+            leaf_name = leaf.get('name', '')
+            leaf_type = leaf.get('leaf_type')  # 不设置默认值，保持原始的None
+
+            # 根据leaf_type判断是否为视频：
+            # leaf_type = None 通常是视频, 4 是讨论, 6 是测试, 5 是考试等
+            # 或者name包含"Video"
+            is_video = (leaf_name == 'Video' or
+                       leaf_type is None or  # None 通常是视频类型
+                       'video' in leaf_name.lower())
+
+            if debug:
+                logger.debug("    is_video判断: %s (leaf_type is None: %s)", is_video, leaf_type is None)
+
+            if is_video:
+                # 检查这个视频section是否有leaf_list（实际的视频leaf）
+                leaf_list = section_entry['leaf_list']
+
+                if leaf_list:
+                    # 找到实际的视频leaf
+                    for actual_leaf in leaf_list:
+                        if actual_leaf.get('leaf_type') == 0:  # 只要leaf_type为0就是视频
                             video_info = {
-                                'id': leaf.get('id'),
-                                'name': leaf.get('name'),
+                                'id': actual_leaf.get('id'),  # 使用实际的leaf ID
+                                'name': leaf.get('name'),     # 使用section的名称
+                                'section_id': leaf.get('id'), # 保存section ID以备用
                                 'chapter_name': chapter_name,
-                                'leaf_type': leaf.get('leaf_type'),
+                                'leaf_type': actual_leaf.get('leaf_type'),
                                 'sku_id': leaf.get('sku_id'),
+                                'leafinfo_id': actual_leaf.get('leafinfo_id'),
                             }
                             video_leafs.append(video_info)
-                            print(f"  找到视频: ID={video_info['id']} (section), 名称={video_info['name']}, 类型={video_info['leaf_type']}, 章节={chapter_name}")
+                            logger.info("  找到视频: ID=%s (实际leaf), 名称=%s, 章节=%s", video_info['id'], video_info['name'], chapter_name)
+                else:
+                    # 如果没有leaf_list，这可能是一个简单的视频section
+                    # 我们需要通过其他方式找到实际的video leaf ID
+                    # 根据调试信息，leafinfo_id可能指向实际的leaf
+                    leafinfo_id = leaf.get('leafinfo_id')
+                    if leafinfo_id:
+                        video_info = {
+                            'id': leafinfo_id,  # 尝试使用leafinfo_id
+                            'name': leaf.get('name'),
+                            'section_id': leaf.get('id'),
+                            'chapter_name': chapter_name,
+                            'leaf_type': leaf.get('leaf_type'),
+                            'sku_id': leaf.get('sku_id'),
+                            'leafinfo_id': leafinfo_id,
+                        }
+                        video_leafs.append(video_info)
+                        logger.info("  找到视频: ID=%s (leafinfo_id), 名称=%s, 章节=%s", video_info['id'], video_info['name'], chapter_name)
+                    else:
+                        # 最后的备用选项：使用section ID
+                        video_info = {
+                            'id': leaf.get('id'),
+                            'name': leaf.get('name'),
+                            'chapter_name': chapter_name,
+                            'leaf_type': leaf.get('leaf_type'),
+                            'sku_id': leaf.get('sku_id'),
+                        }
+                        video_leafs.append(video_info)
+                        logger.info("  找到视频: ID=%s (section), 名称=%s, 类型=%s, 章节=%s", video_info['id'], video_info['name'], video_info['leaf_type'], chapter_name)
 
-        print(f"总共找到 {len(video_leafs)} 个视频")
+        logger.info("总共找到 %s 个视频", len(video_leafs))
         return video_leafs
 
     def simulate_video_watching(self, total_duration=None, speed=1.0, interval=5, start_position=0):
-        """模拟观看视频"""
+        """模拟观看当前会话的视频"""
+        return self.run_watch_plan(self.video_session,
+                                   self.watch_plan(self.video_session, total_duration, speed, interval, start_position))
+
+    def run_watch_plan(self, video_session, plan):
+        """同步执行观看流程：逐个完成流程产生的心跳、等待和进度查询动作
+
+        取消后等待立即结束，由流程自己发出暂停心跳并返回。
+        """
+        reply = None
+        scheduled = None
+        try:
+            while True:
+                try:
+                    action = plan.send(reply)
+                except StopIteration as stop:
+                    return stop.value
+
+                kind = action[0]
+                if kind == 'heartbeat':
+                    reply = self.send_heartbeat(video_session, action[1])
+                elif kind == 'sleep':
+                    if self.cancel_token.cancelled:
+                        pass
+                    elif self.scheduler is not None:
+                        # 由中央调度器按绝对时间唤醒，心跳请求耗时不会累积成漂移
+                        if scheduled is None:
+                            scheduled = self.scheduler.register(action[1])
+                            # 取消时立即唤醒
+                            self.cancel_token.add_callback(scheduled.fire)
+                        self.scheduler.wait(scheduled)
+                    else:
+                        self.cancel_token.wait(action[1])
+                    reply = None
+                elif kind == 'progress':
+                    reply = self.get_video_progress(video_session)
+                else:
+                    raise ValueError(f"未知的观看动作: {kind}")
+        finally:
+            if scheduled is not None:
+                self.cancel_token.remove_callback(scheduled.fire)
+                self.scheduler.unregister(scheduled)
+
+    def _flush_heartbeats(self, buffer):
+        """子流程：把缓冲的心跳按批量大小分成若干次请求发出，返回最后一次请求的结果"""
+        result = None
+        while len(buffer):
+            result = yield ('heartbeat', buffer.drain())
+        return result
+
+    @staticmethod
+    def _progress_poll_interval(rate, total_duration, speed, interval):
+        """下一次进度查询前等待的秒数：取按当前速度到达完成阈值所需时间的一半
+
+        离阈值越远查询越少，接近阈值时缩短到 PROGRESS_POLL_MIN_SECONDS（不短于心跳间隔）。
+        """
+        remaining = max(0.0, COMPLETION_THRESHOLD - rate) * total_duration / max(speed, 0.1)
+        return min(max(remaining / 2, PROGRESS_POLL_MIN_SECONDS, interval), PROGRESS_POLL_MAX_SECONDS)
+
+    def watch_plan(self, video_session, total_duration=None, speed=1.0, interval=5, start_position=0):
+        """观看流程生成器
+
+        依次产生 ('heartbeat', heart_data_list)、('sleep', 秒数)、('progress',) 动作，
+        由同步或 asyncio 驱动执行后把结果送回；返回值为是否观看成功。
+        同一流程因此可以跑在线程里，也可以作为协程运行。
+        观看中按距完成阈值的远近调整进度查询频率，服务器完成率达到阈值时提前结束；
+        被取消时发出最后一个 pause 心跳、记录当前位置并返回 False。
+        """
+        if self.cancel_token.cancelled:
+            return False
+
         # 如果没有指定总时长，使用配置中的视频时长
         if total_duration is None:
-            total_duration = self.video_params.get('duration', 0)
+            total_duration = video_session.duration or 0
             if total_duration == 0:
-                print("未找到视频时长，无法模拟观看")
+                logger.warning("未找到视频时长，无法模拟观看")
                 return False
 
         current_position = start_position
         first_position = start_position
 
-        print(f"开始模拟观看视频")
-        print(f"  总时长: {total_duration}秒")
-        print(f"  开始位置: {start_position}秒")
-        print(f"  播放速度: {speed}x")
-        print(f"  心跳间隔: {interval}秒")
+        self._journal(video_session.classroom_id, video_session.video_id, 'watching',
+                      position=current_position)
 
-        # 发送加载开始事件
-        heart_data = self.create_heartbeat_data("loadstart", current_position, first_position, speed=speed)
-        result = self.send_heartbeat([heart_data])
-        if result:
-            print(f"发送加载开始事件成功")
+        logger.info("开始模拟观看视频")
+        logger.info("  总时长: %s秒", total_duration)
+        logger.info("  开始位置: %s秒", start_position)
+        logger.info("  播放速度: %sx", speed)
+        logger.info("  心跳间隔: %s秒", interval)
 
+        # 启动阶段的事件在同一时刻产生，缓冲后合并为一次请求
+        buffer = HeartbeatBuffer(self.heartbeat_batch_size, self.heartbeat_flush_interval)
+        buffer.add(self.encode_heartbeat(video_session, "loadstart", current_position, first_position, speed=speed))
         # 如果从非0位置开始，发送seeking事件
         if start_position > 0:
-            heart_data = self.create_heartbeat_data("seeking", current_position, first_position, speed=speed)
-            result = self.send_heartbeat([heart_data])
-            if result:
-                print(f"发送定位事件成功 - 位置: {current_position}s")
-
-        # 发送数据加载完成事件
-        heart_data = self.create_heartbeat_data("loadeddata", current_position, first_position, speed=speed)
-        result = self.send_heartbeat([heart_data])
-        if result:
-            print(f"发送数据加载完成事件成功")
-
-        # 发送开始播放事件
-        heart_data = self.create_heartbeat_data("play", current_position, first_position, speed=speed)
-        result = self.send_heartbeat([heart_data])
+            buffer.add(self.encode_heartbeat(video_session, "seeking", current_position, first_position, speed=speed))
+        buffer.add(self.encode_heartbeat(video_session, "loadeddata", current_position, first_position, speed=speed))
+        buffer.add(self.encode_heartbeat(video_session, "play", current_position, first_position, speed=speed))
+        buffer.add(self.encode_heartbeat(video_session, "playing", current_position, first_position, speed=speed))
+        count = len(buffer)
+        result = yield from self._flush_heartbeats(buffer)
         if result:
-            print(f"发送开始播放事件成功")
+            logger.info("发送启动事件成功（%s 个事件） - 位置: %ss", count, current_position)
 
-        # 发送播放中事件
-        heart_data = self.create_heartbeat_data("playing", current_position, first_position, speed=speed)
-        result = self.send_heartbeat([heart_data])
-        if result:
-            print(f"发送播放中事件成功")
-
-        # 模拟播放过程
-        progress_check_counter = 0
+        # 模拟播放过程；进度查询间隔随距完成阈值的远近调整
+        seconds_since_check = 0
+        next_check = self._progress_poll_interval(current_position / total_duration, total_duration, speed, interval)
         while current_position < total_duration:
-            time.sleep(interval)
+            yield ('sleep', interval)
+            if self.cancel_token.cancelled:
+                # 缓冲的心跳与暂停事件合并为最后一次请求，运行日志记录当前位置供下次续看
+                buffer.add(self.encode_heartbeat(video_session, "pause", current_position, first_position, speed=speed))
+                yield from self._flush_heartbeats(buffer)
+                self._journal(video_session.classroom_id, video_session.video_id, 'watching',
+                              position=current_position)
+                logger.info("观看已取消，已发送暂停心跳 - 位置: %.1fs", current_position)
+                return False
             current_position += interval * speed
 
             # 确保不超过总时长
@@ -910,112 +2799,94 @@ class YuketangHeartbeat:
             event_types = ["playing", "playing", "playing", "waiting"]  # playing概率更高
             event_type = random.choice(event_types)
 
-            heart_data = self.create_heartbeat_data(
+            buffer.add(self.encode_heartbeat(
+                video_session,
                 event_type,
                 current_position,
                 first_position,
                 speed=speed
-            )
+            ))
 
-            result = self.send_heartbeat([heart_data])
-            if result:
-                completion_rate = (current_position / total_duration) * 100
-                print(f"发送心跳成功 - 位置: {current_position:.1f}s/{total_duration}s ({completion_rate:.1f}%), 事件: {event_type}")
+            if buffer.due():
+                result = yield from self._flush_heartbeats(buffer)
+                if result:
+                    completion_rate = (current_position / total_duration) * 100
+                    logger.info("发送心跳成功 - 位置: %.1fs/%ss (%.1f%%), 事件: %s", current_position, total_duration, completion_rate, event_type)
 
             # 定期获取进度
-            progress_check_counter += 1
-            if progress_check_counter * interval >= 30:  # 每30秒获取一次进度
-                progress = self.get_video_progress()
-                if progress and progress.get('code') == 0:
-                    video_id = str(self.video_params['video_id'])
-                    progress_data = progress.get('data', {}).get(video_id, {})
-                    if progress_data:
-                        rate = progress_data.get('rate', 0)
-                        last_point = progress_data.get('last_point', 0)
-                        print(f"服务器进度: 完成率={rate:.2%}, 最后位置={last_point:.1f}s")
-                progress_check_counter = 0
-
-        # 发送视频结束事件
-        heart_data = self.create_heartbeat_data("videoend", total_duration, first_position, speed=speed)
-        result = self.send_heartbeat([heart_data])
-        if result:
-            print(f"发送视频结束事件成功")
-
-        # 发送暂停事件
-        heart_data = self.create_heartbeat_data("pause", total_duration, first_position, speed=speed)
-        result = self.send_heartbeat([heart_data])
+            seconds_since_check += interval
+            if seconds_since_check >= next_check:
+                # 查询前先发出缓冲的心跳，服务器进度才是最新的
+                yield from self._flush_heartbeats(buffer)
+                progress_info = self.parse_progress_info(video_session, (yield ('progress',)))
+                if progress_info:
+                    rate = progress_info['rate']
+                    logger.info("服务器进度: 完成率=%.2f%%, 最后位置=%.1fs", rate * 100, progress_info['last_point'])
+                    if rate >= COMPLETION_THRESHOLD:
+                        # 服务器已判定完成：缓冲的心跳与暂停事件合并发出以关闭播放会话，之后不再发送心跳和查询进度
+                        buffer.add(self.encode_heartbeat(video_session, "pause", current_position, first_position, speed=speed))
+                        yield from self._flush_heartbeats(buffer)
+                        logger.info("服务器完成率已达到 %.0f%%，已发送暂停心跳，提前结束观看", COMPLETION_THRESHOLD * 100)
+                        self._journal(video_session.classroom_id, video_session.video_id, 'watching',
+                                      position=current_position)
+                        return True
+                else:
+                    # 查询失败时按本地位置估算
+                    rate = current_position / total_duration
+                seconds_since_check = 0
+                next_check = self._progress_poll_interval(rate, total_duration, speed, interval)
+                self._journal(video_session.classroom_id, video_session.video_id, 'watching',
+                              position=current_position)
+
+        # 结束事件（videoend、pause）与尚未发出的心跳合并为一次请求
+        buffer.add(self.encode_heartbeat(video_session, "videoend", total_duration, first_position, speed=speed))
+        buffer.add(self.encode_heartbeat(video_session, "pause", total_duration, first_position, speed=speed))
+        result = yield from self._flush_heartbeats(buffer)
         if result:
-            print(f"发送暂停事件成功")
+            logger.info("发送结束事件成功")
 
-        print("视频观看模拟完成")
+        logger.info("视频观看模拟完成")
 
         # 最终获取一次进度
-        final_progress = self.get_video_progress()
+        final_progress = yield ('progress',)
         if final_progress and final_progress.get('code') == 0:
-            video_id = str(self.video_params['video_id'])
+            video_id = str(video_session.video_id)
             progress_data = final_progress.get('data', {}).get(video_id, {})
             if progress_data:
                 rate = progress_data.get('rate', 0)
                 last_point = progress_data.get('last_point', 0)
-                print(f"最终进度: 完成率={rate:.2%}, 最后位置={last_point:.1f}s")
+                logger.info("最终进度: 完成率=%.2f%%, 最后位置=%.1fs", rate * 100, last_point)
 
         return True
 
     def auto_configure_from_ids(self, classroom_id, leaf_id, sign=None):
-        """根据课堂ID和视频ID自动配置参数"""
-        print(f"开始自动配置参数 - 课堂ID: {classroom_id}, 视频ID: {leaf_id}")
-
-        # 获取视频单元信息
-        leaf_info = self.get_leaf_info(classroom_id, leaf_id)
-        print(f"auto_configure_from_ids - {leaf_info}")
-        if not leaf_info or not leaf_info.get('success'):
-            print("主方法失败，尝试备用方法获取视频信息...")
-            leaf_info = self.get_video_info_alternative(classroom_id, leaf_id)
-            if not leaf_info or not leaf_info.get('success'):
-                print("API方法都失败，尝试从课程结构中获取信息...")
-                structure_info = self.find_video_in_course_structure(classroom_id, leaf_id, sign)
-                if structure_info and structure_info.get('success'):
-                    # 使用课程结构中的信息
-                    leaf_data = structure_info.get('data', {})
-                    print(f"从课程结构获取信息成功，视频名称: {leaf_data.get('name', '未知')}")
-
-                    # 尝试使用课程结构中的sku_id等信息
-                    sku_id = leaf_data.get('sku_id')
-                    if sku_id:
-                        print(f"使用课程结构中的sku_id: {sku_id}")
-                        # 模拟一个简单的leaf_info结构
-                        leaf_info = {
-                            'success': True,
-                            'data': {
-                                'sku_id': sku_id,
-                                'name': leaf_data.get('name', '未知视频'),
-                                'content_info': {
-                                    'media': {
-                                        'duration': leaf_data.get('duration', 0),
-                                        'ccid': leaf_data.get('video_id'),  # 可能存在
-                                        'cc_id': leaf_data.get('video_id'),
-                                        'cc': leaf_data.get('video_id')
-                                    }
-                                }
-                            }
-                        }
-                    else:
-                        print("课程结构中也没有足够的信息")
-                        return False
-                else:
-                    print("所有方法都失败，无法获取视频单元信息")
-                    return False
+        """根据课堂ID和视频ID自动配置参数，配置结果作为当前会话"""
+        video_session = self.configure_video_session(classroom_id, leaf_id, sign)
+        if video_session is None:
+            return False
+        self.video_session = video_session
+        return True
+
+    def configure_video_session(self, classroom_id, leaf_id, sign=None):
+        """根据课堂ID和视频ID获取视频参数，返回新的 VideoSession，失败返回None"""
+        logger.info("开始自动配置参数 - 课堂ID: %s, 视频ID: %s", classroom_id, leaf_id)
+
+        # 获取视频单元信息（解析器会优先使用该课堂已验证可用的方式）
+        leaf_info = self.resolver.resolve(self, classroom_id, leaf_id, sign)
+        if not leaf_info:
+            logger.warning("所有方法都失败，无法获取视频单元信息")
+            return None
 
         data = leaf_info.get('data', {})
         content_info = data.get('content_info', {})
         media = content_info.get('media', {})
 
         # 打印数据结构以便调试
-        print("数据结构调试:")
-        print(f"data keys: {list(data.keys()) if data else 'None'}")
-        print(f"content_info keys: {list(content_info.keys()) if content_info else 'None'}")
-        print(f"media keys: {list(media.keys()) if media else 'None'}")
-        print(f"media内容: {media}")
+        logger.debug("数据结构调试:")
+        logger.debug("data keys: %s", list(data.keys()) if data else 'None')
+        logger.debug("content_info keys: %s", list(content_info.keys()) if content_info else 'None')
+        logger.debug("media keys: %s", list(media.keys()) if media else 'None')
+        logger.debug("media内容: %s", media)
 
         # 提取关键参数
         user_id = data.get('user_id')
@@ -1037,39 +2908,59 @@ class YuketangHeartbeat:
 
         # 获取拖拽权限
         if sku_id:
-            drag_info = self.get_video_drag_permission(sku_id, classroom_id)
+            drag_info = self.get_video_drag_permission(sku_id, classroom_id, cache_key=(classroom_id, leaf_id))
             if drag_info and drag_info.get('success'):
                 has_drag = drag_info.get('data', {}).get('has_drag', False)
-                print(f"拖拽权限: {'允许' if has_drag else '禁止'}")
+                logger.info("拖拽权限: %s", '允许' if has_drag else '禁止')
 
         # 获取水印配置
         if university_id:
-            watermark_config = self.get_watermark_config(university_id, classroom_id)
+            watermark_config = self.get_watermark_config(university_id, classroom_id, cache_key=(classroom_id, leaf_id))
             if watermark_config and watermark_config.get('success'):
                 watermark_data = watermark_config.get('data', {})
-                print(f"水印配置: {watermark_data}")
+                logger.debug("水印配置: %s", watermark_data)
+
+        # 时长已缓存时无需再请求播放地址
+        duration = None
+        if self.duration_cache is not None:
+            duration = self.duration_cache.get(cc_id)
+            if duration is not None:
+                logger.info("使用缓存的视频时长: %s秒", duration)
 
         # 获取视频播放地址
-        if cc_id:
-            play_url_info = self.get_video_play_url(cc_id)
+        play_urls = []
+        if cc_id and duration is None:
+            play_url_info = self.get_video_play_url(cc_id, cache_key=(classroom_id, leaf_id))
             if play_url_info and play_url_info.get('success'):
                 sources = play_url_info.get('data', {}).get('playurl', {}).get('sources', {})
-                play_urls = []
                 for quality, urls in sources.items():
                     # print(quality)
                     play_urls.extend(urls)
-                print(f"视频播放地址获取成功，共{len(play_urls)}个清晰度")
+                logger.info("视频播放地址获取成功，共%s个清晰度", len(play_urls))
                 # print(play_urls)
-        duration = getVideoDuration(play_urls[0])
+        if duration is None and play_urls:
+            def probe(url):
+                # 时长探测走CDN的Range请求，整体记为一次 media_probe
+                stats = {}
+                start = time.perf_counter()
+                result = getVideoDuration(url, session=self.transport.probe_session, stats=stats)
+                self.metrics.observe('media_probe', 206 if result is not None else 'ProbeFailed',
+                                     time.perf_counter() - start, bytes_in=stats.get('bytes_read', 0))
+                return result
+
+            if self.duration_cache is not None:
+                duration = self.duration_cache.get_or_probe(cc_id, play_urls[0], probe)
+            else:
+                duration = probe(play_urls[0])
 
         # 检查必要参数
         if not all([user_id, course_id, sku_id, cc_id]):
-            print("缺少必要参数:")
-            print(f"  user_id: {user_id}")
-            print(f"  course_id: {course_id}")
-            print(f"  sku_id: {sku_id}")
-            print(f"  cc_id: {cc_id}")
-            return False
+            logger.warning("缺少必要参数:")
+            logger.info("  user_id: %s", user_id)
+            logger.info("  course_id: %s", course_id)
+            logger.info("  sku_id: %s", sku_id)
+            logger.info("  cc_id: %s", cc_id)
+            return None
 
         # 从cookies中获取csrf_token
         csrf_token = None
@@ -1079,11 +2970,11 @@ class YuketangHeartbeat:
                 break
 
         if not csrf_token:
-            print("未找到CSRF token")
-            return False
+            logger.warning("未找到CSRF token")
+            return None
 
-        # 自动设置视频参数
-        self.set_video_params(
+        # 创建视频会话
+        video_session = self.new_video_session(
             user_id=user_id,
             course_id=course_id,
             video_id=leaf_id,
@@ -1096,277 +2987,1038 @@ class YuketangHeartbeat:
             duration=duration,
         )
 
-        print("参数配置完成:")
-        print(f"  视频名称: {data.get('name', '未知')}")
-        print(f"  用户ID: {user_id}")
-        print(f"  课程ID: {course_id}")
-        print(f"  视频ID: {leaf_id}")
-        print(f"  SKU ID: {sku_id}")
-        print(f"  课堂ID: {classroom_id}")
-        print(f"  CC ID: {cc_id}")
-        print(f"  视频时长: {duration}秒")
-        print(f"  学校ID: {university_id}")
-
-        return True
+        logger.info("参数配置完成:")
+        logger.info("  视频名称: %s", data.get('name', '未知'))
+        logger.info("  用户ID: %s", user_id)
+        logger.info("  课程ID: %s", course_id)
+        logger.info("  视频ID: %s", leaf_id)
+        logger.info("  SKU ID: %s", sku_id)
+        logger.info("  课堂ID: %s", classroom_id)
+        logger.info("  CC ID: %s", cc_id)
+        logger.info("  视频时长: %s秒", duration)
+        logger.info("  学校ID: %s", university_id)
+
+        return video_session
+
+    def get_current_progress_info(self, video_session=None):
+        """获取会话（默认为当前会话）的播放进度信息"""
+        video_session = video_session or self.video_session
+        return self.parse_progress_info(video_session, self.get_video_progress(video_session))
+
+    def take_prefetched_progress(self, video_session):
+        """取出进度预筛选时查到的该视频进度信息（只能取一次），没有时返回None"""
+        progress_data = self._prefetched_progress.pop(
+            (str(video_session.classroom_id), str(video_session.video_id)), None)
+        if progress_data is None:
+            return None
+        return {
+            'rate': progress_data.get('rate', 0) or 0,
+            'last_point': progress_data.get('last_point', 0) or 0,
+            'duration': video_session.duration or 0
+        }
 
-    def get_current_progress_info(self):
-        """获取当前播放进度信息"""
-        progress = self.get_video_progress()
+    def parse_progress_info(self, video_session, progress):
+        """从进度接口响应中提取会话视频的进度信息"""
         if progress and progress.get('code') == 0:
-            video_id = str(self.video_params['video_id'])
+            video_id = str(video_session.video_id)
             progress_data = progress.get('data', {}).get(video_id, {})
             if progress_data:
                 return {
                     'rate': progress_data.get('rate', 0),
                     'last_point': progress_data.get('last_point', 0),
-                    'duration': self.video_params.get('duration', 0)
+                    'duration': video_session.duration or 0
                 }
         return None
 
-    def smart_watch_video(self, speed=1.5, interval=5):
-        """智能观看视频（从上次停止的位置开始）"""
+    def get_watch_progress_map(self, classroom_id, course_id, user_id, video_ids):
+        """一次请求查询多个视频的进度（video_id 以逗号分隔），返回 {video_id: 进度数据}，失败返回None"""
+        params = {
+            'cid': course_id,
+            'user_id': user_id,
+            'classroom_id': classroom_id,
+            'video_type': 'video',
+            'vtype': 'rate',
+            'video_id': ','.join(str(video_id) for video_id in video_ids),
+            'snapshot': 1
+        }
+
+        progress_headers = self.headers.copy()
+        progress_headers.update({
+            'Accept': 'application/json, text/plain, */*',
+            'Xt-Agent': 'web',
+            'classroom-id': str(classroom_id)
+        })
+        csrf_token = self.session.cookies.get('csrftoken')
+        if csrf_token:
+            progress_headers['X-CSRFToken'] = csrf_token
+
+        try:
+            response = self._request('progress_batch', 'GET', self.progress_url, classroom_id=classroom_id,
+                                     headers=progress_headers, params=params, timeout=10)
+            if response.status_code == 200:
+                progress = response.json()
+                if progress.get('code') == 0:
+                    return progress.get('data', {}) or {}
+            logger.warning("批量获取进度失败，状态码: %s", response.status_code)
+        except Exception as e:
+            logger.warning("批量获取进度失败: %s", e)
+        return None
+
+    def _progress_identity(self, classroom_id, video_leafs, sign=None, attempts=3):
+        """从前几个视频的leaf信息中取得查询进度所需的 (course_id, user_id)，同一课堂内相同"""
+        key = str(classroom_id)
+        if key in self._progress_identities:
+            return self._progress_identities[key]
+
+        for video_info in video_leafs[:attempts]:
+            leaf_info = self.resolver.resolve(self, classroom_id, video_info['id'], sign)
+            data = (leaf_info or {}).get('data', {})
+            if data.get('course_id') and data.get('user_id'):
+                identity = (data['course_id'], data['user_id'])
+                self._progress_identities[key] = identity
+                return identity
+        return None
+
+    def prefilter_completed_videos(self, classroom_id, video_leafs, sign=None, max_workers=5, batch_size=50):
+        """在配置视频参数之前批量查询进度，剔除已完成（>=90%）的视频
+
+        返回 (待观看的视频列表, 已完成视频的skipped结果列表)。
+        进度接口支持多个 video_id 时按批查询，否则并发逐个查询。
+        """
+        identity = self._progress_identity(classroom_id, video_leafs, sign)
+        if identity is None:
+            logger.warning("无法获取课程/用户ID，跳过进度预筛选")
+            return video_leafs, []
+        course_id, user_id = identity
+
+        progress_map = {}
+        batches = [video_leafs[i:i + batch_size] for i in range(0, len(video_leafs), batch_size)]
+
+        remaining_batches = batches
+        if self._progress_batch_supported is None and batches:
+            # 第一批用来确认接口是否支持批量查询：只有多个 video_id 的请求确实返回了多个视频的进度才算支持，
+            # 否则保持未知，下次（例如下一个课堂）再确认；这次返回的进度照常使用
+            first = batches[0]
+            data = self.get_watch_progress_map(classroom_id, course_id, user_id, [v['id'] for v in first]) or {}
+            progress_map.update(data)
+            found = sum(1 for v in first if str(v['id']) in data)
+            if len(first) > 1 and found > 1:
+                self._progress_batch_supported = True
+            remaining_batches = batches[1:]
+
+        if self._progress_batch_supported:
+            for batch in remaining_batches:
+                progress_map.update(
+                    self.get_watch_progress_map(classroom_id, course_id, user_id, [v['id'] for v in batch]) or {}
+                )
+        else:
+            # 未确认支持批量查询时逐个查询，已经拿到进度的视频不再重复查询
+            missing = [v for v in video_leafs if str(v['id']) not in progress_map]
+            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='progress') as executor:
+                for data in executor.map(
+                    lambda v: self.get_watch_progress_map(classroom_id, course_id, user_id, [v['id']]),
+                    missing
+                ):
+                    progress_map.update(data or {})
+
+        remaining = []
+        skipped = []
+        for video_info in video_leafs:
+            progress_data = progress_map.get(str(video_info['id']))
+            rate = (progress_data or {}).get('rate', 0) or 0
+            if rate >= COMPLETION_THRESHOLD:
+                skipped.append({'status': 'skipped', 'video_info': video_info, 'rate': rate})
+                # 记入运行日志，中断后续看时不再查询和配置这些视频
+                self._journal(classroom_id, video_info['id'], 'finished', rate=rate)
+            else:
+                remaining.append(video_info)
+                if progress_data is not None:
+                    # 留给准备阶段使用，开始观看前不再查询一次进度
+                    self._prefetched_progress[(str(classroom_id), str(video_info['id']))] = progress_data
+
+        mode = '批量' if self._progress_batch_supported else '并发'
+        logger.info("进度预筛选（%s查询）: %s 个视频已完成，%s 个待观看", mode, len(skipped), len(remaining))
+        return remaining, skipped
+
+    def smart_watch_video(self, speed=1.5, interval=5, progress_info=None):
+        """智能观看当前会话的视频（从上次停止的位置开始），progress_info 含义同 smart_watch_plan"""
+        return self.run_watch_plan(self.video_session,
+                                   self.smart_watch_plan(self.video_session, speed=speed, interval=interval,
+                                                         progress_info=progress_info))
+
+    def smart_watch_plan(self, video_session, speed=1.5, interval=5, progress_info=None):
+        """智能观看流程生成器，动作约定同 watch_plan
+
+        progress_info 为预取阶段已经获取的进度，传入时不再重复查询。
+        """
         # 获取当前进度
-        progress_info = self.get_current_progress_info()
+        if progress_info is None:
+            progress_info = self.parse_progress_info(video_session, (yield ('progress',)))
         if not progress_info:
-            print("无法获取进度信息，从头开始播放")
+            logger.warning("无法获取进度信息，从头开始播放")
             start_position = 0
         else:
             rate = progress_info['rate']
             last_point = progress_info['last_point']
             duration = progress_info['duration']
 
-            print(f"当前进度: {rate:.2%}, 最后位置: {last_point:.1f}s, 总时长: {duration}")
+            logger.info("当前进度: %.2f%%, 最后位置: %.1fs, 总时长: %s", rate * 100, last_point, duration)
 
-            if rate >= 0.9:  # 如果已经看了90%以上
-                print("视频已基本看完，无需继续观看")
+            if rate >= COMPLETION_THRESHOLD:  # 如果已经看了90%以上
+                logger.info("视频已基本看完，无需继续观看")
                 return True
 
             # 从最后位置开始播放
             start_position = max(0, last_point - 10)  # 往前退10秒，避免遗漏
 
         # 开始模拟观看
-        return self.simulate_video_watching(
+        return (yield from self.watch_plan(
+            video_session,
             speed=speed,
             interval=interval,
             start_position=start_position
-        )
+        ))
+
+    def discover_videos(self, classroom_id, sign=None, debug=False):
+        """获取视频列表；运行日志中有上次未完成运行的发现结果时直接复用"""
+        if self.journal is not None:
+            videos = self.journal.discovered_videos(classroom_id)
+            if videos:
+                logger.info("从运行日志恢复视频列表，共 %s 个视频", len(videos))
+                return videos
+
+        videos = self.get_video_leaf_list(classroom_id, sign, debug=debug)
+        if videos and self.journal is not None:
+            self.journal.record_discovery(classroom_id, videos)
+        return videos
+
+    def select_videos_to_watch(self, classroom_id, video_leafs, sign=None, skip_completed=True, max_workers=5):
+        """确定需要处理的视频，返回 (待处理视频列表, skipped结果列表)
+
+        运行日志中已完成的视频直接跳过，其余视频（中断时正在处理的、失败的、还没有记录的）
+        都做进度预筛选，服务器上已完成的视频不再配置参数和探测时长。
+        """
+        states = self.journal.leaf_states(classroom_id) if self.journal is not None else {}
+
+        skipped = []
+        to_check = []
+        in_flight = 0
+        for video_info in video_leafs:
+            entry = states.get(str(video_info['id']))
+            if entry and entry['state'] == 'finished':
+                skipped.append({'status': 'skipped', 'video_info': video_info, 'rate': entry.get('rate', 1.0)})
+                continue
+            if entry and entry['state'] in RunJournal.IN_FLIGHT_STATES:
+                in_flight += 1
+            to_check.append(video_info)
 
-    def watch_single_video_worker(self, video_info, classroom_id, sign, speed, interval, skip_completed, worker_id):
-        """单个视频观看的工作函数，用于并发执行"""
+        pending = to_check
+        if skip_completed and to_check:
+            pending, prefiltered = self.prefilter_completed_videos(classroom_id, to_check, sign, max_workers=max_workers)
+            skipped.extend(prefiltered)
+
+        if states:
+            logger.info("从运行日志恢复: %s 个视频已完成，%s 个中断时正在处理，%s 个待处理", len(skipped), in_flight, len(pending))
+        return pending, skipped
+
+    def prepare_video(self, video_info, classroom_id, sign, skip_completed, worker_id):
+        """预取阶段：配置视频参数并获取当前进度
+
+        返回 {'status': 'ready', 'session', 'progress_info', 'video_info'}，
+        或与 watch_single_video_worker 相同格式的 failed/skipped 结果。
+        """
         leaf_id = video_info['id']
-        video_name = video_info['name']
-        chapter_name = video_info['chapter_name']
+        with log_context(worker=f'prefetch-{worker_id}', leaf=leaf_id):
+            video_name = video_info['name']
+
+            if self.cancel_token.cancelled:
+                return {'status': 'cancelled', 'video_info': video_info}
+
+            logger.info("[Prefetch-%s] 开始准备视频: %s (ID: %s)", worker_id, video_name, leaf_id)
+
+            try:
+                # 为该视频创建独立的观看会话，所有会话共用本实例的连接和请求头
+                video_session = self.configure_video_session(classroom_id, leaf_id, sign)
+                if video_session is None:
+                    logger.warning("[Prefetch-%s] ❌ 配置视频参数失败: %s", worker_id, video_name)
+                    self._journal(classroom_id, leaf_id, 'failed', reason='参数配置失败')
+                    return {'status': 'failed', 'video_info': video_info, 'reason': '参数配置失败'}
+
+                # 预筛选已查过的视频直接使用当时的进度
+                progress_info = self.take_prefetched_progress(video_session) or self.get_current_progress_info(video_session)
+                if progress_info is None:
+                    # 服务器进度不可用时，使用运行日志中记录的最后位置续看
+                    progress_info = self.journal_progress_info(classroom_id, leaf_id, video_session.duration)
+
+                # 检查是否已完成
+                if skip_completed and progress_info and progress_info['rate'] >= COMPLETION_THRESHOLD:
+                    logger.info("[Prefetch-%s] ✅ 视频已完成 (%.1f%%): %s", worker_id, progress_info['rate'] * 100, video_name)
+                    self._journal(classroom_id, leaf_id, 'finished', rate=progress_info['rate'])
+                    return {'status': 'skipped', 'video_info': video_info, 'rate': progress_info['rate']}
 
-        print(f"[Worker-{worker_id}] 开始处理视频: {video_name} (ID: {leaf_id})")
+                self._journal(classroom_id, leaf_id, 'configured')
+                return {'status': 'ready', 'session': video_session, 'progress_info': progress_info, 'video_info': video_info}
 
-        try:
-            # 创建独立的工作实例
-            worker = self.create_worker_instance()
+            except Exception as e:
+                logger.warning("[Prefetch-%s] ❌ 准备视频时发生异常: %s, 错误: %s", worker_id, video_name, str(e))
+                self._journal(classroom_id, leaf_id, 'failed', reason=f'异常: {str(e)}')
+                return {'status': 'failed', 'video_info': video_info, 'reason': f'异常: {str(e)}'}
 
-            # 自动配置视频参数
-            if not worker.auto_configure_from_ids(classroom_id, leaf_id, sign):
-                print(f"[Worker-{worker_id}] ❌ 配置视频参数失败: {video_name}")
-                return {'status': 'failed', 'video_info': video_info, 'reason': '参数配置失败'}
+    def journal_progress_info(self, classroom_id, leaf_id, duration):
+        """根据运行日志中 watching 状态的最后位置构造进度信息，没有记录时返回None"""
+        if self.journal is None or not duration:
+            return None
+        entry = self.journal.leaf_states(classroom_id).get(str(leaf_id))
+        if not entry or entry.get('state') != 'watching':
+            return None
+        last_point = entry.get('position', 0)
+        return {'rate': last_point / duration, 'last_point': last_point, 'duration': duration}
+
+    def record_watch_result(self, classroom_id, result):
+        """把观看阶段的结果写入运行日志"""
+        leaf_id = result['video_info']['id']
+        if result['status'] == 'success':
+            self._journal(classroom_id, leaf_id, 'finished', rate=1.0)
+        elif result['status'] == 'failed':
+            self._journal(classroom_id, leaf_id, 'failed', reason=result.get('reason', '未知原因'))
+
+    def watch_prepared_video(self, prepared, speed, interval, worker_id):
+        """观看阶段：使用预取阶段创建的会话观看视频"""
+        video_info = prepared['video_info']
+        with log_context(worker=f'worker-{worker_id}', leaf=video_info['id']):
+            video_name = video_info['name']
+            video_session = prepared['session']
+
+            try:
+                # 开始观看视频
+                logger.info("[Worker-%s] 🎬 开始观看视频: %s", worker_id, video_name)
+                plan = self.smart_watch_plan(video_session, speed=speed, interval=interval,
+                                             progress_info=prepared['progress_info'])
+                if self.run_watch_plan(video_session, plan):
+                    logger.info("[Worker-%s] ✅ 视频观看完成: %s", worker_id, video_name)
+                    result = {'status': 'success', 'video_info': video_info}
+                elif self.cancel_token.cancelled:
+                    logger.info("[Worker-%s] ⏹️ 观看已取消: %s", worker_id, video_name)
+                    result = {'status': 'cancelled', 'video_info': video_info}
+                else:
+                    logger.warning("[Worker-%s] ❌ 视频观看失败: %s", worker_id, video_name)
+                    result = {'status': 'failed', 'video_info': video_info, 'reason': '观看失败'}
 
-            # 检查是否已完成
-            if skip_completed:
-                progress_info = worker.get_current_progress_info()
-                if progress_info and progress_info['rate'] >= 0.9:
-                    print(f"[Worker-{worker_id}] ✅ 视频已完成 ({progress_info['rate']:.1%}): {video_name}")
-                    return {'status': 'skipped', 'video_info': video_info, 'rate': progress_info['rate']}
+            except Exception as e:
+                logger.warning("[Worker-%s] ❌ 处理视频时发生异常: %s, 错误: %s", worker_id, video_name, str(e))
+                result = {'status': 'failed', 'video_info': video_info, 'reason': f'异常: {str(e)}'}
 
-            # 开始观看视频
-            print(f"[Worker-{worker_id}] 🎬 开始观看视频: {video_name}")
-            if worker.smart_watch_video(speed=speed, interval=interval):
-                print(f"[Worker-{worker_id}] ✅ 视频观看完成: {video_name}")
-                return {'status': 'success', 'video_info': video_info}
-            else:
-                print(f"[Worker-{worker_id}] ❌ 视频观看失败: {video_name}")
-                return {'status': 'failed', 'video_info': video_info, 'reason': '观看失败'}
+            self.record_watch_result(video_session.classroom_id, result)
+            return result
 
-        except Exception as e:
-            print(f"[Worker-{worker_id}] ❌ 处理视频时发生异常: {video_name}, 错误: {str(e)}")
-            return {'status': 'failed', 'video_info': video_info, 'reason': f'异常: {str(e)}'}
+    def watch_single_video_worker(self, video_info, classroom_id, sign, speed, interval, skip_completed, worker_id):
+        """单个视频观看的工作函数，用于并发执行"""
+        prepared = self.prepare_video(video_info, classroom_id, sign, skip_completed, worker_id)
+        if prepared['status'] != 'ready':
+            return prepared
+        return self.watch_prepared_video(prepared, speed, interval, worker_id)
 
-    def concurrent_watch_videos(self, classroom_id, sign=None, speed=1.5, interval=5, skip_completed=True, max_workers=3, test_mode=False, test_video_count=5):
-        """并发观看课程中的所有视频"""
-        print(f"开始并发观看视频... (最大并发数: {max_workers})")
+    def concurrent_watch_videos(self, classroom_id, sign=None, speed=1.5, interval=5, skip_completed=True, max_workers=3, test_mode=False, test_video_count=5, prefetch_workers=5):
+        """并发观看课程中的所有视频
 
-        # 获取所有视频列表
-        video_leafs = self.get_video_leaf_list(classroom_id, sign)
+        元数据和进度由独立的预取线程池（prefetch_workers）提前获取，
+        观看并发数（max_workers）只用于真正需要观看的视频。
+        """
+        summaries = self.watch_classrooms(
+            [(classroom_id, sign)], speed=speed, interval=interval, skip_completed=skip_completed,
+            max_workers=max_workers, test_mode=test_mode, test_video_count=test_video_count,
+            prefetch_workers=prefetch_workers
+        )
+        return summaries.get(classroom_id)
+
+    def _start_classroom_run(self, classroom_id, sign, skip_completed, test_mode, test_video_count,
+                             prefetch_workers, record):
+        """发现课堂视频并剔除已完成的视频，返回该课堂的运行状态；没有视频时返回None"""
+        video_leafs = self.discover_videos(classroom_id, sign)
 
         if not video_leafs:
-            print("没有找到任何视频")
-            return
+            logger.warning("没有找到任何视频")
+            return None
 
         # 测试模式：只处理前几个视频
         if test_mode:
             video_leafs = video_leafs[:test_video_count]
-            print(f"🧪 测试模式：只处理前 {len(video_leafs)} 个视频")
+            logger.info("🧪 测试模式：只处理前 %s 个视频", len(video_leafs))
         else:
-            print(f"准备观看 {len(video_leafs)} 个视频")
+            logger.info("准备观看 %s 个视频", len(video_leafs))
 
-        success_count = 0
-        skip_count = 0
-        failed_count = 0
+        run = {
+            'classroom_id': classroom_id,
+            'sign': sign,
+            'total': len(video_leafs),
+            'completed': 0,
+            'success': 0,
+            'skipped': 0,
+            'failed': 0,
+            'cancelled': 0,
+        }
 
-        # 使用线程池并发处理
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # 提交所有任务
-            future_to_video = {
-                executor.submit(
-                    self.watch_single_video_worker,
-                    video_info,
-                    classroom_id,
-                    sign,
-                    speed,
-                    interval,
-                    skip_completed,
-                    i + 1
-                ): video_info
-                for i, video_info in enumerate(video_leafs)
-            }
+        # 先剔除已完成的视频（运行日志 + 进度预筛选），这些视频不再做任何元数据请求和时长探测
+        run['pending'], skipped_results = self.select_videos_to_watch(
+            classroom_id, video_leafs, sign, skip_completed, max_workers=prefetch_workers
+        )
+        for result in skipped_results:
+            record(run, result)
+        return run
+
+    def _record_watch_result(self, run, result, label):
+        """把单个视频的结果计入所属课堂的统计并打印进度"""
+        run['completed'] += 1
+        status = result['status']
+        video_name = result['video_info']['name']
+        position = (run['completed'], run['total'])
+
+        if status == 'success':
+            run['success'] += 1
+            logger.info("[%s] ✅ (%s/%s) 成功完成: %s", label, *position, video_name)
+        elif status == 'skipped':
+            run['skipped'] += 1
+            rate = result.get('rate', 0)
+            logger.info("[%s] ⏭️ (%s/%s) 跳过已完成 (%.1f%%): %s", label, *position, rate * 100, video_name)
+        elif status == 'cancelled':
+            run['cancelled'] += 1
+            logger.info("[%s] ⏹️ (%s/%s) 已取消: %s", label, *position, video_name)
+        else:
+            run['failed'] += 1
+            reason = result.get('reason', '未知原因')
+            logger.warning("[%s] ❌ (%s/%s) 失败 (%s): %s", label, *position, reason, video_name)
+
+    def _finish_classroom_run(self, run, title):
+        """写运行日志并打印单个课堂的统计，返回与 concurrent_watch_videos 相同格式的结果"""
+        # 运行结束（未中断）时下次都重新发现课程：全部成功则清除该课堂的记录，
+        # 有失败的视频时只清除发现结果，保留各视频状态；中断时全部保留，下次从日志续看
+        if run['cancelled'] == 0 and self.journal is not None:
+            if run['failed'] == 0:
+                self.journal.reset(run['classroom_id'])
+            else:
+                self.journal.forget_discovery(run['classroom_id'])
 
-            # 收集结果
-            completed_count = 0
-            for future in as_completed(future_to_video):
-                completed_count += 1
-                video_info = future_to_video[future]
+        logger.info("============================================================")
+        if run['cancelled']:
+            logger.info("%s已中断（%s）", title, self.cancel_token.reason)
+        else:
+            logger.info("%s完成！", title)
+        logger.info("总视频数: %s", run['total'])
+        logger.info("成功观看: %s", run['success'])
+        logger.info("跳过（已完成）: %s", run['skipped'])
+        logger.info("失败: %s", run['failed'])
+        if run['cancelled']:
+            logger.info("已取消: %s", run['cancelled'])
+        logger.info("============================================================")
 
-                try:
-                    result = future.result()
-                    status = result['status']
-                    video_name = result['video_info']['name']
-
-                    if status == 'success':
-                        success_count += 1
-                        print(f"[主线程] ✅ ({completed_count}/{len(video_leafs)}) 成功完成: {video_name}")
-                    elif status == 'skipped':
-                        skip_count += 1
-                        rate = result.get('rate', 0)
-                        print(f"[主线程] ⏭️ ({completed_count}/{len(video_leafs)}) 跳过已完成 ({rate:.1%}): {video_name}")
-                    else:
-                        failed_count += 1
-                        reason = result.get('reason', '未知原因')
-                        print(f"[主线程] ❌ ({completed_count}/{len(video_leafs)}) 失败 ({reason}): {video_name}")
+        return {
+            'total': run['total'],
+            'success': run['success'],
+            'skipped': run['skipped'],
+            'failed': run['failed'],
+            'cancelled': run['cancelled']
+        }
 
-                except Exception as e:
-                    failed_count += 1
-                    print(f"[主线程] ❌ ({completed_count}/{len(video_leafs)}) 处理结果时发生异常: {str(e)}")
+    def watch_classrooms(self, classrooms, speed=1.5, interval=5, skip_completed=True, max_workers=3,
+                         test_mode=False, test_video_count=5, prefetch_workers=5):
+        """并发观看多个课堂（同一账号）的所有视频
 
-                # 添加短暂延迟，避免请求过快
-                time.sleep(0.5)
+        classrooms 为 [(classroom_id, sign), ...]。所有课堂共用同一个预取线程池和观看线程池
+        （即同一份并发预算），以及本实例的连接池、限速器和调度器。
+        返回 {classroom_id: 与 concurrent_watch_videos 相同格式的结果}，没有视频的课堂为None。
+        """
+        multiple = len(classrooms) > 1
+        if multiple:
+            logger.info("开始并发观看 %s 个课堂的视频... (最大并发数: %s, 预取并发数: %s)", len(classrooms), max_workers, prefetch_workers)
+        else:
+            logger.info("开始并发观看视频... (最大并发数: %s, 预取并发数: %s)", max_workers, prefetch_workers)
 
-        print(f"\n{'='*60}")
-        print("并发观看完成！")
-        print(f"总视频数: {len(video_leafs)}")
-        print(f"成功观看: {success_count}")
-        print(f"跳过（已完成）: {skip_count}")
-        print(f"失败: {failed_count}")
-        print(f"{'='*60}")
+        def record(run, result):
+            self._record_watch_result(run, result, '主线程')
 
-        return {
-            'total': len(video_leafs),
-            'success': success_count,
-            'skipped': skip_count,
-            'failed': failed_count
-        }
+        summaries = {}
+        runs = []
+        for classroom_id, sign in classrooms:
+            if self.cancel_token.cancelled:
+                break
+            with log_context(classroom=classroom_id) if multiple else contextlib.nullcontext():
+                run = self._start_classroom_run(classroom_id, sign, skip_completed, test_mode, test_video_count,
+                                                prefetch_workers, record)
+            summaries[classroom_id] = None
+            if run is not None:
+                runs.append(run)
+
+        # 两级流水线：预取线程池负责元数据和进度，观看线程池只处理已准备好的视频
+        with ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix='prefetch') as prefetch_pool, \
+                ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='watch') as watch_pool:
+            future_to_video = {}
+            worker_ids = itertools.count(1)
+            for run in runs:
+                for video_info in run['pending']:
+                    worker_id = next(worker_ids)
+                    future = prefetch_pool.submit(
+                        self.prepare_video,
+                        video_info,
+                        run['classroom_id'],
+                        run['sign'],
+                        skip_completed,
+                        worker_id
+                    )
+                    future_to_video[future] = (run, video_info, worker_id)
+
+            # 收集结果，预取完成的视频立即交给观看线程池
+            pending = set(future_to_video)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    run, video_info, worker_id = future_to_video[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = {'status': 'failed', 'video_info': video_info, 'reason': f'异常: {str(e)}'}
+
+                    if result['status'] == 'ready' and self.cancel_token.cancelled:
+                        # 取消后不再开始新的观看
+                        record(run, {'status': 'cancelled', 'video_info': video_info})
+                    elif result['status'] == 'ready':
+                        watch_future = watch_pool.submit(self.watch_prepared_video, result, speed, interval, worker_id)
+                        future_to_video[watch_future] = (run, video_info, worker_id)
+                        pending.add(watch_future)
+                    else:
+                        record(run, result)
+
+        for run in runs:
+            title = f"课堂 {run['classroom_id']} 并发观看" if multiple else "并发观看"
+            summaries[run['classroom_id']] = self._finish_classroom_run(run, title)
+        return summaries
+
+    def async_watch_videos(self, classroom_id, sign=None, speed=1.5, interval=5, skip_completed=True, max_workers=3, test_mode=False, test_video_count=5, prefetch_workers=5):
+        """使用 asyncio 引擎并发观看课程中的所有视频，参数和返回值与 concurrent_watch_videos 相同"""
+        engine = AsyncWatchEngine(self, max_concurrent=max_workers, prefetch_concurrent=prefetch_workers)
+        return asyncio.run(engine.watch_videos(
+            classroom_id,
+            sign=sign,
+            speed=speed,
+            interval=interval,
+            skip_completed=skip_completed,
+            test_mode=test_mode,
+            test_video_count=test_video_count
+        ))
+
+    def async_watch_classrooms(self, classrooms, speed=1.5, interval=5, skip_completed=True, max_workers=3, test_mode=False, test_video_count=5, prefetch_workers=5):
+        """使用 asyncio 引擎并发观看多个课堂的视频，参数和返回值与 watch_classrooms 相同"""
+        engine = AsyncWatchEngine(self, max_concurrent=max_workers, prefetch_concurrent=prefetch_workers)
+        return asyncio.run(engine.watch_classrooms(
+            classrooms,
+            speed=speed,
+            interval=interval,
+            skip_completed=skip_completed,
+            test_mode=test_mode,
+            test_video_count=test_video_count
+        ))
 
     def batch_watch_videos(self, classroom_id, sign=None, speed=1.5, interval=5, skip_completed=True):
         """批量观看课程中的所有视频"""
-        print("开始批量观看视频...")
+        logger.info("开始批量观看视频...")
 
         # 获取所有视频列表
         video_leafs = self.get_video_leaf_list(classroom_id, sign)
 
         if not video_leafs:
-            print("没有找到任何视频")
+            logger.warning("没有找到任何视频")
             return
 
-        print(f"准备观看 {len(video_leafs)} 个视频")
+        logger.info("准备观看 %s 个视频", len(video_leafs))
 
         success_count = 0
         skip_count = 0
         failed_count = 0
 
+        # 先批量剔除已完成的视频
+        completed_ids = set()
+        if skip_completed:
+            _, skipped_results = self.prefilter_completed_videos(classroom_id, video_leafs, sign)
+            completed_ids = {result['video_info']['id'] for result in skipped_results}
+
         for i, video_info in enumerate(video_leafs, 1):
+            if self.cancel_token.cancelled:
+                logger.info("⏹️ 已取消，剩余视频不再处理")
+                break
             leaf_id = video_info['id']
             chapter_name = video_info['chapter_name']
 
-            print(f"\n{'='*60}")
-            print(f"正在处理第 {i}/{len(video_leafs)} 个视频")
-            print(f"视频ID: {leaf_id}")
-            print(f"章节: {chapter_name}")
-            print(f"{'='*60}")
+            if leaf_id in completed_ids:
+                logger.info("✅ 视频 %s 已完成，跳过", leaf_id)
+                skip_count += 1
+                continue
+
+            logger.info("============================================================")
+            logger.info("正在处理第 %s/%s 个视频", i, len(video_leafs))
+            logger.info("视频ID: %s", leaf_id)
+            logger.info("章节: %s", chapter_name)
+            logger.info("============================================================")
 
             # 自动配置视频参数
             if not self.auto_configure_from_ids(classroom_id, leaf_id, sign):
-                print(f"❌ 配置视频参数失败，跳过视频 {leaf_id}")
+                logger.warning("❌ 配置视频参数失败，跳过视频 %s", leaf_id)
                 failed_count += 1
                 continue
 
+            # 当前进度：预筛选已查过时直接使用，否则查询一次，观看流程不再重复查询
+            progress_info = self.take_prefetched_progress(self.video_session) or self.get_current_progress_info()
+
             # 检查是否已完成
-            if skip_completed:
-                progress_info = self.get_current_progress_info()
-                if progress_info and progress_info['rate'] >= 0.9:
-                    print(f"✅ 视频已完成 ({progress_info['rate']:.1%})，跳过")
-                    skip_count += 1
-                    continue
+            if skip_completed and progress_info and progress_info['rate'] >= COMPLETION_THRESHOLD:
+                logger.info("✅ 视频已完成 (%.1f%%)，跳过", progress_info['rate'] * 100)
+                skip_count += 1
+                continue
 
             # 开始观看视频
-            print(f"🎬 开始观看视频...")
-            if self.smart_watch_video(speed=speed, interval=interval):
-                print(f"✅ 视频观看完成")
+            logger.info("🎬 开始观看视频...")
+            if self.smart_watch_video(speed=speed, interval=interval, progress_info=progress_info):
+                logger.info("✅ 视频观看完成")
                 success_count += 1
+            elif self.cancel_token.cancelled:
+                logger.info("⏹️ 视频观看已取消")
             else:
-                print(f"❌ 视频观看失败")
+                logger.warning("❌ 视频观看失败")
                 failed_count += 1
 
-            # 添加短暂延迟，避免请求过快
-            time.sleep(2)
+        # 中断时未处理完的视频
+        cancelled_count = len(video_leafs) - success_count - skip_count - failed_count
 
-        print(f"\n{'='*60}")
-        print("批量观看完成！")
-        print(f"总视频数: {len(video_leafs)}")
-        print(f"成功观看: {success_count}")
-        print(f"跳过（已完成）: {skip_count}")
-        print(f"失败: {failed_count}")
-        print(f"{'='*60}")
+        logger.info("============================================================")
+        if cancelled_count:
+            logger.info("批量观看已中断（%s）", self.cancel_token.reason)
+        else:
+            logger.info("批量观看完成！")
+        logger.info("总视频数: %s", len(video_leafs))
+        logger.info("成功观看: %s", success_count)
+        logger.info("跳过（已完成）: %s", skip_count)
+        logger.info("失败: %s", failed_count)
+        if cancelled_count:
+            logger.info("已取消: %s", cancelled_count)
+        logger.info("============================================================")
 
         return {
             'total': len(video_leafs),
             'success': success_count,
             'skipped': skip_count,
-            'failed': failed_count
+            'failed': failed_count,
+            'cancelled': cancelled_count
         }
 
 
+class AsyncHttpClient:
+    """asyncio 引擎共享的HTTP客户端
+
+    安装了 httpx 时使用 httpx.AsyncClient（同时安装 h2 时启用 HTTP/2）；否则用挂载在
+    共享连接池上的 requests.Session，请求放到有界线程池中执行（只有网络I/O占用线程）。
+    多课堂运行时 classroomId 与账号cookies不同的课堂各用一个客户端，连接池仍然共享。
+    """
+
+    def __init__(self, cookies=None, max_connections=10, timeout=10, transport=None, metrics=None,
+                 retry_policy=None, rate_limiter=None, cancel_token=None):
+        self.timeout = timeout
+        self.cookies = dict(cookies or {})
+        self.cancel_token = cancel_token or CancellationToken()
+        self.metrics = metrics or RequestMetrics.get_default()
+        self.retry_policy = retry_policy or RetryPolicy.get_default()
+        self.rate_limiter = rate_limiter or RateLimiter.get_default()
+        # 课堂ID -> 该课堂专用的 httpx.AsyncClient 或 requests.Session
+        self.classroom_clients = {}
+        if httpx is not None:
+            self.transport = httpx.AsyncHTTPTransport(
+                http2=importlib.util.find_spec('h2') is not None,
+                limits=httpx.Limits(max_connections=max_connections,
+                                    max_keepalive_connections=max_connections)
+            )
+            self.client = self._new_httpx_client(self.cookies)
+            self.session = None
+            self.executor = None
+        else:
+            self.transport = transport or SharedTransport.get_default()
+            self.client = None
+            self.session = self.transport.new_session()
+            self.session.cookies.update(self.cookies)
+            self.executor = ThreadPoolExecutor(max_workers=max_connections)
+
+    def _new_httpx_client(self, cookies):
+        return httpx.AsyncClient(cookies=cookies, timeout=self.timeout, transport=self.transport)
+
+    def _client_for(self, classroom_id):
+        """返回发送该课堂请求的客户端（httpx.AsyncClient 或 requests.Session），规则与
+        YuketangHeartbeat._session_for 相同"""
+        default = self.client if self.client is not None else self.session
+        overrides = _classroom_cookie_overrides(self.cookies, classroom_id)
+        if overrides is None:
+            return default
+        key = str(classroom_id)
+        client = self.classroom_clients.get(key)
+        if client is None:
+            cookies = dict(self.cookies, **overrides)
+            if self.client is not None:
+                client = self._new_httpx_client(cookies)
+            else:
+                client = self.transport.new_session()
+                client.cookies.update(cookies)
+            self.classroom_clients[key] = client
+        return client
+
+    async def _send(self, method, url, headers, params, data, classroom_id=None):
+        client = self._client_for(classroom_id)
+        if self.client is not None:
+            return await client.request(method, url, headers=headers, params=params, content=data)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            lambda: client.request(method, url, headers=headers, params=params,
+                                   data=data, timeout=self.timeout)
+        )
+
+    async def request(self, method, url, headers=None, params=None, data=None, endpoint='other',
+                      classroom_id=None):
+        """发送请求，返回 (状态码, JSON数据或None)；按 endpoint 记录请求统计，
+        重试和熔断规则与 YuketangHeartbeat._request 相同；classroom_id 决定请求携带的课堂 cookies"""
+        attempt = 0
+        while True:
+            try:
+                probe = self.retry_policy.before_request(endpoint)
+            except CircuitOpenError:
+                self.metrics.observe(endpoint, 'CircuitOpen', 0.0)
+                raise
+
+            try:
+                await self.rate_limiter.acquire_async(endpoint)
+                response, error = None, None
+                start = time.perf_counter()
+                try:
+                    response = await self._send(method, url, headers, params, data, classroom_id)
+                except Exception as e:
+                    error = e
+                    self.metrics.observe(endpoint, type(e).__name__, time.perf_counter() - start)
+                else:
+                    self.metrics.observe(endpoint, response.status_code, time.perf_counter() - start,
+                                         bytes_in=len(response.content or b''), bytes_out=len(data) if data else 0)
+
+                delay = self.retry_policy.next_delay(endpoint, attempt, response, error)
+            finally:
+                # 协程被取消（CancelledError）时同样结束探测
+                if probe:
+                    self.retry_policy.end_probe(endpoint)
+            if delay is None or self.cancel_token.cancelled:
+                break
+            self.metrics.record_retry(endpoint)
+            if await self.cancel_token.wait_async(delay):
+                break
+            attempt += 1
+
+        if error is not None:
+            raise error
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, None
+
+    async def aclose(self):
+        if self.client is not None:
+            for client in self.classroom_clients.values():
+                await client.aclose()
+            await self.client.aclose()
+        else:
+            self.executor.shutdown(wait=False)
+            for session in self.classroom_clients.values():
+                session.close()
+            self.session.close()
+
+
+class AsyncWatchEngine:
+    """基于 asyncio 的视频观看引擎：每个视频是一个协程，共享一个HTTP客户端，
+    并发数由信号量限制（对应 MAX_CONCURRENT_VIDEOS）"""
+
+    def __init__(self, heartbeat, max_concurrent=3, prefetch_concurrent=5):
+        self.heartbeat = heartbeat
+        self.max_concurrent = max_concurrent
+        self.prefetch_concurrent = prefetch_concurrent
+        self.client = None
+
+    async def _request_json(self, endpoint, method, request, error_label, classroom_id=None):
+        """发送 build_*_request 构造的请求，成功返回JSON，失败打印并返回None"""
+        url, headers, extra = request
+        try:
+            if method == 'POST':
+                status, data = await self.client.request(method, url, headers=headers, data=extra,
+                                                         endpoint=endpoint, classroom_id=classroom_id)
+            else:
+                status, data = await self.client.request(method, url, headers=headers, params=extra,
+                                                         endpoint=endpoint, classroom_id=classroom_id)
+        except Exception as e:
+            logger.warning("%s: %s", error_label, e)
+            return None
+
+        if status != 200:
+            logger.warning("%s，状态码: %s", error_label, status)
+            return None
+        return data
+
+    async def _run_plan(self, video_session, plan):
+        """异步执行 watch_plan 产生的动作，语义与 YuketangHeartbeat.run_watch_plan 相同"""
+        reply = None
+        scheduler = self.heartbeat.scheduler
+        cancel_token = self.heartbeat.cancel_token
+        scheduled = None
+        try:
+            while True:
+                try:
+                    action = plan.send(reply)
+                except StopIteration as stop:
+                    return stop.value
+
+                kind = action[0]
+                if kind == 'heartbeat':
+                    reply = await self._request_json(
+                        'heartbeat', 'POST', self.heartbeat.build_heartbeat_request(video_session, action[1]), "发送心跳失败",
+                        video_session.classroom_id)
+                elif kind == 'sleep':
+                    if cancel_token.cancelled:
+                        pass
+                    elif scheduler is not None:
+                        if scheduled is None:
+                            scheduled = scheduler.register(action[1])
+                            cancel_token.add_callback(scheduled.fire)
+                        await scheduler.wait_async(scheduled)
+                    else:
+                        await cancel_token.wait_async(action[1])
+                    reply = None
+                elif kind == 'progress':
+                    reply = await self._request_json(
+                        'progress', 'GET', self.heartbeat.build_progress_request(video_session), "获取进度失败",
+                        video_session.classroom_id)
+                else:
+                    raise ValueError(f"未知的观看动作: {kind}")
+        finally:
+            if scheduled is not None:
+                cancel_token.remove_callback(scheduled.fire)
+                scheduler.unregister(scheduled)
+
+    async def watch_single_video(self, prefetch_semaphore, semaphore, video_info, classroom_id, sign, speed,
+                                 interval, skip_completed, worker_id):
+        """单个视频的观看协程，返回值与 watch_single_video_worker 相同"""
+        # 预取阶段：元数据配置仍走同步接口，放到线程中执行，不占用观看并发数
+        with log_context(worker=f'task-{worker_id}', leaf=video_info['id']):
+            async with prefetch_semaphore:
+                prepared = await asyncio.to_thread(
+                    self.heartbeat.prepare_video, video_info, classroom_id, sign, skip_completed, worker_id
+                )
+            if prepared['status'] != 'ready':
+                return prepared
+
+            video_name = video_info['name']
+            video_session = prepared['session']
+
+            async with semaphore:
+                try:
+                    logger.info("[Task-%s] 🎬 开始观看视频: %s", worker_id, video_name)
+                    plan = self.heartbeat.smart_watch_plan(video_session, speed=speed, interval=interval,
+                                                           progress_info=prepared['progress_info'])
+                    if await self._run_plan(video_session, plan):
+                        logger.info("[Task-%s] ✅ 视频观看完成: %s", worker_id, video_name)
+                        result = {'status': 'success', 'video_info': video_info}
+                    elif self.heartbeat.cancel_token.cancelled:
+                        logger.info("[Task-%s] ⏹️ 观看已取消: %s", worker_id, video_name)
+                        result = {'status': 'cancelled', 'video_info': video_info}
+                    else:
+                        logger.warning("[Task-%s] ❌ 视频观看失败: %s", worker_id, video_name)
+                        result = {'status': 'failed', 'video_info': video_info, 'reason': '观看失败'}
+
+                except Exception as e:
+                    logger.warning("[Task-%s] ❌ 处理视频时发生异常: %s, 错误: %s", worker_id, video_name, str(e))
+                    result = {'status': 'failed', 'video_info': video_info, 'reason': f'异常: {str(e)}'}
+
+            self.heartbeat.record_watch_result(classroom_id, result)
+            return result
+
+    async def watch_videos(self, classroom_id, sign=None, speed=1.5, interval=5, skip_completed=True,
+                           test_mode=False, test_video_count=5):
+        """异步并发观看课程中的所有视频，返回值与 concurrent_watch_videos 相同"""
+        summaries = await self.watch_classrooms([(classroom_id, sign)], speed=speed, interval=interval,
+                                                skip_completed=skip_completed, test_mode=test_mode,
+                                                test_video_count=test_video_count)
+        return summaries.get(classroom_id)
+
+    async def watch_classrooms(self, classrooms, speed=1.5, interval=5, skip_completed=True,
+                               test_mode=False, test_video_count=5):
+        """异步并发观看多个课堂的视频，所有课堂共用同一组信号量和HTTP客户端，
+        返回值与 YuketangHeartbeat.watch_classrooms 相同"""
+        heartbeat = self.heartbeat
+        multiple = len(classrooms) > 1
+        if multiple:
+            logger.info("开始异步并发观看 %s 个课堂的视频... (最大并发数: %s)", len(classrooms), self.max_concurrent)
+        else:
+            logger.info("开始异步并发观看视频... (最大并发数: %s)", self.max_concurrent)
+
+        def record(run, result):
+            heartbeat._record_watch_result(run, result, '主协程')
+
+        def start_run(classroom_id, sign):
+            with log_context(classroom=classroom_id) if multiple else contextlib.nullcontext():
+                return heartbeat._start_classroom_run(classroom_id, sign, skip_completed, test_mode,
+                                                      test_video_count, self.prefetch_concurrent, record)
+
+        summaries = {}
+        runs = []
+        for classroom_id, sign in classrooms:
+            if heartbeat.cancel_token.cancelled:
+                break
+            run = await asyncio.to_thread(start_run, classroom_id, sign)
+            summaries[classroom_id] = None
+            if run is not None:
+                runs.append(run)
+        if not runs:
+            return summaries
+
+        self.client = AsyncHttpClient(
+            cookies=heartbeat.session.cookies.get_dict(),
+            max_connections=max(self.max_concurrent, 1),
+            transport=heartbeat.transport,
+            metrics=heartbeat.metrics,
+            retry_policy=heartbeat.retry_policy,
+            rate_limiter=heartbeat.rate_limiter,
+            cancel_token=heartbeat.cancel_token
+        )
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+        prefetch_semaphore = asyncio.Semaphore(self.prefetch_concurrent)
+
+        try:
+            task_runs = {}
+            worker_ids = itertools.count(1)
+            for run in runs:
+                for video_info in run['pending']:
+                    task = asyncio.create_task(self.watch_single_video(
+                        prefetch_semaphore, semaphore, video_info, run['classroom_id'], run['sign'], speed, interval,
+                        skip_completed, next(worker_ids)
+                    ))
+                    task_runs[task] = run
+
+            pending = set(task_runs)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    record(task_runs[task], task.result())
+        finally:
+            await self.client.aclose()
+
+        for run in runs:
+            title = f"课堂 {run['classroom_id']} 异步并发观看" if multiple else "异步并发观看"
+            summaries[run['classroom_id']] = heartbeat._finish_classroom_run(run, title)
+        return summaries
+
+
+def parse_classrooms(value):
+    """解析 CLASSROOMS 配置："课堂ID:SIGN,课堂ID:SIGN,..."，SIGN 可省略，返回 [(classroom_id, sign), ...]"""
+    classrooms = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        classroom_id, _, sign = item.partition(':')
+        classrooms.append((int(classroom_id.strip()), sign.strip() or None))
+    return classrooms
+
+
+def install_shutdown_handlers(cancel_token, timeout, log_listener=None):
+    """第一次收到 SIGINT/SIGTERM 时取消所有会话：正在观看的会话发出暂停心跳、保存进度，
+    然后照常输出（部分）统计并退出。timeout 秒后仍未退出，或再次收到信号时立即结束进程。"""
+
+    def force_exit(code):
+        if log_listener is not None:
+            log_listener.stop()
+        os._exit(code)
+
+    def on_timeout():
+        logger.error("%s秒内未能完成退出，强制结束进程", timeout)
+        force_exit(1)
+
+    def handle(signum, frame):
+        name = signal.Signals(signum).name
+        if cancel_token.cancelled:
+            os._exit(128 + signum)
+        logger.warning("收到 %s，正在停止：发送暂停心跳并保存进度（再次按 Ctrl-C 立即退出）", name)
+        # 取消回调需要获取锁，放到单独线程执行，避免在信号处理函数中死锁
+        threading.Thread(target=cancel_token.cancel, args=(f'收到 {name}',), name='shutdown', daemon=True).start()
+        if timeout > 0:
+            timer = threading.Timer(timeout, on_timeout)
+            timer.daemon = True
+            timer.start()
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, handle)
+
+
 def main():
     """主函数，演示如何使用心跳机制"""
 
     # 从环境变量加载配置
     classroom_id = int(os.getenv('CLASSROOM_ID', 12345678))
     sign = os.getenv('SIGN')
+    # 多个课堂：CLASSROOMS="课堂ID:SIGN,课堂ID:SIGN"，设置后忽略 CLASSROOM_ID/SIGN
+    classrooms = parse_classrooms(os.getenv('CLASSROOMS', '')) or [(classroom_id, sign)]
+    classroom_id = classrooms[0][0]
     university_id = int(os.getenv('UNIVERSITY_ID', 1234))
     csrf_token = os.getenv('CSRF_TOKEN', 'your_csrf_token_here')
     session_id = os.getenv('SESSION_ID', 'your_session_id_here')
+    base_url = os.getenv('YUKETANG_BASE_URL', DEFAULT_BASE_URL)
 
     # 视频观看配置
     video_speed = float(os.getenv('VIDEO_SPEED', 1.5))
     heartbeat_interval = int(os.getenv('HEARTBEAT_INTERVAL', 5))
     max_concurrent_videos = int(os.getenv('MAX_CONCURRENT_VIDEOS', 3))
+    prefetch_concurrency = int(os.getenv('PREFETCH_CONCURRENCY', 5))
     skip_completed = os.getenv('SKIP_COMPLETED', 'true').lower() == 'true'
     test_mode = os.getenv('TEST_MODE', 'false').lower() == 'true'
     test_video_count = int(os.getenv('TEST_VIDEO_COUNT', 5))
     use_concurrent = os.getenv('USE_CONCURRENT', 'true').lower() == 'true'
+    use_async = os.getenv('USE_ASYNC', 'false').lower() == 'true'
     debug = os.getenv('DEBUG', 'false').lower() == 'true'
 
+    # 日志配置：DEBUG=true 时默认输出调试级别日志
+    log_level = os.getenv('LOG_LEVEL', 'DEBUG' if debug else 'INFO').upper()
+    log_json_file = os.getenv('LOG_JSON_FILE', '')
+    log_listener = setup_logging(log_level, log_json_file or None)
+    # 退出时等待监听线程写完队列中剩余的日志
+    atexit.register(log_listener.stop)
+
     # 图文观看配置
     auto_richtext = os.getenv('AUTO_RICHTEXT', 'false').lower() == 'true'
     richtext_stay_seconds = int(os.getenv('RICHTEXT_STAY_SECONDS', 3))
     richtext_skip_delay = float(os.getenv('RICHTEXT_SKIP_DELAY', 1))
-
-    # 设置cookies（从环境变量获取）
+    richtext_concurrency = int(os.getenv('RICHTEXT_CONCURRENCY', 1))
+    richtext_prescan_concurrency = int(os.getenv('RICHTEXT_PRESCAN_CONCURRENCY', 5))
+
+    # 元数据缓存配置
+    metadata_cache_enabled = os.getenv('METADATA_CACHE', 'true').lower() == 'true'
+    metadata_cache_file = os.getenv('METADATA_CACHE_FILE', '.yuketang_cache/metadata.json')
+    metadata_cache_ttl = int(os.getenv('METADATA_CACHE_TTL', 86400))
+    playurl_cache_ttl = int(os.getenv('PLAYURL_CACHE_TTL', 3600))
+    duration_cache_enabled = os.getenv('DURATION_CACHE', 'true').lower() == 'true'
+    duration_cache_file = os.getenv('DURATION_CACHE_FILE', '.yuketang_cache/durations.json')
+    run_journal_enabled = os.getenv('RUN_JOURNAL', 'true').lower() == 'true'
+    run_journal_file = os.getenv('RUN_JOURNAL_FILE', '.yuketang_cache/journal.jsonl')
+
+    # 请求统计配置
+    metrics_file = os.getenv('METRICS_FILE', '')
+    metrics_port = int(os.getenv('METRICS_PORT', 0))
+
+    # 心跳合并配置
+    heartbeat_batch_size = int(os.getenv('HEARTBEAT_BATCH_SIZE', 10))
+    heartbeat_flush_interval = float(os.getenv('HEARTBEAT_FLUSH_INTERVAL', 0))
+
+    # Ctrl-C / SIGTERM：先优雅停止，超过 SHUTDOWN_TIMEOUT 秒强制退出
+    shutdown_timeout = float(os.getenv('SHUTDOWN_TIMEOUT', 30))
+    cancel_token = CancellationToken()
+    install_shutdown_handlers(cancel_token, shutdown_timeout, log_listener)
+
+    # 设置cookies（从环境变量获取）；classroomId 取第一个课堂，其他课堂的请求发送时改写为各自的课堂ID
     cookies = {
         'login_type': 'WX',
         'csrftoken': csrf_token,
@@ -1381,71 +4033,170 @@ def main():
         'platform_type': '1'
     }
 
+    # 元数据磁盘缓存：重启后无需重新请求已获取过的leaf元数据
+    metadata_cache = None
+    if metadata_cache_enabled:
+        metadata_cache = MetadataCache(
+            metadata_cache_file,
+            ttl=metadata_cache_ttl,
+            ttl_overrides={'playurl': playurl_cache_ttl}
+        )
+        # 修改按间隔批量写盘，退出时写入剩余部分
+        atexit.register(metadata_cache.flush)
+
+    # 视频时长缓存：每个视频在所有运行中最多探测一次
+    duration_cache = DurationCache(duration_cache_file) if duration_cache_enabled else None
+
+    # 运行日志：进程中断后下次运行从日志恢复
+    journal = RunJournal(run_journal_file) if run_journal_enabled else None
+
+    # 进程级共享连接池
+    transport = SharedTransport.get_default()
+    # 中央心跳调度器：所有会话按绝对时间发送心跳
+    scheduler = HeartbeatScheduler()
+    # 按接口的请求统计，长时间运行时可通过HTTP端点实时查看
+    metrics = RequestMetrics.get_default()
+    # 重试与熔断策略（RETRY_*、CIRCUIT_* 环境变量）
+    retry_policy = RetryPolicy.get_default()
+    # 全局请求限速（RATE_LIMIT_* 环境变量），所有观看会话共享；心跳和进度的默认速率按并发数估算
+    rate_limiter = RateLimiter.get_default(max_concurrent_videos, heartbeat_interval)
+    heartbeat_rate = rate_limiter.rate('heartbeat')
+    if heartbeat_rate is not None and heartbeat_rate * heartbeat_interval < max_concurrent_videos:
+        logger.warning("RATE_LIMIT_HEARTBEAT=%s 最多支撑约 %s 个会话按 %s 秒间隔发送心跳，低于并发数 %s，部分会话将等待限速",
+                       heartbeat_rate, int(heartbeat_rate * heartbeat_interval), heartbeat_interval, max_concurrent_videos)
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
+        logger.info("请求统计: http://127.0.0.1:%s/metrics (JSON: /metrics.json)", metrics_port)
+
     # 创建心跳对象
-    heartbeat = YuketangHeartbeat(cookies)
+    heartbeat = YuketangHeartbeat(
+        cookies,
+        metadata_cache=metadata_cache,
+        duration_cache=duration_cache,
+        transport=transport,
+        scheduler=scheduler,
+        journal=journal,
+        base_url=base_url,
+        metrics=metrics,
+        retry_policy=retry_policy,
+        rate_limiter=rate_limiter,
+        heartbeat_batch_size=heartbeat_batch_size,
+        heartbeat_flush_interval=heartbeat_flush_interval,
+        cancel_token=cancel_token
+    )
 
     # 首先测试获取视频列表
-    print("正在获取视频列表...")
+    logger.info("正在获取视频列表...")
     # 需要先配置基本参数才能调用API
-    heartbeat.video_params = {
-        'uv_id': university_id,
-        'university_id': university_id,
-        'csrf_token': csrf_token
-    }
+    heartbeat.set_account_params(csrf_token, university_id)
 
     # ─── 图文自动浏览 ───────────────────────────────────────────
     if auto_richtext:
-        print("\n" + "="*60)
-        print("开始自动浏览图文内容...")
-        print(f"配置参数: 每篇停留={richtext_stay_seconds}s, 篇间间隔={richtext_skip_delay}s")
-        print("="*60)
+        for classroom_id, sign in classrooms:
+            if cancel_token.cancelled:
+                break
+            logger.info("============================================================")
+            logger.info("开始自动浏览图文内容... (课堂ID: %s)", classroom_id)
+            logger.info("配置参数: 每篇停留=%ss, 篇间间隔=%ss, 并发数=%s, 速率上限=%s/s", richtext_stay_seconds, richtext_skip_delay, richtext_concurrency, rate_limiter.rate('article') or '不限')
+            logger.info("============================================================")
 
-        richtext_result = heartbeat.batch_view_richtexts(
-            classroom_id=classroom_id,
-            sign=sign,
-            stay_seconds=richtext_stay_seconds,
-            skip_delay=richtext_skip_delay,
-            debug=debug
-        )
-        print(f"图文浏览结果: 共{richtext_result['total']}篇, "
-              f"成功{richtext_result['success']}篇, "
-              f"失败{richtext_result['failed']}篇")
+            richtext_result = heartbeat.batch_view_richtexts(
+                classroom_id=classroom_id,
+                sign=sign,
+                stay_seconds=richtext_stay_seconds,
+                skip_delay=richtext_skip_delay,
+                debug=debug,
+                concurrency=richtext_concurrency,
+                prescan_workers=richtext_prescan_concurrency
+            )
+            logger.info("图文浏览结果: 共%s篇, 成功%s篇, 失败%s篇, 取消%s篇", richtext_result['total'], richtext_result['success'], richtext_result['failed'], richtext_result['cancelled'])
     else:
-        print("图文自动浏览未启用（可在 .env 中设置 AUTO_RICHTEXT=true 开启）")
+        logger.info("图文自动浏览未启用（可在 .env 中设置 AUTO_RICHTEXT=true 开启）")
 
     # ─── 视频自动观看 ───────────────────────────────────────────
-    video_list = heartbeat.get_video_leaf_list(classroom_id, sign, debug=debug)
-    if video_list:
-        print(f"找到 {len(video_list)} 个视频")
+    watchable = []
+    for classroom_id, sign in classrooms:
+        if cancel_token.cancelled:
+            logger.info("已取消，跳过视频观看")
+            break
+        video_list = heartbeat.discover_videos(classroom_id, sign, debug=debug)
+        if not video_list:
+            logger.warning("课堂 %s 未找到视频，请检查参数", classroom_id)
+            continue
+        watchable.append((classroom_id, sign))
+        logger.info("课堂 %s 找到 %s 个视频", classroom_id, len(video_list))
         for i, video in enumerate(video_list, 1):
-            print(f"{i}. ID: {video['id']}, 名称: {video['name']}, 章节: {video['chapter_name']}")
+            logger.info("%s. ID: %s, 名称: %s, 章节: %s", i, video['id'], video['name'], video['chapter_name'])
 
-        print(f"配置参数: 并发={use_concurrent}, 并发数={max_concurrent_videos}, 速度={video_speed}x, 间隔={heartbeat_interval}s")
-        print(f"测试模式: {test_mode}, 跳过已完成: {skip_completed}")
+    summaries = {}
+    if watchable:
+        logger.info("配置参数: 并发=%s, 并发数=%s, 速度=%sx, 间隔=%ss", use_concurrent, max_concurrent_videos, video_speed, heartbeat_interval)
+        logger.info("测试模式: %s, 跳过已完成: %s", test_mode, skip_completed)
 
-        if use_concurrent:
-            print(f"\n开始并发观看视频... (并发数: {max_concurrent_videos})")
-            heartbeat.concurrent_watch_videos(
-                classroom_id=classroom_id,
-                sign=sign,
+        if use_concurrent and use_async:
+            logger.info("开始异步并发观看视频... (并发数: %s)", max_concurrent_videos)
+            summaries = heartbeat.async_watch_classrooms(
+                watchable,
                 speed=video_speed,
                 interval=heartbeat_interval,
                 skip_completed=skip_completed,
-                max_workers=max_concurrent_videos,  # 最大并发数
-                test_mode=test_mode,          # 测试模式
-                test_video_count=test_video_count   # 测试视频数量
+                max_workers=max_concurrent_videos,
+                test_mode=test_mode,
+                test_video_count=test_video_count,
+                prefetch_workers=prefetch_concurrency
             )
-        else:
-            print("\n开始串行观看所有视频...")
-            heartbeat.batch_watch_videos(
-                classroom_id=classroom_id,
-                sign=sign,
+        elif use_concurrent:
+            logger.info("开始并发观看视频... (并发数: %s)", max_concurrent_videos)
+            # 所有课堂共用同一份并发预算、连接池和限速
+            summaries = heartbeat.watch_classrooms(
+                watchable,
                 speed=video_speed,
                 interval=heartbeat_interval,
-                skip_completed=skip_completed
+                skip_completed=skip_completed,
+                max_workers=max_concurrent_videos,  # 最大并发数
+                test_mode=test_mode,          # 测试模式
+                test_video_count=test_video_count,   # 测试视频数量
+                prefetch_workers=prefetch_concurrency  # 元数据预取并发数
             )
-    else:
-        print("未找到视频，请检查参数")
+        else:
+            logger.info("开始串行观看所有视频...")
+            for classroom_id, sign in watchable:
+                if cancel_token.cancelled:
+                    break
+                summaries[classroom_id] = heartbeat.batch_watch_videos(
+                    classroom_id=classroom_id,
+                    sign=sign,
+                    speed=video_speed,
+                    interval=heartbeat_interval,
+                    skip_completed=skip_completed
+                )
+
+    if len(classrooms) > 1:
+        logger.info("各课堂观看统计:")
+        for classroom_id, _ in classrooms:
+            summary = summaries.get(classroom_id)
+            if summary is None:
+                logger.info("  课堂 %s: 未观看", classroom_id)
+            else:
+                logger.info("  课堂 %s: 共%s个, 成功%s个, 跳过%s个, 失败%s个, 取消%s个", classroom_id, summary['total'], summary['success'], summary['skipped'], summary['failed'], summary['cancelled'])
+
+    pool_stats = transport.stats()
+    logger.info("连接池统计: 请求 %s 次, 新建连接 %s 次, 复用连接 %s 次", pool_stats['requests'], pool_stats['new_connections'], pool_stats['reused_connections'])
+
+    tick_stats = scheduler.stats()
+    if tick_stats['ticks']:
+        logger.info("心跳调度统计: 共 %s 次, 平均延迟 %.1fms, P95 %.1fms, 最大 %.1fms", tick_stats['ticks'], tick_stats['mean_lateness'] * 1000, tick_stats['p95_lateness'] * 1000, tick_stats['max_lateness'] * 1000)
+
+    logger.info("接口请求统计:")
+    for line in metrics.summary_lines():
+        logger.info("%s", line)
+    if metrics_file:
+        metrics.write(metrics_file)
+        logger.info("请求统计已写入: %s", metrics_file)
+    metrics.stop_http_server()
+
+    if cancel_token.cancelled:
+        sys.exit(130)
 
 
 
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+长江雨课堂本地模拟服务器
+
+实现 YuketangHeartbeat 用到的全部接口（课程章节、leaf信息、拖拽权限、水印、播放地址、
+心跳、观看进度、图文打卡），并提供合成的 MP4 文件供 getVideoDuration 探测时长。
+用于离线测试和压测，课程规模、延迟和错误率均可配置：
+
+    python mock_server.py --port 8765 --chapters 10 --videos-per-chapter 5 --latency-ms 50
+    YUKETANG_BASE_URL=http://127.0.0.1:8765 python main.py
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import random
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+MOCK_USER_ID = 10001
+MOCK_COURSE_ID = 20001
+MOCK_UNIVERSITY_ID = 1234
+
+
+def _box(box_type, payload):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def build_mp4(duration, moov_at_end=False, mdat_size=1024 * 1024, time_scale=1000):
+    """构造一个只含 ftyp、moov(mvhd) 和 mdat 的 MP4 文件，moov 可放在开头或末尾"""
+    ftyp = _box(b'ftyp', b'isom' + struct.pack('>I', 512) + b'isomiso2avc1mp41')
+    # mvhd version 0：version/flags、创建时间、修改时间、time_scale、duration，其余字段补零
+    mvhd = _box(b'mvhd', struct.pack('>I', 0) + struct.pack('>IIII', 0, 0, time_scale,
+                                                              int(duration * time_scale)) + bytes(80))
+    moov = _box(b'moov', mvhd)
+    mdat = _box(b'mdat', bytes(mdat_size))
+    if moov_at_end:
+        return ftyp + mdat + moov
+    return ftyp + moov + mdat
+
+
+class MockCourse:
+    """模拟课堂的课程结构和用户状态（观看进度、图文完成情况），线程安全"""
+
+    def __init__(self, chapters=3, videos_per_chapter=4, richtexts_per_chapter=1, video_duration=300,
+                 completed_ratio=0.0, moov_layout='mixed', mdat_size=1024 * 1024, seed=0):
+        self.lock = threading.Lock()
+        self.chapters = []
+        # leaf_id -> leaf信息（视频和图文）
+        self.leaves = {}
+        # leaf_id -> {'rate', 'last_point'}
+        self.progress = {}
+        # 图文 leaf_id -> 是否已完成
+        self.article_finished = {}
+        self.mdat_size = mdat_size
+        # ccid -> MP4 文件内容（按需生成）
+        self._media = {}
+
+        rng = random.Random(seed)
+        next_id = itertools.count(1000)
+        for c in range(chapters):
+            sections = []
+            for v in range(videos_per_chapter):
+                section_id, leaf_id = next(next_id), next(next_id)
+                ccid = f"mockcc{leaf_id:08d}"
+                if moov_layout == 'mixed':
+                    moov_at_end = leaf_id % 2 == 1
+                else:
+                    moov_at_end = moov_layout == 'end'
+                sku_id = 30000 + c
+                sections.append({
+                    'id': section_id,
+                    'name': f"Video {c + 1}-{v + 1}",
+                    'sku_id': sku_id,
+                    'leaf_list': [{'id': leaf_id, 'leaf_type': 0, 'leafinfo_id': leaf_id + 500000}],
+                })
+                self.leaves[leaf_id] = {
+                    'kind': 'video', 'name': f"Video {c + 1}-{v + 1}", 'sku_id': sku_id, 'ccid': ccid,
+                    'duration': video_duration, 'moov_at_end': moov_at_end,
+                }
+                if rng.random() < completed_ratio:
+                    self.progress[leaf_id] = {'rate': 1.0, 'last_point': video_duration}
+            for r in range(richtexts_per_chapter):
+                leaf_id = next(next_id)
+                sections.append({
+                    'id': leaf_id,
+                    'name': f"图文 {c + 1}-{r + 1}",
+                    'leaf_type': 3,
+                    'sku_id': 30000 + c,
+                    'leafinfo_id': leaf_id + 500000,
+                    'leaf_list': [],
+                })
+                self.leaves[leaf_id] = {'kind': 'article', 'name': f"图文 {c + 1}-{r + 1}", 'sku_id': 30000 + c}
+                self.article_finished[leaf_id] = rng.random() < completed_ratio
+            self.chapters.append({'id': 900 + c, 'name': f"第{c + 1}章", 'section_leaf_list': sections})
+
+        self._ccid_to_leaf = {info['ccid']: leaf_id for leaf_id, info in self.leaves.items() if 'ccid' in info}
+
+    def leaf_info(self, leaf_id):
+        info = self.leaves.get(leaf_id)
+        if info is None:
+            return None
+        data = {
+            'id': leaf_id,
+            'name': info['name'],
+            'user_id': MOCK_USER_ID,
+            'course_id': MOCK_COURSE_ID,
+            'sku_id': info['sku_id'],
+            'university_id': MOCK_UNIVERSITY_ID,
+            'content_info': {},
+        }
+        if info['kind'] == 'video':
+            # 与线上一致：media 中不带可用的时长，需要探测 MP4
+            data['content_info'] = {'media': {'ccid': info['ccid'], 'duration': 0}}
+        return data
+
+    def media(self, ccid):
+        leaf_id = self._ccid_to_leaf.get(ccid)
+        if leaf_id is None:
+            return None
+        with self.lock:
+            if ccid not in self._media:
+                info = self.leaves[leaf_id]
+                self._media[ccid] = build_mp4(info['duration'], info['moov_at_end'], self.mdat_size)
+            return self._media[ccid]
+
+    def record_heartbeat(self, heart_data):
+        try:
+            leaf_id = int(heart_data.get('v'))
+            position = float(heart_data.get('cp', 0))
+            duration = float(heart_data.get('d') or 0)
+        except (TypeError, ValueError):
+            return
+        if duration <= 0:
+            return
+        with self.lock:
+            current = self.progress.setdefault(leaf_id, {'rate': 0.0, 'last_point': 0})
+            current['last_point'] = position
+            current['rate'] = max(current['rate'], min(position / duration, 1.0))
+
+    def progress_of(self, leaf_ids):
+        with self.lock:
+            return {
+                str(leaf_id): dict(self.progress.get(leaf_id, {'rate': 0.0, 'last_point': 0}))
+                for leaf_id in leaf_ids if leaf_id in self.leaves
+            }
+
+
+class MockYuketangServer:
+    """在后台线程中运行的模拟服务器，start() 后通过 base_url 访问"""
+
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0,
+                 course=None, **course_options):
+        self.course = course or MockCourse(**course_options)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        # 按接口统计请求数，便于压测时核对请求量
+        self.request_counts = {}
+        self.bytes_sent = 0
+        self._stats_lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='mock-yuketang', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def count(self, endpoint, sent=0):
+        with self._stats_lock:
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+            self.bytes_sent += sent
+
+    def stats(self):
+        with self._stats_lock:
+            return {'requests': dict(self.request_counts), 'bytes_sent': self.bytes_sent}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(_MockHandler):
+            mock = server
+
+        return Handler
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # 响应头和响应体分两次写出，不关闭 Nagle 时 keep-alive 连接上每个请求会多出约40ms的延迟确认等待
+    disable_nagle_algorithm = True
+    mock = None
+
+    # (方法, 路径前缀, 接口名, 处理函数名)，按顺序匹配
+    ROUTES = [
+        ('GET', '/mooc-api/v1/lms/learn/course/chapter', 'course_chapter', '_course_chapter'),
+        ('GET', '/mooc-api/v1/lms/learn/leaf_info/', 'leaf_info', '_leaf_info'),
+        ('GET', '/mooc-api/v1/lms/learn/leafprogress/', 'leafprogress', '_leaf_info'),
+        ('GET', '/mooc-api/v1/lms/learn/leaf/', 'leaf', '_leaf_info'),
+        ('GET', '/mooc-api/v1/lms/learn/classroom_info/', 'classroom_info', '_classroom_info'),
+        ('GET', '/mooc-api/v1/lms/learn/video/drag', 'video_drag', '_video_drag'),
+        ('GET', '/c27/api/v1/platfrom/watermark', 'watermark', '_watermark'),
+        ('GET', '/api/open/audiovideo/playurl', 'playurl', '_playurl'),
+        ('GET', '/video-log/get_video_watch_progress/', 'progress', '_progress'),
+        ('POST', '/video-log/heartbeat/', 'heartbeat', '_heartbeat'),
+        ('GET', '/mooc-api/v1/lms/learn/user_article_finish_status/', 'article_status', '_article_status'),
+        ('GET', '/mooc-api/v1/lms/learn/user_article_finish/', 'article_finish', '_article_finish'),
+        ('GET', '/media/', 'media', '_media'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, method):
+        parts = urlsplit(self.path)
+        self.query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        self.route_path = parts.path
+
+        body = b''
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length)
+
+        for route_method, prefix, endpoint, handler in self.ROUTES:
+            if route_method == method and parts.path.startswith(prefix):
+                break
+        else:
+            self._send_json({'success': False, 'msg': 'not found'}, status=404, endpoint='unknown')
+            return
+
+        mock = self.mock
+        if mock.latency_ms or mock.jitter_ms:
+            time.sleep(max(mock.latency_ms + random.uniform(-mock.jitter_ms, mock.jitter_ms), 0) / 1000)
+        # 媒体文件不注入错误，时长探测本身会在失败时返回None
+        if endpoint != 'media' and mock.error_rate and random.random() < mock.error_rate:
+            self._send_json({'success': False, 'msg': 'injected error'}, status=500, endpoint=endpoint)
+            return
+
+        self.endpoint = endpoint
+        getattr(self, handler)(body)
+
+    def _path_ids(self, prefix):
+        """取出路径前缀之后的数字段，如 leaf_info/{classroom_id}/{leaf_id}/ -> [classroom_id, leaf_id]"""
+        tail = self.route_path.split(prefix, 1)[1]
+        return [int(part) for part in tail.split('/') if part.isdigit()]
+
+    def _send_json(self, payload, status=200, endpoint=None, etag=False):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if etag:
+            tag = '"' + hashlib.md5(data).hexdigest() + '"'
+            headers['ETag'] = tag
+            if self.headers.get('If-None-Match') == tag:
+                status, data = 304, b''
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.mock.count(endpoint or self.endpoint, len(data))
+
+    def _course_chapter(self, body):
+        course = self.mock.course
+        self._send_json({'success': True, 'data': {'course_chapter': course.chapters}})
+
+    def _leaf_info(self, body):
+        prefix = {
+            'leaf_info': '/leaf_info/', 'leafprogress': '/leafprogress/', 'leaf': '/learn/leaf/'
+        }[self.endpoint]
+        ids = self._path_ids(prefix)
+        data = self.mock.course.leaf_info(ids[-1]) if ids else None
+        if data is None:
+            self._send_json({'success': False, 'msg': 'leaf not found'})
+        else:
+            self._send_json({'success': True, 'data': data}, etag=True)
+
+    def _classroom_info(self, body):
+        self._send_json({'success': True, 'data': {'classroom_id': self.query.get('classroom_id'),
+                                                   'course_id': MOCK_COURSE_ID}})
+
+    def _video_drag(self, body):
+        self._send_json({'success': True, 'data': {'has_drag': False}}, etag=True)
+
+    def _watermark(self, body):
+        self._send_json({'success': True, 'data': {'enable': False}}, etag=True)
+
+    def _playurl(self, body):
+        ccid = self.query.get('video_id', '')
+        if self.mock.course.media(ccid) is None:
+            self._send_json({'success': False, 'msg': 'video not found'})
+            return
+        host = self.headers.get('Host')
+        self._send_json({'success': True, 'data': {'playurl': {'sources': {
+            'quality20': [f"http://{host}/media/{ccid}.mp4"],
+            'quality10': [f"http://{host}/media/{ccid}.mp4?q=10"],
+        }}}}, etag=True)
+
+    def _progress(self, body):
+        ids = [int(value) for value in self.query.get('video_id', '').split(',') if value.isdigit()]
+        self._send_json({'code': 0, 'data': self.mock.course.progress_of(ids)})
+
+    def _heartbeat(self, body):
+        try:
+            heart_data = json.loads(body or b'{}').get('heart_data', [])
+        except ValueError:
+            self._send_json({'code': 1, 'msg': 'bad json'}, status=400)
+            return
+        for item in heart_data:
+            self.mock.course.record_heartbeat(item)
+        self._send_json({'code': 0, 'msg': '', 'data': {}})
+
+    def _article_status(self, body):
+        ids = self._path_ids('/user_article_finish_status/')
+        finished = self.mock.course.article_finished.get(ids[0]) if ids else None
+        if finished is None:
+            self._send_json({'success': False, 'msg': 'leaf not found'})
+        else:
+            self._send_json({'success': True, 'data': {'finish': 1 if finished else 0}})
+
+    def _article_finish(self, body):
+        ids = self._path_ids('/user_article_finish/')
+        course = self.mock.course
+        if not ids or ids[0] not in course.article_finished:
+            self._send_json({'success': False, 'msg': 'leaf not found'})
+            return
+        with course.lock:
+            course.article_finished[ids[0]] = True
+        self._send_json({'success': True, 'data': {}})
+
+    def _media(self, body):
+        ccid = self.route_path.rsplit('/', 1)[-1].split('.', 1)[0]
+        data = self.mock.course.media(ccid)
+        if data is None:
+            self._send_json({'success': False}, status=404)
+            return
+
+        status, start, end = 200, 0, len(data) - 1
+        range_header = self.headers.get('Range', '')
+        if range_header.startswith('bytes='):
+            first, _, last = range_header[6:].partition('-')
+            start = int(first) if first else 0
+            end = min(int(last), len(data) - 1) if last else len(data) - 1
+            status = 206
+        chunk = data[start:end + 1]
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        self.send_header('Content-Length', str(len(chunk)))
+        self.end_headers()
+        try:
+            self.wfile.write(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端读到足够的数据后会提前关闭连接
+            pass
+        self.mock.count('media', len(chunk))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='长江雨课堂本地模拟服务器')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--chapters', type=int, default=3, help='章节数')
+    parser.add_argument('--videos-per-chapter', type=int, default=4, help='每章视频数')
+    parser.add_argument('--richtexts-per-chapter', type=int, default=1, help='每章图文数')
+    parser.add_argument('--video-duration', type=float, default=300, help='视频时长（秒）')
+    parser.add_argument('--completed-ratio', type=float, default=0.0, help='初始已完成的视频/图文比例')
+    parser.add_argument('--moov', choices=['start', 'end', 'mixed'], default='mixed',
+                        help='MP4 中 moov 的位置（mixed 为交替）')
+    parser.add_argument('--mdat-size', type=int, default=1024 * 1024, help='合成 MP4 的 mdat 字节数')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='每个请求的平均延迟（毫秒）')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='延迟的随机抖动（毫秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='接口返回500的概率')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    args = parser.parse_args()
+
+    server = MockYuketangServer(
+        host=args.host, port=args.port,
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+        chapters=args.chapters, videos_per_chapter=args.videos_per_chapter,
+        richtexts_per_chapter=args.richtexts_per_chapter, video_duration=args.video_duration,
+        completed_ratio=args.completed_ratio, moov_layout=args.moov, mdat_size=args.mdat_size, seed=args.seed
+    )
+    video_count = sum(1 for info in server.course.leaves.values() if info['kind'] == 'video')
+    print(f"模拟服务器已启动: {server.base_url}")
+    print(f"  章节数: {args.chapters}, 视频数: {video_count}, 图文数: {len(server.course.article_finished)}")
+    print(f"  设置 YUKETANG_BASE_URL={server.base_url} 后运行 main.py")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("\n模拟服务器已停止")
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()